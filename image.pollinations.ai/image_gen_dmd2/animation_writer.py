@@ -0,0 +1,141 @@
+import os
+import queue
+import subprocess
+import threading
+
+import numpy as np
+
+MINTERPOLATE = "minterpolate='mi_mode=mci:mc_mode=aobmc:vsbmc=1:fps={fps}'"
+GIF_PALETTE = "split[a][b];[a]palettegen[p];[b][p]paletteuse"
+
+
+def ping_pong(frames):
+    """Frames forward, back again and the first frame once more, as references to the same frames."""
+    return list(frames) + list(frames[-2:0:-1]) + list(frames[:1])
+
+
+class AnimationWriter:
+    """Encodes an MP4 or GIF through one ffmpeg process fed raw RGB frames over stdin.
+
+    `write` only queues a frame; a background thread converts it to raw bytes
+    and pipes it to ffmpeg, so encoding overlaps whatever the caller does
+    next, e.g. rendering the following frames. With `reuse_frames`, a frame
+    written several times (e.g. by `ping_pong`) is converted once. With
+    `smooth_fps`, minterpolate runs inside the same ffmpeg filter graph, so the
+    clip is encoded once instead of being decoded and encoded again.
+    `audio_path` is muxed into every output, and `interpolated_path` gets a
+    second copy of the video motion-interpolated to `interpolated_fps` from
+    the same frames. `close` waits for ffmpeg and raises if it failed.
+    """
+
+    def __init__(self, path, width, height, fps, smooth_fps=None, max_queued=8, reuse_frames=False,
+                 audio_path=None, interpolated_path=None, interpolated_fps=60, video_args=None):
+        self.paths = [path] + ([interpolated_path] if interpolated_path else [])
+        self.path = path
+        self.width = width
+        self.height = height
+        self.frames = queue.Queue(maxsize=max_queued)
+        self.error = None
+        self.reuse_frames = reuse_frames
+        self._converted = {}  # id(frame) -> (frame, raw bytes); the frame is kept so its id isn't reused
+
+        filters = [MINTERPOLATE.format(fps=smooth_fps)] if smooth_fps else []
+        if path.endswith(".gif"):
+            filters.append(GIF_PALETTE)
+        graph = []
+        if interpolated_path:
+            graph.append("[0:v]split[main][interpolated]")
+            graph.append(f"[interpolated]minterpolate='fps={interpolated_fps}'[out1]")
+            source = "[main]"
+        else:
+            source = "[0:v]"
+        graph.append(f"{source}{','.join(filters) or 'null'}[out0]")
+
+        command = [
+            "ffmpeg", "-loglevel", "error", "-y",
+            "-f", "rawvideo", "-pix_fmt", "rgb24", "-s", f"{width}x{height}", "-r", str(fps), "-i", "-",
+        ]
+        if audio_path:
+            command += ["-i", audio_path]
+        command += ["-filter_complex", ";".join(graph)]
+        for idx, output_path in enumerate(self.paths):
+            command += ["-map", f"[out{idx}]"]
+            if audio_path:
+                command += ["-map", "1:a", "-c:a", "aac", "-shortest"]
+            if output_path.endswith(".gif"):
+                command += ["-loop", "0"]
+            else:
+                command += video_args or ["-c:v", "libx264", "-pix_fmt", "yuv420p", "-movflags", "+faststart"]
+            command.append(output_path)
+
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+        self.thread = threading.Thread(target=self._feed, name="animation-writer", daemon=True)
+        self.thread.start()
+
+    def write(self, frame):
+        """Queue a PIL image or HxWx3 uint8 array for encoding."""
+        self.frames.put(frame)
+
+    def _raw(self, frame):
+        cached = self._converted.get(id(frame))
+        if cached is not None:
+            return cached[1]
+        if isinstance(frame, np.ndarray):
+            array = np.ascontiguousarray(frame, dtype=np.uint8)
+            if array.shape != (self.height, self.width, 3):
+                raise ValueError(f"Frame is not {self.width}x{self.height} RGB")
+            # A flat byte view of the array, so ffmpeg gets it without another copy
+            raw = array.data.cast("B")
+        else:
+            raw = frame.convert("RGB").tobytes()
+            if len(raw) != self.width * self.height * 3:
+                raise ValueError(f"Frame is not {self.width}x{self.height} RGB")
+        if self.reuse_frames:
+            self._converted[id(frame)] = (frame, raw)
+        return raw
+
+    def _feed(self):
+        while True:
+            frame = self.frames.get()
+            if frame is None:
+                break
+            if self.error is not None:
+                # Keep draining so writers never block on a dead encoder
+                continue
+            try:
+                self.process.stdin.write(self._raw(frame))
+            except (OSError, ValueError) as e:
+                self.error = e
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+
+    def close(self):
+        """Finish encoding and return the path of the first output."""
+        self.frames.put(None)
+        self.thread.join()
+        self._converted.clear()
+        stderr = self.process.stderr.read().decode("utf-8", "replace")
+        returncode = self.process.wait()
+        if returncode != 0 or self.error is not None:
+            raise RuntimeError(f"ffmpeg failed writing {self.path} ({returncode}): {stderr.strip() or self.error}")
+        for path in self.paths:
+            print(f"Wrote animation {path} ({os.path.getsize(path) / 1024:.0f} KB)")
+        return self.path
+
+    def abort(self):
+        """Stop ffmpeg without finishing the outputs."""
+        self.process.kill()
+        self.frames.put(None)
+        self.thread.join()
+        self.process.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
@@ -0,0 +1,152 @@
+import hashlib
+import os
+import subprocess
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy.signal import lfilter
+
+SAMPLE_RATE = 22050
+RMS_FRAME_LENGTH = 2048
+
+
+def decode_stream(path, sample_rate=SAMPLE_RATE, chunk_seconds=30):
+    """Mono float32 samples of `path` at `sample_rate`, decoded by ffmpeg and yielded in chunks,
+    so a long track is never held in memory whole."""
+    process = subprocess.Popen(
+        ["ffmpeg", "-loglevel", "error", "-i", path, "-f", "f32le", "-ac", "1", "-ar", str(sample_rate), "-"],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+    )
+    chunk_bytes = int(sample_rate * chunk_seconds) * 4
+    try:
+        while True:
+            data = process.stdout.read(chunk_bytes)
+            if not data:
+                break
+            # A read can end mid-sample only at the end of the stream
+            yield np.frombuffer(data[:len(data) - len(data) % 4], dtype=np.float32)
+    finally:
+        process.stdout.close()
+        stderr = process.stderr.read().decode("utf-8", "replace")
+        if process.wait() != 0:
+            raise RuntimeError(f"ffmpeg could not decode {path}: {stderr.strip()}")
+
+
+def peak(frames):
+    return np.abs(frames).max(axis=1)
+
+
+def rms(frames):
+    return np.sqrt(np.mean(np.square(frames, dtype=np.float64), axis=1)).astype(np.float32)
+
+
+class EnvelopeStream:
+    """Envelope of a signal fed in chunks, one value per hop.
+
+    Frames are strided views over the samples buffered so far, reduced in one
+    call per chunk; only the tail of an incomplete frame is carried over.
+    `peak` uses back-to-back frames of `hop_length` samples, like
+    range(0, len(signal), hop_length). `rms` uses centered, zero-padded frames of
+    `frame_length` samples, like librosa.feature.rms.
+    """
+
+    def __init__(self, hop_length, kind="peak", frame_length=RMS_FRAME_LENGTH):
+        if kind not in ("peak", "rms"):
+            raise ValueError(f"Unknown envelope {kind!r}, expected 'peak' or 'rms'")
+        self.hop_length = hop_length
+        self.kind = kind
+        self.reduce = peak if kind == "peak" else rms
+        self.frame_length = hop_length if kind == "peak" else frame_length
+        self.buffer = np.zeros(0 if kind == "peak" else self.frame_length // 2, dtype=np.float32)
+        self.samples = 0
+        self.emitted = 0
+
+    def _frames(self, count):
+        if count == 0:
+            return np.zeros(0, dtype=np.float32)
+        frames = sliding_window_view(self.buffer, self.frame_length)[::self.hop_length][:count]
+        self.buffer = self.buffer[count * self.hop_length:]
+        self.emitted += count
+        return self.reduce(frames)
+
+    def feed(self, chunk):
+        """Envelope values of the frames completed by `chunk`."""
+        self.samples += len(chunk)
+        self.buffer = np.concatenate([self.buffer, chunk])
+        count = max(0, (len(self.buffer) - self.frame_length) // self.hop_length + 1)
+        return self._frames(count)
+
+    def finish(self):
+        """Envelope values of the remaining frames, zero-padded at the end of the signal."""
+        if self.kind == "peak":
+            total = -(-self.samples // self.hop_length)
+        else:
+            total = 1 + self.samples // self.hop_length
+        count = total - self.emitted
+        if count <= 0:
+            return np.zeros(0, dtype=np.float32)
+        needed = (count - 1) * self.hop_length + self.frame_length
+        self.buffer = np.pad(self.buffer, (0, max(0, needed - len(self.buffer))))
+        return self._frames(count)
+
+
+def envelope(signal, hop_length, kind="peak", frame_length=RMS_FRAME_LENGTH):
+    """Envelope of a signal that is already in memory."""
+    stream = EnvelopeStream(hop_length, kind, frame_length)
+    return np.concatenate([stream.feed(np.asarray(signal, dtype=np.float32)), stream.finish()])
+
+
+def smooth(values, smoothing):
+    """Exponential smoothing y[n] = smoothing * y[n-1] + (1 - smoothing) * x[n], starting from 0."""
+    return lfilter([1 - smoothing], [1, -smoothing], np.asarray(values, dtype=np.float64))
+
+
+def noise_schedule(intensities, smoothing, noise_scale):
+    """Per-frame interpolation positions between two start codes, from normalized audio intensities."""
+    return (smooth(intensities, smoothing) * noise_scale).astype(np.float32)
+
+
+def file_digest(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class AudioFeatures:
+    """Envelopes of audio files, decoded in chunks and cached on disk.
+
+    Entries are keyed by the file's content hash and the analysis parameters,
+    so the same track uploaded again under another name is only hashed, not
+    decoded.
+    """
+
+    def __init__(self, directory, sample_rate=SAMPLE_RATE, chunk_seconds=30):
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.chunk_seconds = chunk_seconds
+        os.makedirs(directory, exist_ok=True)
+
+    def envelope(self, path, hop_length, kind="peak", frame_length=RMS_FRAME_LENGTH):
+        key = f"{file_digest(path)}-{self.sample_rate}-{kind}-{hop_length}"
+        if kind == "rms":
+            key += f"-{frame_length}"
+        cache_path = os.path.join(self.directory, f"{key}.npy")
+        if os.path.exists(cache_path):
+            return np.load(cache_path)
+
+        stream = EnvelopeStream(hop_length, kind, frame_length)
+        values = [stream.feed(chunk) for chunk in decode_stream(path, self.sample_rate, self.chunk_seconds)]
+        values.append(stream.finish())
+        result = np.concatenate(values)
+
+        # Written under a temporary name so concurrent readers never see a partial file
+        temp_path = f"{cache_path}.{os.getpid()}.tmp.npy"
+        np.save(temp_path, result)
+        os.replace(temp_path, cache_path)
+        return result
+
+
+def from_env():
+    return AudioFeatures(os.getenv("AUDIO_FEATURE_CACHE_DIR", "/tmp/audio-features"))
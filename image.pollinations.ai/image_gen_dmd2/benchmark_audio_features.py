@@ -0,0 +1,103 @@
+"""Compares the audio-reactive feature pipeline with the per-frame Python loops it replaced.
+
+Synthesizes a multi-minute stereo track, then times the peak envelope and the
+exponential smoothing on the decoded signal both ways, and the streamed
+analysis of the file: decoded by ffmpeg in chunks, then served from the cache.
+Needs ffmpeg on the PATH.
+
+Run with:
+    python benchmark_audio_features.py [minutes]
+"""
+import sys
+import tempfile
+import time
+import tracemalloc
+import wave
+
+import numpy as np
+
+from audio_features import SAMPLE_RATE, AudioFeatures, decode_stream, envelope, smooth
+
+FRAME_RATE = 16
+SMOOTHING = 0.8
+
+
+def loop_envelope(signal, hop_length):
+    amplitude_envelope = []
+    for i in range(0, len(signal), hop_length):
+        amplitude_envelope.append(max(np.abs(signal[i:i + hop_length])))
+    return np.array(amplitude_envelope)
+
+
+def loop_smooth(values, smoothing):
+    smoothed, result = 0, []
+    for value in values:
+        smoothed = smoothed * smoothing + value * (1 - smoothing)
+        result.append(smoothed)
+    return np.array(result)
+
+
+def write_track(path, minutes, sample_rate=44100):
+    rng = np.random.default_rng(0)
+    t = np.arange(int(minutes * 60 * sample_rate)) / sample_rate
+    beat = (np.sin(2 * np.pi * 2 * t) > 0.9).astype(np.float32)
+    left = 0.3 * np.sin(2 * np.pi * 220 * t) * (0.5 + 0.5 * np.sin(2 * np.pi * 0.05 * t)) + 0.4 * beat * rng.standard_normal(t.shape)
+    right = 0.3 * np.sin(2 * np.pi * 330 * t) + 0.2 * rng.standard_normal(t.shape)
+    samples = (np.clip(np.stack([left, right], axis=1), -1, 1) * 32767).astype(np.int16)
+    with wave.open(path, "wb") as f:
+        f.setnchannels(2)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(samples.tobytes())
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, (time.perf_counter() - start) * 1000
+
+
+def peak_memory_mb(fn):
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak / 1024 / 1024
+
+
+def main():
+    minutes = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+    hop_length = int(SAMPLE_RATE / FRAME_RATE)
+    with tempfile.TemporaryDirectory() as directory:
+        path = f"{directory}/track.wav"
+        write_track(path, minutes)
+        signal = np.concatenate(list(decode_stream(path)))
+        print(f"{minutes:g} minute track, {len(signal)} samples at {SAMPLE_RATE} Hz, hop {hop_length}")
+
+        reference, loop_ms = timed(lambda: loop_envelope(signal, hop_length))
+        peaks, vectorized_ms = timed(lambda: envelope(signal, hop_length))
+        assert np.allclose(reference, peaks)
+        print(f"peak envelope: loop {loop_ms:.1f}ms, strided {vectorized_ms:.1f}ms ({len(peaks)} frames)")
+
+        _, rms_ms = timed(lambda: envelope(signal, hop_length, kind="rms"))
+        print(f"rms envelope: strided {rms_ms:.1f}ms")
+
+        intensities = peaks / peaks.max()
+        reference, loop_ms = timed(lambda: loop_smooth(intensities, SMOOTHING))
+        smoothed, vectorized_ms = timed(lambda: smooth(intensities, SMOOTHING))
+        assert np.allclose(reference, smoothed)
+        print(f"smoothing: loop {loop_ms:.2f}ms, lfilter {vectorized_ms:.2f}ms")
+
+        features = AudioFeatures(f"{directory}/cache")
+        streamed, cold_ms = timed(lambda: features.envelope(path, hop_length))
+        assert np.allclose(streamed, peaks)
+        _, cached_ms = timed(lambda: features.envelope(path, hop_length))
+        print(f"file analysis: streamed decode {cold_ms:.1f}ms, cached {cached_ms:.1f}ms")
+
+        full = peak_memory_mb(lambda: envelope(np.concatenate(list(decode_stream(path))), hop_length))
+        streamed = peak_memory_mb(lambda: AudioFeatures(f"{directory}/uncached").envelope(path, hop_length))
+        print(f"peak memory: whole signal {full:.1f}MB, streamed {streamed:.1f}MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -70,17 +70,12 @@ from audiocraft.models.loaders import (
 )
 from audiocraft.data.audio import audio_write
 from audiocraft.models import MultiBandDiffusion
-from BeatNet.BeatNet import BeatNet
-import madmom.audio.filters
-
-# Hack madmom to work with recent python
-madmom.audio.filters.np.float = float
-
 import soundfile as sf
-import librosa
 import numpy as np
 import pyrubberband as pyrb
 
+from loop_search import from_env as loop_search_from_env
+
 
 MAX_TRIES = 3
 
@@ -95,14 +90,9 @@ class Predictor(BasePredictor):
 
         self.mbd = MultiBandDiffusion.get_mbd_musicgen()
 
-        self.beatnet = BeatNet(
-            1,
-            mode="offline",
-            inference_model="DBN",
-            plot=[],
-            thread=False,
-            device="cuda:0",
-        )
+        # beat tracking runs in CPU worker processes, one candidate each
+        self.loop_search = loop_search_from_env(MAX_TRIES)
+        self.loop_search.warm()
 
     def load_model(self, model_version):
         if model_version == "melody":
@@ -168,6 +158,12 @@ class Predictor(BasePredictor):
             description="Audio file to be continued by the model.",
             default=None,
         ),
+        num_candidates: int = Input(
+            description="Variations generated together in one batch; the one that best fits the tempo is returned. With 1, variations are generated one after another until one fits.",
+            default=MAX_TRIES,
+            ge=1,
+            le=8,
+        ),
     ) -> List[Path]:
         if prompt:
             prompt = f", {bpm}bpm. 320kbps 48khz. {prompt}"
@@ -194,11 +190,12 @@ class Predictor(BasePredictor):
         set_all_seeds(seed)
         print(f"Using seed {seed}")
 
-        print("Generating variation 1")
-
-        try_num = 0
+        # MAX_TRIES variations in total, num_candidates of them per batched generation
+        num_rounds = -(-MAX_TRIES // num_candidates)
         bpm_match = False
-        while not bpm_match and try_num < MAX_TRIES:
+        analysis = None
+        for round_num in range(num_rounds):
+            print(f"Generating variations {round_num * num_candidates + 1}-{(round_num + 1) * num_candidates}")
             if audio_input:
                 audio_prompt, sample_rate = torchaudio.load(audio_input)
                 # normalize
@@ -213,19 +210,20 @@ class Predictor(BasePredictor):
                     temperature=temperature,
                     cfg_coef=classifier_free_guidance,
                 )
+                audio_prompts = audio_prompt[None].expand(num_candidates, -1, -1)
 
                 if model_version == "melody":
                     wav, tokens = model.generate_with_chroma(
-                        melody_wavs=audio_prompt,
+                        melody_wavs=audio_prompts,
                         melody_sample_rate=sample_rate,
-                        descriptions=[prompt],
+                        descriptions=[prompt] * num_candidates,
                         return_tokens=True,
                         progress=True,
                     )
                 else:
-                    descriptions = {"descriptions": [prompt] } if prompt else {}
+                    descriptions = {"descriptions": [prompt] * num_candidates} if prompt else {}
                     wav, tokens = model.generate_continuation(
-                        prompt=audio_prompt,
+                        prompt=audio_prompts,
                         prompt_sample_rate=sample_rate,
                         return_tokens=True,
                         progress=True,
@@ -233,53 +231,41 @@ class Predictor(BasePredictor):
                     )
                 
             else:
-                wav, tokens = model.generate([prompt], return_tokens=True, progress=True)
+                wav, tokens = model.generate([prompt] * num_candidates, return_tokens=True, progress=True)
                 
             if use_multiband_diffusion:
                 left, right = model.compression_model.get_left_right_codes(tokens)
                 tokens = torch.cat([left, right])
                 wav = self.mbd.tokens_to_wav(tokens)
 
-            wav = wav.cpu().detach().numpy()[0, 0]
+            # left channel of each candidate; with multiband diffusion the right channels follow
+            candidates = wav[:num_candidates, 0].cpu().detach().numpy()
             # normalize
-            wav = wav / np.abs(wav).max()
-
-            audio_duration = len(wav) / model.sample_rate
+            candidates = [candidate / np.abs(candidate).max() for candidate in candidates]
 
-            beats = self.estimate_beats(wav, model.sample_rate)
-            start_time, end_time = self.get_loop_points(beats)
-            if not end_time:
+            idx, candidate_analysis = self.loop_search.best(candidates, model.sample_rate, bpm, shift_to_start=bool(audio_input))
+            if candidate_analysis is None:
+                print("no variation contains four whole bars, retrying")
                 continue
-            
-            # shift to start 0 
-            if audio_input:
-                end_time = end_time - start_time
-                start_time = 0
+            if analysis is None or candidate_analysis["bpm_error"] < analysis["bpm_error"]:
+                loop_wav, analysis = candidates[idx], candidate_analysis
+            if analysis["matched"]:
+                bpm_match = True
+                break
+            print("could not generate loop in requested bpm, retrying or returning as is")
 
-            print("Beats:\n", beats)
-            print(f"{start_time=}, {end_time=}")
+        if analysis is None:
+            raise ValueError(
+                "Less than four bars detected. Try increasing max_duration, or use a different seed."
+            )
 
-            num_beats = len(beats[(beats[:, 0] >= start_time) & (beats[:, 0] < end_time)])
-            duration = end_time - start_time
-            actual_bpm = num_beats / duration * 60
-            if (
-                abs(actual_bpm - bpm) > 15
-                and abs(actual_bpm / 2 - bpm) > 15
-                and abs(actual_bpm * 2 - bpm) > 15
-            ):
-                print("could not generate loop in requested bpm, retrying or returning as is")
-                try_num += 1
-            else:
-                # Allow octave errors
-                if abs(actual_bpm / 2 - bpm) <= 10:
-                    actual_bpm = actual_bpm / 2
-                elif abs(actual_bpm * 2 - bpm) <= 10:
-                    actual_bpm = actual_bpm * 2
-                bpm_match = True
+        print("Beats:\n", analysis["beats"])
+        start_time, end_time, actual_bpm = analysis["start_time"], analysis["end_time"], analysis["actual_bpm"]
+        print(f"{start_time=}, {end_time=}")
 
         start_sample = int(start_time * model.sample_rate)
         end_sample = int(end_time * model.sample_rate)
-        loop = wav[start_sample:end_sample]
+        loop = loop_wav[start_sample:end_sample]
 
         if bpm_match:
             print("Time stretch rate", bpm/actual_bpm)
@@ -291,37 +277,6 @@ class Predictor(BasePredictor):
 
         return outputs
 
-    def estimate_beats(self, wav, sample_rate):
-        # resample to BeatNet's sample rate
-        beatnet_input = librosa.resample(
-            wav,
-            orig_sr=sample_rate,
-            target_sr=self.beatnet.sample_rate,
-        )
-        print("wav", wav)
-        return self.beatnet.process(beatnet_input)
-
-    def get_loop_points(self, beats):
-        # extract an even number of bars
-        downbeat_times = beats[:, 0][beats[:, 1] == 1]
-        num_bars = len(downbeat_times) - 1
-
-        if num_bars < 1:
-            raise ValueError(
-                "Less than one bar detected. Try increasing max_duration, or use a different seed."
-            )
-
-        even_num_bars = int((num_bars // 4) * 4)
-        if even_num_bars < 4:
-            even_num_bars = 4
-        print("even_num_bars", even_num_bars)        
-        start_time = downbeat_times[0]
-        if num_bars < even_num_bars:
-            return start_time, None
-        end_time = downbeat_times[even_num_bars]
-
-        return start_time, end_time
-
     def write(self, audio, sample_rate, output_format, name):
         wav_path = name + ".wav"
         sf.write(wav_path, audio, sample_rate)
@@ -906,9 +861,11 @@ from transformers import CLIPImageProcessor
 
 from dataset_and_utils import TokenEmbeddingsHandler
 from rotate_animate import rotate_animate
-import imageio
 import uuid
 import requests
+from animation_writer import AnimationWriter, ping_pong
+from trajectory import slerp, slerp_path
+from model_cache import LoraAdapters, from_env as model_cache_from_env
 SDXL_MODEL_CACHE = "./sdxl-cache"
 REFINER_MODEL_CACHE = "./refiner-cache"
 SAFETY_CACHE = "./safety-cache"
@@ -917,6 +874,9 @@ SDXL_URL = "https://weights.replicate.delivery/default/sdxl/sdxl-vae-fix-1.0.tar
 REFINER_URL = "https://weights.replicate.delivery/default/sdxl/refiner-no-vae-no-encoder-1.0.tar"
 SAFETY_URL = "https://weights.replicate.delivery/default/sdxl/safety-1.0.tar"
 
+# LoRA files are downloaded once and swapped in and out of the pipelines per request
+model_cache = model_cache_from_env()
+lora_adapters = LoraAdapters()
 
 
 class KarrasDPM:
@@ -1185,18 +1145,10 @@ class Predictor(BasePredictor):
 
         if lora_url is not None and lora_url != "":
 
-            # create a path name which is a hash of the url with /tmp/[hash].tar
-
-            lora_hash = uuid.uuid5(uuid.NAMESPACE_URL, lora_url)
-            lora_path = f"/tmp/{lora_hash}.tar"
-
-            # check if the file exists
-            if not os.path.exists(lora_path):
-                # download tar file from url using requests
-                r = requests.get(lora_url, allow_redirects=True)
-                open(lora_path, 'wb').write(r.content)
-
-            # load the weights from the tar file
+            # streamed into the content-addressed model cache, or served from it
+            lora_path = model_cache.fetch(lora_url, suffix=".tar")
+        else:
+            lora_url = None
             
 
             
@@ -1275,9 +1227,8 @@ class Predictor(BasePredictor):
         generator = torch.Generator("cuda").manual_seed(seed)
         subseed_generator = torch.Generator("cuda").manual_seed(subseed)
 
-        # load lora
-        if lora_url is not None:
-            pipe.load_lora_weights(lora_path)
+        # activate the requested lora, or switch off the one a previous request used
+        lora_adapters.activate(pipe, [(lora_path, 1.0)] if lora_url is not None else [])
 
         latents = None
 
@@ -1312,8 +1263,8 @@ class Predictor(BasePredictor):
             scale = interpolate_distance / dist
             print("scale", scale, "dist", dist)
 
-            # use slerp(t, v0, v1, DOT_THRESHOLD=0.9995)
-            latents = torch.stack([slerp(scale * i / (num_outputs - 1), latent1, latent2) for i in range(num_outputs)])
+            # all outputs along the slerp from latent1 towards latent2 in one batched op
+            latents = slerp_path(torch.linspace(0, scale, num_outputs), latent1, latent2).stack()
 
             # move latents to device
             latents = latents.to(device)
@@ -1344,6 +1295,25 @@ class Predictor(BasePredictor):
 
         # _, has_nsfw_content = self.run_safety_checker(output.images)
     
+        if interpolate:
+            # create a unique temp filename for the animation
+            temp_out_filename = f"/tmp/out-{uuid.uuid4()}{media_extension}"
+            # mp4 runs at 3 fps, gifs get a 250ms delay between frames and loop.
+            # smooth_interpolation interpolates to 20 fps with minterpolate in the same encode
+            width, height = output.images[0].size
+            animation = AnimationWriter(
+                temp_out_filename,
+                width,
+                height,
+                fps=3 if media_extension == ".mp4" else 4,
+                smooth_fps=20 if smooth_interpolation else None,
+                reuse_frames=True,
+            )
+            # all frames forward, back without the last one, then the first again.
+            # ffmpeg encodes them in the background while the PNGs are saved below
+            for frame in ping_pong(output.images):
+                animation.write(frame)
+
         output_paths = []
         for i, nsfw in enumerate(output.images):
             output_path = f"/tmp/out-{uuid.uuid4()}-{i}.png"
@@ -1352,40 +1322,7 @@ class Predictor(BasePredictor):
         
 
         if interpolate:
-            # create a unique temp filename for the mp4
-            temp_out_filename = f"/tmp/out-{uuid.uuid4()}{media_extension}"
-            # create animated gif by appending all images
-            images = []
-            for path in output_paths:
-                images.append(imageio.imread(path))
-            # dont append the last image because it is the same as the first
-            for path in output_paths[1:-1][::-1]:
-                images.append(imageio.imread(path))
-            # if we interpolate, append the first image again
-            images.append(imageio.imread(output_paths[0]))
-
-            # there should be a 400ms delay between each frame. it should also loop
-            if media_extension == ".mp4":
-                # Convert PIL Images to Numpy arrays
-                np_images = [np.array(img) for img in images]
-
-                # Save as MP4
-                imageio.mimwrite(temp_out_filename, np_images, fps=3)
-            else:
-                imageio.mimsave(temp_out_filename, images, duration=250, loop=0)
-
-            # if smooth_interolate is True us ffmpeg and minterpolate to smooth the gif
-            # use fps of 20
-            if smooth_interpolation:
-                # create temp filename for the smoothed gif
-                smoothed_gif_temp_filename = f"/tmp/out-{uuid.uuid4()}{media_extension}"
-
-                command = f"ffmpeg -y -i {temp_out_filename} -filter:v minterpolate='mi_mode=mci:mc_mode=aobmc:vsbmc=1:fps=20' {smoothed_gif_temp_filename}"
-                # use os.system to run the command
-                os.system(command)
-
-                temp_out_filename = smoothed_gif_temp_filename
-
+            animation.close()
 
             if disable_rotate:
                 rotated_media = temp_out_filename
@@ -1410,47 +1347,7 @@ class Predictor(BasePredictor):
         return output_paths
 
 
-def slerp(t, v0, v1, DOT_THRESHOLD=0.9995):
-    '''
-    Spherical linear interpolation
-    Args:
-        t (float/np.ndarray): Float value between 0.0 and 1.0
-        v0 (np.ndarray): Starting vector
-        v1 (np.ndarray): Final vector
-        DOT_THRESHOLD (float): Threshold for considering the two vectors as
-                               colineal. Not recommended to alter this.
-    Returns:
-        v2 (np.ndarray): Interpolation vector between v0 and v1
-    '''
-    c = False
-    if not isinstance(v0,np.ndarray):
-        c = True
-        v0 = v0.detach().cpu().numpy()
-    if not isinstance(v1,np.ndarray):
-        c = True
-        v1 = v1.detach().cpu().numpy()
-    # Copy the vectors to reuse them later
-    v0_copy = np.copy(v0)
-    v1_copy = np.copy(v1)
-    # Normalize the vectors to get the directions and angles
-    v0 = v0 / np.linalg.norm(v0)
-    v1 = v1 / np.linalg.norm(v1)
-    # Dot product with the normalized vectors (can't use np.dot in W)
-    dot = np.sum(v0 * v1)
-    theta_0 = np.arccos(dot)
-    sin_theta_0 = np.sin(theta_0)
-    # Angle at timestep t
-    theta_t = theta_0 * t
-    sin_theta_t = np.sin(theta_t)
-    # Finish the slerp algorithm
-    s0 = np.sin(theta_0 - theta_t) / sin_theta_0
-    s1 = sin_theta_t / sin_theta_0
-    v2 = s0 * v0_copy + s1 * v1_copy
-    if c:
-        res = torch.from_numpy(v2).to("cuda")
-    else:
-        res = v2
-    return res# Prediction interface for Cog ⚙️
+# Prediction interface for Cog ⚙️
 # https://github.com/replicate/cog/blob/main/docs/python.md
 
 from cog import BasePredictor, Input, Path, BaseModel, File
@@ -3061,7 +2958,6 @@ from contextlib import contextmanager, nullcontext
 from glob import glob
 from time import time
 
-import librosa
 import numpy as np
 import torch
 from cog import BasePredictor, Input, Path
@@ -3081,18 +2977,17 @@ from torch import autocast
 #from tqdm.auto import tqdm, trange  # NOTE: updated for notebook
 from tqdm import tqdm, trange  # NOTE: updated for notebook
 from typing import Iterator
+from conditioning_cache import from_env as conditioning_cache_from_env, split_batch
+from trajectory import keyframe_path, slerp_path
+from audio_features import from_env as audio_features_from_env, noise_schedule
+from animation_writer import AnimationWriter
 
+# CLIP conditioning per prompt, reused across predictions with the same prompts
+conditioning_cache = conditioning_cache_from_env()
 
-def get_amplitude_envelope(signal, hop_length):
-    """Calculate the amplitude envelope of a signal with a given frame size nad hop length."""
-    amplitude_envelope = []
-    
-    # calculate amplitude envelope for each frame
-    for i in range(0, len(signal), hop_length): 
-        amplitude_envelope_current_frame = max(np.abs(signal[i:i+hop_length]) )
-        amplitude_envelope.append(amplitude_envelope_current_frame)
-    
-    return np.array(amplitude_envelope)  
+
+# Audio envelopes per track and analysis parameters, reused across predictions
+audio_features = audio_features_from_env()
 
 class Predictor(BasePredictor):
 
@@ -3201,6 +3096,9 @@ Two fishes talking to eachother in deep sea, art by hieronymus bosch"""),
         
         options['scale'] = prompt_scale
         options['seed'] = random_seed
+        # the latents are 1/f the size of the image, so frames decode at multiples of f.
+        # snap here so the video writer is sized like the frames it gets
+        width, height = width - width % options.f, height - height % options.f
         options['H'] = height
         options['W'] = width
         options['steps'] = diffusion_steps
@@ -3208,24 +3106,15 @@ Two fishes talking to eachother in deep sea, art by hieronymus bosch"""),
         options['init_image_strength'] = init_image_strength
         options['audio_smoothing'] = audio_smoothing
        
-        y, sr = librosa.load(audio_file, sr=22050)
         print("using audio file", audio_file)
         # calculate hop length based on frame rate
-        hop_length = int(22050 / frame_rate)
-        print("hop length", hop_length, "audio length", len(y), "audio sr", sr)
-        
-        if audio_loudness_type == "peak":
-            # get amplitude envelope
-            amplitude_envelope = get_amplitude_envelope(y, hop_length)
-            # normalize
-            options["audio_intensities"] = amplitude_envelope / amplitude_envelope.max()
-        else:
-            # get rms
-            rms = librosa.feature.rms(y=y, frame_length=2048, hop_length=hop_length)
-            # get amplitude envelope
+        hop_length = int(audio_features.sample_rate / frame_rate)
+        print("hop length", hop_length, "audio sr", audio_features.sample_rate)
 
-            # normalize
-            options["audio_intensities"] = rms[0] / rms[0].max()
+        # peak or rms envelope, one value per video frame; the audio is decoded in chunks
+        loudness = audio_features.envelope(str(audio_file), hop_length, kind=audio_loudness_type)
+        # normalize
+        options["audio_intensities"] = loudness / max(loudness.max(), 1e-8)
 
         print("length of audio intensities", len(options["audio_intensities"]))
         audio_length = len(options["audio_intensities"])
@@ -3236,42 +3125,38 @@ Two fishes talking to eachother in deep sea, art by hieronymus bosch"""),
         print("num frames per prompt", num_frames_per_prompt)
         options['num_interpolation_steps'] = num_frames_per_prompt
 
-        precision_scope = autocast if options.precision=="autocast" else nullcontext
-        with precision_scope("cuda"):
-            for image_path in run_inference(options, self.model, self.model_wrap, self.device):
-                yield Path(image_path)
-
-
+        # frames are piped to ffmpeg while the next batches diffuse. the audio is muxed and the
+        # optional 60 fps version is interpolated in the same process
+        video = AnimationWriter(
+            "/tmp/z_interpollation.mp4",
+            width,
+            height,
+            fps=frame_rate,
+            max_queued=2 * batch_size,
+            audio_path=str(audio_file) if audio_file is not None else None,
+            interpolated_path="/tmp/z_interpollation_60fps.mp4" if frame_interpolation else None,
+            interpolated_fps=60,
+            video_args=["-c:v", "libx264", "-crf", "20", "-preset", "slow", "-pix_fmt", "yuv420p", "-movflags", "+faststart"],
+        )
 
-        #if num_frames_per_prompt == 1:
-        #    return Path(options['output_path'])     
-        encoding_options = "-c:v libx264 -crf 20 -preset slow -vf format=yuv420p -c:a aac -movflags +faststart"
-        os.system("ls -l ./outputs")
+        precision_scope = autocast if options.precision=="autocast" else nullcontext
+        try:
+            with precision_scope("cuda"):
+                for image_path in run_inference(options, self.model, self.model_wrap, self.device, video):
+                    yield Path(image_path)
+        except BaseException:
+            video.abort()
+            raise
 
-        # calculate the frame rate of the video so that the length is always 8 seconds
-        
         os.system("nvidia-smi")
 
-        end_time = time()
-        audio_options = ""
-        if audio_file is not None:
-            audio_options = f"-i {audio_file} -map 0:v -map 1:a -shortest"
-        
-
-        print("total time", end_time - start_time)
-        
-        os.system(f'ffmpeg -y -r {frame_rate} -i {options["outdir"]}/%*.png  {audio_options} {encoding_options} /tmp/z_interpollation.mp4')
-
-
-
-
-        # print(f'ffmpeg -y -r {frame_rate} -i {options["outdir"]}/%*.png {audio_options} ${frame_interpolation_flag} {encoding_options} /tmp/z_interpollation.mp4')
+        print("diffusion time", time() - start_time)
+        video.close()
+        print("total time", time() - start_time)
 
         yield Path("/tmp/z_interpollation.mp4")
 
         if frame_interpolation:
-            # convert previously generated video to 54 fps
-            os.system(f'ffmpeg -y -i /tmp/z_interpollation.mp4 -filter:v "minterpolate=\'fps=60\'" {encoding_options} /tmp/z_interpollation_60fps.mp4')
             yield Path("/tmp/z_interpollation_60fps.mp4")
 
 
@@ -3289,43 +3174,11 @@ def load_model(opt,device):
     
     return model
 
-def slerp(t, v0, v1, DOT_THRESHOLD=0.9995, nonlinear=False):
-    """ helper function to spherically interpolate two arrays v1 v2 """
-
-
-    if nonlinear:
-        # a smooth function that goes from 0 to 1 but grows quickly and then slows down
-        t = 1 - math.exp(-t * 8)
-    
-    if not isinstance(v0, np.ndarray):
-        inputs_are_torch = True
-        input_device = v0.device
-        v0 = v0.cpu().numpy()
-        v1 = v1.cpu().numpy()
-
-    dot = np.sum(v0 * v1 / (np.linalg.norm(v0) * np.linalg.norm(v1)))
-    if np.abs(dot) > DOT_THRESHOLD:
-        v2 = (1 - t) * v0 + t * v1
-    else:
-        theta_0 = np.arccos(dot)
-        sin_theta_0 = np.sin(theta_0)
-        theta_t = theta_0 * t
-        sin_theta_t = np.sin(theta_t)
-        s0 = np.sin(theta_0 - theta_t) / sin_theta_0
-        s1 = sin_theta_t / sin_theta_0
-        v2 = s0 * v0 + s1 * v1
-
-    if inputs_are_torch:
-        v2 = torch.from_numpy(v2).to(input_device)
-
-    return v2
-
-
-
-def run_inference(opt, model, model_wrap, device):
+def run_inference(opt, model, model_wrap, device, video):
     """Seperates the loading of the model from the inference
     
-    Additionally, slightly modified to display generated images inline
+    Additionally, slightly modified to display generated images inline.
+    Every frame is written to `video`; only the last frame of each batch is saved, as a preview
     """
     seed_everything(opt.seed)
 
@@ -3350,7 +3203,9 @@ def run_inference(opt, model, model_wrap, device):
     print("embedding prompts")
     precision_scope = autocast if opt.precision=="autocast" else nullcontext
     with precision_scope("cuda"):
-        datas =[model.get_learned_conditioning(prompt) for prompt in prompts]
+        datas = conditioning_cache.get_many(
+            opt.ckpt, prompts,
+            lambda missing: split_batch(model.get_learned_conditioning(missing), len(missing)))
 
     print("prompt 0 shape", datas[0].shape)
 
@@ -3367,18 +3222,13 @@ def run_inference(opt, model, model_wrap, device):
     start_code_a = torch.randn([1, opt.C, opt.H // opt.f, opt.W // opt.f], device=device)
     start_code_b = torch.randn([1, opt.C, opt.H // opt.f, opt.W // opt.f], device=device)
     
-    start_codes = []
-    smoothed_intensity = 0      
-    for audio_intensity in opt.audio_intensities:
-        smoothed_intensity =  (smoothed_intensity * (opt.audio_smoothing)) + (audio_intensity * (1-opt.audio_smoothing))
-        noise_t = smoothed_intensity * opt.audio_noise_scale
-        start_code = slerp(float(noise_t), start_code_a, start_code_b)
-        start_codes.append(start_code)
+    # smoothed audio intensities move the start code from start_code_a towards start_code_b
+    noise_ts = noise_schedule(opt.audio_intensities, opt.audio_smoothing, opt.audio_noise_scale)
 
+    # start codes and conditionings are built per batch on the GPU from these paths
+    start_codes = slerp_path(noise_ts, start_code_a, start_code_b)
 
-    interpolated_prompts = []
-    for data_a,data_b in zip(datas,datas[1:]):         
-        interpolated_prompts = interpolated_prompts + [slerp(float(t), data_a, data_b, nonlinear=True) for t in np.linspace(0, 1, opt.num_interpolation_steps)]
+    interpolated_prompts = keyframe_path(datas, opt.num_interpolation_steps, nonlinear=True)
 
     print("len smoothed_audio_intensities",len(start_codes), "len interpolated_prompts",len(interpolated_prompts))
 
@@ -3389,26 +3239,21 @@ def run_inference(opt, model, model_wrap, device):
         with model.ema_scope():
             # chunk interpolated_prompts into batches
             for i in range(0, len(interpolated_prompts), batch_size):
-                data_batch = torch.cat(interpolated_prompts[i:i+batch_size])
-                start_code_batch = torch.cat(start_codes[i:i+batch_size])
+                data_batch = interpolated_prompts.cat(i, i+batch_size)
+                start_code_batch = start_codes.cat(i, i+batch_size)
 
                 print("data_batch",data_batch.shape, "start_code_batch",start_code_batch.shape)
                 images = diffuse(start_code_batch, data_batch, len(data_batch), opt, model, model_wrap, device)
                 
 
-                for i2, image in enumerate(images):
-                    image_path = os.path.join(outpath, f"{i+i2:05}.png")
-                    image.save(image_path)
-                    print(f"Saved {image_path}")
-
-                    if i2 == len(images)-1:
-                        yield image_path
-
+                for image in images:
+                    video.write(image)
 
-
-
-    print(f"Your samples have been saved to: \n{outpath} \n"
-          f" \nEnjoy.")
+                if images:
+                    image_path = os.path.join(outpath, f"{i+len(images)-1:05}.png")
+                    images[-1].save(image_path)
+                    print(f"Saved preview {image_path}")
+                    yield image_path
 
 
 
@@ -3419,7 +3264,9 @@ def diffuse(start_code, c, batch_size, opt, model, model_wrap,  device):
         #print("diffusing with batch size", batch_size)
         uc = None
         if opt.scale != 1.0:
-            uc = model.get_learned_conditioning(batch_size * [""])
+            # The unconditional embedding is the same for every batch, encode it once
+            uc = conditioning_cache.pin(opt.ckpt, "", lambda prompt: model.get_learned_conditioning([prompt]))
+            uc = uc.expand(batch_size, -1, -1)
         try:
             samples = sampler_fn(
                 c=c,
@@ -3495,12 +3342,16 @@ import mimetypes
 from cog import BasePredictor, Input, Path
 
 from handfix.handfix import (detect_and_crop_hand_from_binary, insert_cropped_hand_into_image)
+from model_cache import from_env as model_cache_from_env
 
 mimetypes.add_type("image/webp", ".webp")
 
 # Fixing the "DecompressionBombWarning" warning
 Image.MAX_IMAGE_PIXELS = None
 
+# Lora and checkpoint downloads are kept on disk across predictions
+model_cache = model_cache_from_env()
+
 class Predictor(BasePredictor):
     def setup(self) -> None:
         """Load the model into memory to make running multiple predictions efficient"""
@@ -3620,28 +3471,17 @@ class Predictor(BasePredictor):
         if "civitai.com" in parsed_url.netloc:
             filename = f"{os.path.basename(parsed_url.path)}.safetensors"
 
-        os.makedirs(folder_path, exist_ok=True)
-
-        file_path = os.path.join(folder_path, filename)
-
-        response = requests.get(url)
-        response.raise_for_status()
-
-        with open(file_path, "wb") as file:
-            file.write(response.content)
+        # The webui finds loras by name in its folder, so link the cached file there
+        file_path = model_cache.link_into(model_cache.fetch(url), folder_path, filename)
 
         print("Lora saved under:", file_path)
         return file_path
 
     def download_safetensors(self, url: str):
         start_time_custom = time.time()
-        safetensors_path = f"models/Stable-diffusion/custom-{uuid.uuid1()}.safetensors"
-
-        response = requests.get(url)
-        response.raise_for_status()
-
-        with open(safetensors_path, "wb") as file:
-            file.write(response.content)
+        cached_path = model_cache.fetch(url, suffix=".safetensors")
+        # Named after the content, so the same checkpoint keeps the same name across predictions
+        safetensors_path = model_cache.link_into(cached_path, "models/Stable-diffusion", f"custom-{os.path.basename(cached_path)}")
 
         print(f"Checkpoint downloading took {round(time.time() - start_time_custom, 2)} seconds")
 
@@ -6703,11 +6543,12 @@ class RTDETRPredictor(BasePredictor):
 import os
 import time
 import torch
-from transformers import T5Tokenizer, T5ForConditionalGeneration
-from flask import Flask, request, jsonify
+from transformers import T5Tokenizer
+from flask import Flask, Response, request, jsonify
 from diffusers import (
     DiffusionPipeline,
     AutoencoderTiny,
+    UNet2DConditionModel,
     DDIMScheduler,
     EulerAncestralDiscreteScheduler,
     EulerDiscreteScheduler,
@@ -6725,45 +6566,111 @@ from typing import Literal, Dict, Optional
 # from sfast.compilers.diffusion_pipeline_compiler import (compile,
 #                                                          CompilationConfig)
 sys.path.append(os.path.join(os.path.dirname(__file__), "StreamDiffusion"))
+# Modules shared with the FLUX and DMD2 servers
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server_common"))
 
 
 
 from collections import defaultdict
-from performance_metrics import add_timestamp, get_average_generation_duration, calculate_throughput, get_timestamps
+from metrics import Metrics
+from startup import LazyImport, LazyLoader, StartupTimeline, from_env as warm_start_from_env
+from warmup import from_env as warmup_from_env
 import uuid
 import threading
 from transformers import T5EncoderModel
 import re
-from safety_checker.censor import check_safety
+from safety_checker.censor import check_safety, safety_cache
+from pipeline_registry import from_env as pipeline_registry_from_env
+from gpu_queue import DeadlineExceeded, GPUWorkQueue
+from concurrent.futures import TimeoutError as FutureTimeoutError
 
 import torch.nn as nn
 from os.path import expanduser  # pylint: disable=import-outside-toplevel
 from urllib.request import urlretrieve  # pylint: disable=import-outside-toplevel
 
-tinyAutoencoder = AutoencoderTiny.from_pretrained("madebyollin/taesdxl", torch_dtype=torch.float16)
+# Heavy optional modules are imported on first use
+T5ForConditionalGeneration = LazyImport("transformers", "T5ForConditionalGeneration")
+clip = LazyImport("clip")
 
-tokenizer = T5Tokenizer.from_pretrained("google/flan-t5-small")
-pimper_model = T5ForConditionalGeneration.from_pretrained("roborovski/superprompt-v1", device_map="auto")
+timeline = StartupTimeline("sdxl")
+# UNets with fused LoRAs are saved on the first start and memory-mapped on later ones
+warm_start = warm_start_from_env()
+
+prompt_pimper = LazyLoader("prompt_pimper", lambda: (
+    T5Tokenizer.from_pretrained("google/flan-t5-small"),
+    T5ForConditionalGeneration.from_pretrained("roborovski/superprompt-v1", device_map="auto"),
+), timeline)
 
 # Flask App Initialization
 app = Flask(__name__)
 
-# create lock
-lock = threading.Lock()
+# Stage latencies, throughput, GPU utilization and cache stats, served on /metrics
+metrics = Metrics("sdxl")
+metrics.add_cache("safety", safety_cache.stats)
+
+# Requests wait at most this long for the GPU before being dropped
+GPU_QUEUE_TIMEOUT = float(os.getenv("GPU_QUEUE_TIMEOUT", "120"))
+# How long a request waits for its images in total, queueing and rendering
+GPU_RESULT_TIMEOUT = float(os.getenv("GPU_RESULT_TIMEOUT", str(GPU_QUEUE_TIMEOUT + 120)))
+
+# Pipelines are built on first use; idle UNets are offloaded to CPU under a GPU budget
+pipelines = pipeline_registry_from_env(default="turbo")
+
+# Sizes and batch sizes rendered once before serving; TORCH_COMPILE compiles each UNet per bucket
+warmup = warmup_from_env("1024x1024x1,1024x1024x4,768x768x1")
+
+def shared_base_components(base_model_id: str, **overrides) -> Dict:
+    """VAE, text encoders and tokenizers of a base model, loaded once for every pipeline built on it.
+
+    `overrides` replace components instead of loading them, and are part of the key, so pipelines
+    built with and without them don't share components. Pass shared instances, which are keyed by identity.
+    """
+    def load():
+        base = DiffusionPipeline.from_pretrained(base_model_id, torch_dtype=torch.float16, variant="fp16", unet=None, **overrides)
+        return {name: component.to("cuda") if isinstance(component, nn.Module) else component
+                for name, component in base.components.items() if name not in ("unet", "scheduler")}
+    key = ("base", base_model_id, tuple(sorted((name, id(component)) for name, component in overrides.items())))
+    return pipelines.shared(key, load)
+
+def shared_tiny_autoencoder() -> AutoencoderTiny:
+    return pipelines.shared("taesdxl", lambda: AutoencoderTiny.from_pretrained("madebyollin/taesdxl", torch_dtype=torch.float16).to("cuda"))
+
+def fuse_unet_lora(pipe: DiffusionPipeline, lora_path: str):
+    # Only the UNet is fused, the text encoders are shared with other pipelines
+    pipe.load_lora_weights(lora_path)
+    pipe.fuse_lora(components=["unet"])
+    pipe.unload_lora_weights()
+
+def fused_unet(name: str, base_model_id: str, lora: str, lora_path) -> UNet2DConditionModel:
+    """UNet of `base_model_id` with `lora` fused in, from the warm-start snapshot once one exists.
+
+    `lora_path()` returns what `load_lora_weights` takes; it's only called when the snapshot is built.
+    """
+    def build():
+        pipe = DiffusionPipeline.from_pretrained(base_model_id, torch_dtype=torch.float16, variant="fp16", **shared_base_components(base_model_id)).to("cuda")
+        fuse_unet_lora(pipe, lora_path())
+        return pipe.unet
+    return warm_start.load_or_build(
+        name,
+        build,
+        load=lambda path: UNet2DConditionModel.from_pretrained(path, torch_dtype=torch.float16).to("cuda"),
+        model=base_model_id,
+        lora=lora,
+        dtype="float16",
+    )
 
-def get_boltning_pipe() -> DiffusionPipeline:
+def get_boltning_pipe(steps: int = 4) -> DiffusionPipeline:
+    components = shared_base_components("./boltning_diffusers", vae=shared_tiny_autoencoder())
     pipe = DiffusionPipeline.from_pretrained(
         "./boltning_diffusers", 
         torch_dtype=torch.float16, 
-        variant="fp16"
+        variant="fp16",
+        **components
     ).to("cuda")
-    pipe.vae = AutoencoderTiny.from_pretrained("madebyollin/taesdxl").to(
-        device=pipe.device, dtype=pipe.dtype
-    )
     pipe.scheduler = EulerAncestralDiscreteScheduler.from_config(pipe.scheduler.config, timestep_spacing="trailing")
     # pipe.scheduler = DPMSolverSDEScheduler.from_config(pipe.scheduler.config, timestep_spacing="trailing")
 
-    # pipe.unet = torch.compile(pipe.unet, mode="reduce-overhead", fullgraph=True)
+    pipe.unet = warmup.compile(pipe.unet)
     return pipe
 
 def get_lightning_pipe(steps:int = 4) -> DiffusionPipeline:
@@ -6775,14 +6682,13 @@ def get_lightning_pipe(steps:int = 4) -> DiffusionPipeline:
     
     ckpt_name = f"sdxl_lightning_{steps}step_lora.safetensors" # Use the correct ckpt for your step setting!
     repo_name = "ByteDance/SDXL-Lightning"
-    pipe = DiffusionPipeline.from_pretrained(base_model_id, torch_dtype=torch.float16, variant="fp16").to("cuda")
-    pipe.load_lora_weights(hf_hub_download(repo_name, ckpt_name))
-    pipe.fuse_lora()
+    unet = fused_unet(f"lightning-{steps}", base_model_id, f"{repo_name}/{ckpt_name}", lambda: hf_hub_download(repo_name, ckpt_name))
+    pipe = DiffusionPipeline.from_pretrained(base_model_id, torch_dtype=torch.float16, variant="fp16", unet=unet, **shared_base_components(base_model_id)).to("cuda")
     # pipe.scheduler = EulerDiscreteScheduler.from_config(pipe.scheduler.config, timestep_spacing="trailing")
     # try DPMSolverSDEScheduler
     pipe.scheduler = DPMSolverSDEScheduler.from_config(pipe.scheduler.config)
     # pipe.scheduler = DDIMScheduler.from_config(pipe.scheduler.config, timestep_spacing="trailing")
-    # pipe.unet = torch.compile(pipe.unet, mode="reduce-overhead", fullgraph=True)
+    pipe.unet = warmup.compile(pipe.unet)
 
     # # Load resadapter for baseline
     # resadapter_model_name = "resadapter_v2_sdxl"
@@ -6807,14 +6713,13 @@ def get_hyper_pipe(steps:int = 4) -> DiffusionPipeline:
     
     # ckpt_name = f"sdxl_lightning_{steps}step_lora.safetensors" # Use the correct ckpt for your step setting!
     # repo_name = "ByteDance/SDXL-Lightning"
-    pipe = DiffusionPipeline.from_pretrained(base_model_id, torch_dtype=torch.float16, variant="fp16").to("cuda")
-    pipe.load_lora_weights(hf_hub_download(repo_name, ckpt_name))
-    pipe.fuse_lora()
+    unet = fused_unet(f"hyper-{steps}", base_model_id, f"{repo_name}/{ckpt_name}", lambda: hf_hub_download(repo_name, ckpt_name))
+    pipe = DiffusionPipeline.from_pretrained(base_model_id, torch_dtype=torch.float16, variant="fp16", unet=unet, **shared_base_components(base_model_id)).to("cuda")
     # pipe.scheduler = EulerDiscreteScheduler.from_config(pipe.scheduler.config, timestep_spacing="trailing")
     # try DPMSolverSDEScheduler
     # pipe.scheduler = DPMSolverSDEScheduler.from_config(pipe.scheduler.config)
     pipe.scheduler = DDIMScheduler.from_config(pipe.scheduler.config, timestep_spacing="trailing")
-    # pipe.unet = torch.compile(pipe.unet, mode="reduce-overhead", fullgraph=True)
+    pipe.unet = warmup.compile(pipe.unet)
 
     # # Load resadapter for baseline
     # resadapter_model_name = "resadapter_v2_sdxl"
@@ -6836,27 +6741,70 @@ def get_tcd_pipe(steps: int = 4) -> DiffusionPipeline:
     base_model_id = "./zavychromaxl7"
     tcd_lora_id = "h1t/TCD-SDXL-LoRA"
     
-    pipe = StableDiffusionXLPipeline.from_pretrained(base_model_id, torch_dtype=torch.float16, variant="fp16").to(device)
+    unet = fused_unet("tcd", base_model_id, tcd_lora_id, lambda: tcd_lora_id)
+    pipe = StableDiffusionXLPipeline.from_pretrained(base_model_id, torch_dtype=torch.float16, variant="fp16", unet=unet, **shared_base_components(base_model_id)).to(device)
     pipe.scheduler = TCDScheduler.from_config(pipe.scheduler.config)
-    
-    pipe.load_lora_weights(tcd_lora_id)
-    pipe.fuse_lora()
-    # pipe.unet = torch.compile(pipe.unet, mode="reduce-overhead", fullgraph=True)
+    pipe.unet = warmup.compile(pipe.unet)
     
     return pipe
 
 # override_steps = 2
 
-# Initialize the default pipe
-# pipe_hyper = get_hyper_pipe(2)
-
-# pipe_lightning = get_lightning_pipe(4)
+# Lightning and Hyper-SD ship one LoRA per step count, TCD and boltning work at any
+pipelines.register("boltning", get_boltning_pipe)
+pipelines.register("lightning", get_lightning_pipe, steps=(2, 4, 8))
+pipelines.register("hyper", get_hyper_pipe, steps=(1, 2, 4, 8))
+pipelines.register("tcd", get_tcd_pipe)
+pipelines.alias("turbo", "lightning")
 
 # apply_hidiffusion(pipe)
-pipe_boltning = get_lightning_pipe(4)
+# Load the default pipeline up front so the first request doesn't pay for it
+with timeline.phase("turbo"):
+    pipelines.get("turbo", 4)
+
+def render_warmup(width, height, batch_size):
+    pipe, steps = pipelines.get("turbo", 4)
+    pipe(["warmup"] * batch_size, num_inference_steps=steps, guidance_scale=1.0, width=width, height=height)
+
+warmup.run(render_warmup, timeline)
+timeline.report()
 
 # apply_deepcache(pipe)
 
+def run_gpu_batch(key, prompts):
+    """Render prompts merged from one or more requests with the same model and size.
+
+    Runs on the GPU worker thread; returns (image, concept, has_nsfw, steps, seconds) per prompt.
+    """
+    model, width, height, steps = key
+    print("running on prompts", prompts)
+    predict_start_time = time.time()
+    try:
+        # The step count is snapped to one the model has a pipeline for
+        pipe, steps = pipelines.get(model, steps)
+        with metrics.gpu(torch.cuda.synchronize) as timer:
+            # Encoding the prompts separately lets text encoding be timed apart from denoising
+            prompt_embeds, _, pooled_prompt_embeds, _ = pipe.encode_prompt(prompts, device="cuda", do_classifier_free_guidance=False)
+            timer.mark("text_encode")
+            batch_results = pipe(prompt_embeds=prompt_embeds, pooled_prompt_embeds=pooled_prompt_embeds, num_inference_steps=steps, guidance_scale=1.0, width=width, height=height, callback_on_step_end=timer.step_end).images
+            timer.mark("vae_decode")
+    except Exception as e:
+        print("Exception occurred:", e)
+        import traceback
+        traceback.print_exc()
+        os._exit(1)
+
+    with metrics.timer("safety"):
+        concepts, has_nsfw_concepts = check_safety(batch_results, 0.0)
+    metrics.count_images(len(batch_results))
+    # Each prompt is charged its share of the batch
+    seconds = (time.time() - predict_start_time) / len(prompts)
+    return [(image, concept, has_nsfw, steps, seconds)
+            for image, concept, has_nsfw in zip(batch_results, concepts, has_nsfw_concepts)]
+
+# One GPU worker thread serves every request thread, merging their prompts into batches
+gpu_queue = GPUWorkQueue(run_gpu_batch, max_batch_size=16, metrics=metrics)
+
 
 class Predictor:
     def __init__(self):
@@ -6887,55 +6835,34 @@ class Predictor:
 
         print(f"Running batch with model: {model}, width: {width}, height: {height}, number of prompts: {len(prompts)}, steps: {steps}")
 
-        max_batch_size = 16
-
-        model = "turbo"
-
         print("params:", model, width, height, steps, prompts, refine, negative_prompt)
+        # Lower values are served first
+        priority = data.get("priority", 0)
+        futures = gpu_queue.submit((model, width, height, steps), prompts, priority=priority, timeout=GPU_QUEUE_TIMEOUT)
+        try:
+            deadline = time.monotonic() + GPU_RESULT_TIMEOUT
+            outputs = [future.result(timeout=max(0, deadline - time.monotonic())) for future in futures]
+        finally:
+            # If any prompt failed the request is lost, don't render the rest
+            for future in futures:
+                future.cancel()
+
         predict_duration = 0
-        for i in range(0, len(prompts), max_batch_size):
-            chunked_prompts = prompts[i:i + max_batch_size]
-            original_prompt = chunked_prompts[0]
-            chunked_prompts[0] = original_prompt
-            print("running on prompts", chunked_prompts, "original", original_prompt)
-            with lock:
-                predict_start_time = time.time()
-                try:
-                    #batch_results = []
-                    # for prompt in chunked_prompts:
-                    # steps = override_steps
-                    if steps < 4:
-                        steps = 2
-                    else:
-                        steps = 4
-                    pipe = pipe_boltning # ipe_hyper if steps == 2 else pipe_lightning
-                    batch_results = pipe(chunked_prompts, num_inference_steps=4, guidance_scale=1.0, width=width, height=height).images
-                    # batch_results.append(image)
-
-                except Exception as e:
-                    print("Exception occurred:", e)
-                    import traceback
-                    traceback.print_exc()
-                    os._exit(1)
-
-                concepts, has_nsfw_concepts = check_safety(batch_results, 0.0)
-                predict_end_time = time.time()
-
-                predict_duration += predict_end_time - predict_start_time
-
-            for i, (result_image, prompt) in enumerate(zip(batch_results, chunked_prompts)):
+        for prompt, (result_image, concept, has_nsfw_concept, steps, seconds) in zip(prompts, outputs):
+            predict_duration += seconds
+            with metrics.timer("encode"):
                 output_path = self._save_result(result_image)
-                results.append({
-                    "output_path": output_path,
-                    "model": model,
-                    "width": width,
-                    "height": height,
-                    "steps": steps,
-                    "prompt": prompt,
-                    "has_nsfw_concept": has_nsfw_concepts[i],
-                    "concept": concepts[i]
-                })
-                print(f"Saved result for model: {model}, output path: {output_path}")
+            results.append({
+                "output_path": output_path,
+                "model": model,
+                "width": width,
+                "height": height,
+                "steps": steps,
+                "prompt": prompt,
+                "has_nsfw_concept": has_nsfw_concept,
+                "concept": concept
+            })
+            print(f"Saved result for model: {model}, output path: {output_path}")
 
         return results, predict_duration
 
@@ -6952,20 +6879,13 @@ class Predictor:
 
         params["width"] -= params["width"] % 8
         params["height"] -= params["height"] % 8
+        # Sizes close to a warmed bucket render at it
+        params["width"], params["height"] = warmup.snap(params["width"], params["height"])
 
         params["model"] = data.get("model", default_params["model"])
         print(f"Validated parameters: width: {params['width']}, height: {params['height']}, steps: {params['steps']}, seed: {params['seed']}, model: {params['model']}")
         return params
 
-    def _log_performance_metrics(self, start_time, end_time):
-        add_timestamp(start_time, end_time)
-        average_duration = get_average_generation_duration()
-        generation_speed = calculate_throughput(start_time, end_time)
-
-        print(f"Average Generation Duration: {average_duration} seconds per image")
-        print(f"Current Throughput: {generation_speed} images per second")
-        print(f"Images Generated in Last 60 Seconds: {len(get_timestamps())}")
-
     def _save_result(self, result):
         print("Saving result image...")
 
@@ -6980,32 +6900,37 @@ class Predictor:
 predictor = Predictor()
 
 import time
-total_start_time = time.time()
-accumulated_predict_duration = 0
 
 @app.route('/predict', methods=['POST'])
 def predict_endpoint():
-    global accumulated_predict_duration
-
     data = request.json
     validated_params = predictor._validate_params(data)
     data.update(validated_params)
+    try:
+        data["priority"] = int(data.get("priority", 0))
+    except (TypeError, ValueError):
+        return jsonify({"error": "priority must be an integer"}), 400
 
-    response, predict_duration = predictor.predict_batch(data)
-
-    accumulated_predict_duration += predict_duration
-
-    total_time = time.time() - total_start_time
+    try:
+        response, predict_duration = predictor.predict_batch(data)
+    except (DeadlineExceeded, FutureTimeoutError) as e:
+        print(f"Dropping request: {e!r}")
+        return jsonify({"error": "Server busy, retry later"}), 503
 
-    predict_percentage = (accumulated_predict_duration / total_time) * 100
-    print(f"Predict time percentage: {predict_percentage}%")
+    print(f"Predict duration: {predict_duration:.2f} seconds, GPU utilization over the last minute: {metrics.gpu_utilization() * 100:.2f}%")
 
     print("Returning response for one request.")
     return jsonify(response)
 
-import clip
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    body, content_type = metrics.export(request.args.get("format"))
+    return Response(body, content_type=content_type)
+
 device = "cuda" if torch.cuda.is_available() else "cpu"
-clip_model, _ = clip.load("ViT-L/14", device=device)
+# CLIP is only needed for /embeddings; it loads in the background once the predictor is ready
+clip_loader = LazyLoader("clip", lambda: clip.load("ViT-L/14", device=device)[0], timeline)
+clip_loader.prefetch()
 
 @app.route('/embeddings', methods=['POST'])
 def embeddings_endpoint():
@@ -7017,6 +6942,7 @@ def embeddings_endpoint():
     start_time = time.time()
 
     aesthetics_scores = []
+    clip_model = clip_loader.get()
     token = clip.tokenize(prompts, truncate=True).to(device)
     with torch.no_grad():
         embeddings = clip_model.encode_text(token)
@@ -7033,6 +6959,7 @@ def embeddings_endpoint():
     })
 
 def prompt_pimping(input_text):
+    tokenizer, pimper_model = prompt_pimper.get()
     output = pimper_model.generate(tokenizer(input_text, return_tensors="pt").input_ids.to("cuda"), max_length=30)
     result_text = tokenizer.decode(output[0])
     return result_text
@@ -7065,11 +6992,12 @@ if __name__ == "__main__":
 import os
 import time
 import torch
-from transformers import T5Tokenizer, T5ForConditionalGeneration
-from flask import Flask, request, jsonify
+from transformers import T5Tokenizer
+from flask import Flask, Response, request, jsonify
 from diffusers import (
     DiffusionPipeline,
     AutoencoderTiny,
+    UNet2DConditionModel,
     DDIMScheduler,
     EulerAncestralDiscreteScheduler,
     EulerDiscreteScheduler,
@@ -7087,45 +7015,111 @@ from typing import Literal, Dict, Optional
 # from sfast.compilers.diffusion_pipeline_compiler import (compile,
 #                                                          CompilationConfig)
 sys.path.append(os.path.join(os.path.dirname(__file__), "StreamDiffusion"))
+# Modules shared with the FLUX and DMD2 servers
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server_common"))
 
 
 
 from collections import defaultdict
-from performance_metrics import add_timestamp, get_average_generation_duration, calculate_throughput, get_timestamps
+from metrics import Metrics
+from startup import LazyImport, LazyLoader, StartupTimeline, from_env as warm_start_from_env
+from warmup import from_env as warmup_from_env
 import uuid
 import threading
 from transformers import T5EncoderModel
 import re
-from safety_checker.censor import check_safety
+from safety_checker.censor import check_safety, safety_cache
+from pipeline_registry import from_env as pipeline_registry_from_env
+from gpu_queue import DeadlineExceeded, GPUWorkQueue
+from concurrent.futures import TimeoutError as FutureTimeoutError
 
 import torch.nn as nn
 from os.path import expanduser  # pylint: disable=import-outside-toplevel
 from urllib.request import urlretrieve  # pylint: disable=import-outside-toplevel
 
-tinyAutoencoder = AutoencoderTiny.from_pretrained("madebyollin/taesdxl", torch_dtype=torch.float16)
+# Heavy optional modules are imported on first use
+T5ForConditionalGeneration = LazyImport("transformers", "T5ForConditionalGeneration")
+clip = LazyImport("clip")
+
+timeline = StartupTimeline("sdxl")
+# UNets with fused LoRAs are saved on the first start and memory-mapped on later ones
+warm_start = warm_start_from_env()
 
-tokenizer = T5Tokenizer.from_pretrained("google/flan-t5-small")
-pimper_model = T5ForConditionalGeneration.from_pretrained("roborovski/superprompt-v1", device_map="auto")
+prompt_pimper = LazyLoader("prompt_pimper", lambda: (
+    T5Tokenizer.from_pretrained("google/flan-t5-small"),
+    T5ForConditionalGeneration.from_pretrained("roborovski/superprompt-v1", device_map="auto"),
+), timeline)
 
 # Flask App Initialization
 app = Flask(__name__)
 
-# create lock
-lock = threading.Lock()
+# Stage latencies, throughput, GPU utilization and cache stats, served on /metrics
+metrics = Metrics("sdxl")
+metrics.add_cache("safety", safety_cache.stats)
+
+# Requests wait at most this long for the GPU before being dropped
+GPU_QUEUE_TIMEOUT = float(os.getenv("GPU_QUEUE_TIMEOUT", "120"))
+# How long a request waits for its images in total, queueing and rendering
+GPU_RESULT_TIMEOUT = float(os.getenv("GPU_RESULT_TIMEOUT", str(GPU_QUEUE_TIMEOUT + 120)))
+
+# Pipelines are built on first use; idle UNets are offloaded to CPU under a GPU budget
+pipelines = pipeline_registry_from_env(default="turbo")
+
+# Sizes and batch sizes rendered once before serving; TORCH_COMPILE compiles each UNet per bucket
+warmup = warmup_from_env("1024x1024x1,1024x1024x4,768x768x1")
+
+def shared_base_components(base_model_id: str, **overrides) -> Dict:
+    """VAE, text encoders and tokenizers of a base model, loaded once for every pipeline built on it.
 
-def get_boltning_pipe() -> DiffusionPipeline:
+    `overrides` replace components instead of loading them, and are part of the key, so pipelines
+    built with and without them don't share components. Pass shared instances, which are keyed by identity.
+    """
+    def load():
+        base = DiffusionPipeline.from_pretrained(base_model_id, torch_dtype=torch.float16, variant="fp16", unet=None, **overrides)
+        return {name: component.to("cuda") if isinstance(component, nn.Module) else component
+                for name, component in base.components.items() if name not in ("unet", "scheduler")}
+    key = ("base", base_model_id, tuple(sorted((name, id(component)) for name, component in overrides.items())))
+    return pipelines.shared(key, load)
+
+def shared_tiny_autoencoder() -> AutoencoderTiny:
+    return pipelines.shared("taesdxl", lambda: AutoencoderTiny.from_pretrained("madebyollin/taesdxl", torch_dtype=torch.float16).to("cuda"))
+
+def fuse_unet_lora(pipe: DiffusionPipeline, lora_path: str):
+    # Only the UNet is fused, the text encoders are shared with other pipelines
+    pipe.load_lora_weights(lora_path)
+    pipe.fuse_lora(components=["unet"])
+    pipe.unload_lora_weights()
+
+def fused_unet(name: str, base_model_id: str, lora: str, lora_path) -> UNet2DConditionModel:
+    """UNet of `base_model_id` with `lora` fused in, from the warm-start snapshot once one exists.
+
+    `lora_path()` returns what `load_lora_weights` takes; it's only called when the snapshot is built.
+    """
+    def build():
+        pipe = DiffusionPipeline.from_pretrained(base_model_id, torch_dtype=torch.float16, variant="fp16", **shared_base_components(base_model_id)).to("cuda")
+        fuse_unet_lora(pipe, lora_path())
+        return pipe.unet
+    return warm_start.load_or_build(
+        name,
+        build,
+        load=lambda path: UNet2DConditionModel.from_pretrained(path, torch_dtype=torch.float16).to("cuda"),
+        model=base_model_id,
+        lora=lora,
+        dtype="float16",
+    )
+
+def get_boltning_pipe(steps: int = 4) -> DiffusionPipeline:
+    components = shared_base_components("./boltning_diffusers", vae=shared_tiny_autoencoder())
     pipe = DiffusionPipeline.from_pretrained(
         "./boltning_diffusers", 
         torch_dtype=torch.float16, 
-        variant="fp16"
+        variant="fp16",
+        **components
     ).to("cuda")
-    pipe.vae = AutoencoderTiny.from_pretrained("madebyollin/taesdxl").to(
-        device=pipe.device, dtype=pipe.dtype
-    )
     pipe.scheduler = EulerAncestralDiscreteScheduler.from_config(pipe.scheduler.config, timestep_spacing="trailing")
     # pipe.scheduler = DPMSolverSDEScheduler.from_config(pipe.scheduler.config, timestep_spacing="trailing")
 
-    # pipe.unet = torch.compile(pipe.unet, mode="reduce-overhead", fullgraph=True)
+    pipe.unet = warmup.compile(pipe.unet)
     return pipe
 
 def get_lightning_pipe(steps:int = 4) -> DiffusionPipeline:
@@ -7137,14 +7131,13 @@ def get_lightning_pipe(steps:int = 4) -> DiffusionPipeline:
     
     ckpt_name = f"sdxl_lightning_{steps}step_lora.safetensors" # Use the correct ckpt for your step setting!
     repo_name = "ByteDance/SDXL-Lightning"
-    pipe = DiffusionPipeline.from_pretrained(base_model_id, torch_dtype=torch.float16, variant="fp16").to("cuda")
-    pipe.load_lora_weights(hf_hub_download(repo_name, ckpt_name))
-    pipe.fuse_lora()
+    unet = fused_unet(f"lightning-{steps}", base_model_id, f"{repo_name}/{ckpt_name}", lambda: hf_hub_download(repo_name, ckpt_name))
+    pipe = DiffusionPipeline.from_pretrained(base_model_id, torch_dtype=torch.float16, variant="fp16", unet=unet, **shared_base_components(base_model_id)).to("cuda")
     # pipe.scheduler = EulerDiscreteScheduler.from_config(pipe.scheduler.config, timestep_spacing="trailing")
     # try DPMSolverSDEScheduler
     pipe.scheduler = DPMSolverSDEScheduler.from_config(pipe.scheduler.config)
     # pipe.scheduler = DDIMScheduler.from_config(pipe.scheduler.config, timestep_spacing="trailing")
-    # pipe.unet = torch.compile(pipe.unet, mode="reduce-overhead", fullgraph=True)
+    pipe.unet = warmup.compile(pipe.unet)
 
     # # Load resadapter for baseline
     # resadapter_model_name = "resadapter_v2_sdxl"
@@ -7169,14 +7162,13 @@ def get_hyper_pipe(steps:int = 4) -> DiffusionPipeline:
     
     # ckpt_name = f"sdxl_lightning_{steps}step_lora.safetensors" # Use the correct ckpt for your step setting!
     # repo_name = "ByteDance/SDXL-Lightning"
-    pipe = DiffusionPipeline.from_pretrained(base_model_id, torch_dtype=torch.float16, variant="fp16").to("cuda")
-    pipe.load_lora_weights(hf_hub_download(repo_name, ckpt_name))
-    pipe.fuse_lora()
+    unet = fused_unet(f"hyper-{steps}", base_model_id, f"{repo_name}/{ckpt_name}", lambda: hf_hub_download(repo_name, ckpt_name))
+    pipe = DiffusionPipeline.from_pretrained(base_model_id, torch_dtype=torch.float16, variant="fp16", unet=unet, **shared_base_components(base_model_id)).to("cuda")
     # pipe.scheduler = EulerDiscreteScheduler.from_config(pipe.scheduler.config, timestep_spacing="trailing")
     # try DPMSolverSDEScheduler
     # pipe.scheduler = DPMSolverSDEScheduler.from_config(pipe.scheduler.config)
     pipe.scheduler = DDIMScheduler.from_config(pipe.scheduler.config, timestep_spacing="trailing")
-    # pipe.unet = torch.compile(pipe.unet, mode="reduce-overhead", fullgraph=True)
+    pipe.unet = warmup.compile(pipe.unet)
 
     # # Load resadapter for baseline
     # resadapter_model_name = "resadapter_v2_sdxl"
@@ -7198,27 +7190,70 @@ def get_tcd_pipe(steps: int = 4) -> DiffusionPipeline:
     base_model_id = "./zavychromaxl7"
     tcd_lora_id = "h1t/TCD-SDXL-LoRA"
     
-    pipe = StableDiffusionXLPipeline.from_pretrained(base_model_id, torch_dtype=torch.float16, variant="fp16").to(device)
+    unet = fused_unet("tcd", base_model_id, tcd_lora_id, lambda: tcd_lora_id)
+    pipe = StableDiffusionXLPipeline.from_pretrained(base_model_id, torch_dtype=torch.float16, variant="fp16", unet=unet, **shared_base_components(base_model_id)).to(device)
     pipe.scheduler = TCDScheduler.from_config(pipe.scheduler.config)
-    
-    pipe.load_lora_weights(tcd_lora_id)
-    pipe.fuse_lora()
-    # pipe.unet = torch.compile(pipe.unet, mode="reduce-overhead", fullgraph=True)
+    pipe.unet = warmup.compile(pipe.unet)
     
     return pipe
 
 # override_steps = 2
 
-# Initialize the default pipe
-# pipe_hyper = get_hyper_pipe(2)
-
-# pipe_lightning = get_lightning_pipe(4)
+# Lightning and Hyper-SD ship one LoRA per step count, TCD and boltning work at any
+pipelines.register("boltning", get_boltning_pipe)
+pipelines.register("lightning", get_lightning_pipe, steps=(2, 4, 8))
+pipelines.register("hyper", get_hyper_pipe, steps=(1, 2, 4, 8))
+pipelines.register("tcd", get_tcd_pipe)
+pipelines.alias("turbo", "lightning")
 
 # apply_hidiffusion(pipe)
-pipe_boltning = get_lightning_pipe(4)
+# Load the default pipeline up front so the first request doesn't pay for it
+with timeline.phase("turbo"):
+    pipelines.get("turbo", 4)
+
+def render_warmup(width, height, batch_size):
+    pipe, steps = pipelines.get("turbo", 4)
+    pipe(["warmup"] * batch_size, num_inference_steps=steps, guidance_scale=1.0, width=width, height=height)
+
+warmup.run(render_warmup, timeline)
+timeline.report()
 
 # apply_deepcache(pipe)
 
+def run_gpu_batch(key, prompts):
+    """Render prompts merged from one or more requests with the same model and size.
+
+    Runs on the GPU worker thread; returns (image, concept, has_nsfw, steps, seconds) per prompt.
+    """
+    model, width, height, steps = key
+    print("running on prompts", prompts)
+    predict_start_time = time.time()
+    try:
+        # The step count is snapped to one the model has a pipeline for
+        pipe, steps = pipelines.get(model, steps)
+        with metrics.gpu(torch.cuda.synchronize) as timer:
+            # Encoding the prompts separately lets text encoding be timed apart from denoising
+            prompt_embeds, _, pooled_prompt_embeds, _ = pipe.encode_prompt(prompts, device="cuda", do_classifier_free_guidance=False)
+            timer.mark("text_encode")
+            batch_results = pipe(prompt_embeds=prompt_embeds, pooled_prompt_embeds=pooled_prompt_embeds, num_inference_steps=steps, guidance_scale=1.0, width=width, height=height, callback_on_step_end=timer.step_end).images
+            timer.mark("vae_decode")
+    except Exception as e:
+        print("Exception occurred:", e)
+        import traceback
+        traceback.print_exc()
+        os._exit(1)
+
+    with metrics.timer("safety"):
+        concepts, has_nsfw_concepts = check_safety(batch_results, 0.0)
+    metrics.count_images(len(batch_results))
+    # Each prompt is charged its share of the batch
+    seconds = (time.time() - predict_start_time) / len(prompts)
+    return [(image, concept, has_nsfw, steps, seconds)
+            for image, concept, has_nsfw in zip(batch_results, concepts, has_nsfw_concepts)]
+
+# One GPU worker thread serves every request thread, merging their prompts into batches
+gpu_queue = GPUWorkQueue(run_gpu_batch, max_batch_size=16, metrics=metrics)
+
 
 class Predictor:
     def __init__(self):
@@ -7249,55 +7284,34 @@ class Predictor:
 
         print(f"Running batch with model: {model}, width: {width}, height: {height}, number of prompts: {len(prompts)}, steps: {steps}")
 
-        max_batch_size = 16
-
-        model = "turbo"
-
         print("params:", model, width, height, steps, prompts, refine, negative_prompt)
+        # Lower values are served first
+        priority = data.get("priority", 0)
+        futures = gpu_queue.submit((model, width, height, steps), prompts, priority=priority, timeout=GPU_QUEUE_TIMEOUT)
+        try:
+            deadline = time.monotonic() + GPU_RESULT_TIMEOUT
+            outputs = [future.result(timeout=max(0, deadline - time.monotonic())) for future in futures]
+        finally:
+            # If any prompt failed the request is lost, don't render the rest
+            for future in futures:
+                future.cancel()
+
         predict_duration = 0
-        for i in range(0, len(prompts), max_batch_size):
-            chunked_prompts = prompts[i:i + max_batch_size]
-            original_prompt = chunked_prompts[0]
-            chunked_prompts[0] = original_prompt
-            print("running on prompts", chunked_prompts, "original", original_prompt)
-            with lock:
-                predict_start_time = time.time()
-                try:
-                    #batch_results = []
-                    # for prompt in chunked_prompts:
-                    # steps = override_steps
-                    if steps < 4:
-                        steps = 2
-                    else:
-                        steps = 4
-                    pipe = pipe_boltning # ipe_hyper if steps == 2 else pipe_lightning
-                    batch_results = pipe(chunked_prompts, num_inference_steps=4, guidance_scale=1.0, width=width, height=height).images
-                    # batch_results.append(image)
-
-                except Exception as e:
-                    print("Exception occurred:", e)
-                    import traceback
-                    traceback.print_exc()
-                    os._exit(1)
-
-                concepts, has_nsfw_concepts = check_safety(batch_results, 0.0)
-                predict_end_time = time.time()
-
-                predict_duration += predict_end_time - predict_start_time
-
-            for i, (result_image, prompt) in enumerate(zip(batch_results, chunked_prompts)):
+        for prompt, (result_image, concept, has_nsfw_concept, steps, seconds) in zip(prompts, outputs):
+            predict_duration += seconds
+            with metrics.timer("encode"):
                 output_path = self._save_result(result_image)
-                results.append({
-                    "output_path": output_path,
-                    "model": model,
-                    "width": width,
-                    "height": height,
-                    "steps": steps,
-                    "prompt": prompt,
-                    "has_nsfw_concept": has_nsfw_concepts[i],
-                    "concept": concepts[i]
-                })
-                print(f"Saved result for model: {model}, output path: {output_path}")
+            results.append({
+                "output_path": output_path,
+                "model": model,
+                "width": width,
+                "height": height,
+                "steps": steps,
+                "prompt": prompt,
+                "has_nsfw_concept": has_nsfw_concept,
+                "concept": concept
+            })
+            print(f"Saved result for model: {model}, output path: {output_path}")
 
         return results, predict_duration
 
@@ -7314,20 +7328,13 @@ class Predictor:
 
         params["width"] -= params["width"] % 8
         params["height"] -= params["height"] % 8
+        # Sizes close to a warmed bucket render at it
+        params["width"], params["height"] = warmup.snap(params["width"], params["height"])
 
         params["model"] = data.get("model", default_params["model"])
         print(f"Validated parameters: width: {params['width']}, height: {params['height']}, steps: {params['steps']}, seed: {params['seed']}, model: {params['model']}")
         return params
 
-    def _log_performance_metrics(self, start_time, end_time):
-        add_timestamp(start_time, end_time)
-        average_duration = get_average_generation_duration()
-        generation_speed = calculate_throughput(start_time, end_time)
-
-        print(f"Average Generation Duration: {average_duration} seconds per image")
-        print(f"Current Throughput: {generation_speed} images per second")
-        print(f"Images Generated in Last 60 Seconds: {len(get_timestamps())}")
-
     def _save_result(self, result):
         print("Saving result image...")
 
@@ -7342,32 +7349,37 @@ class Predictor:
 predictor = Predictor()
 
 import time
-total_start_time = time.time()
-accumulated_predict_duration = 0
 
 @app.route('/predict', methods=['POST'])
 def predict_endpoint():
-    global accumulated_predict_duration
-
     data = request.json
     validated_params = predictor._validate_params(data)
     data.update(validated_params)
+    try:
+        data["priority"] = int(data.get("priority", 0))
+    except (TypeError, ValueError):
+        return jsonify({"error": "priority must be an integer"}), 400
 
-    response, predict_duration = predictor.predict_batch(data)
-
-    accumulated_predict_duration += predict_duration
-
-    total_time = time.time() - total_start_time
+    try:
+        response, predict_duration = predictor.predict_batch(data)
+    except (DeadlineExceeded, FutureTimeoutError) as e:
+        print(f"Dropping request: {e!r}")
+        return jsonify({"error": "Server busy, retry later"}), 503
 
-    predict_percentage = (accumulated_predict_duration / total_time) * 100
-    print(f"Predict time percentage: {predict_percentage}%")
+    print(f"Predict duration: {predict_duration:.2f} seconds, GPU utilization over the last minute: {metrics.gpu_utilization() * 100:.2f}%")
 
     print("Returning response for one request.")
     return jsonify(response)
 
-import clip
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    body, content_type = metrics.export(request.args.get("format"))
+    return Response(body, content_type=content_type)
+
 device = "cuda" if torch.cuda.is_available() else "cpu"
-clip_model, _ = clip.load("ViT-L/14", device=device)
+# CLIP is only needed for /embeddings; it loads in the background once the predictor is ready
+clip_loader = LazyLoader("clip", lambda: clip.load("ViT-L/14", device=device)[0], timeline)
+clip_loader.prefetch()
 
 @app.route('/embeddings', methods=['POST'])
 def embeddings_endpoint():
@@ -7379,6 +7391,7 @@ def embeddings_endpoint():
     start_time = time.time()
 
     aesthetics_scores = []
+    clip_model = clip_loader.get()
     token = clip.tokenize(prompts, truncate=True).to(device)
     with torch.no_grad():
         embeddings = clip_model.encode_text(token)
@@ -7395,6 +7408,7 @@ def embeddings_endpoint():
     })
 
 def prompt_pimping(input_text):
+    tokenizer, pimper_model = prompt_pimper.get()
     output = pimper_model.generate(tokenizer(input_text, return_tensors="pt").input_ids.to("cuda"), max_length=30)
     result_text = tokenizer.decode(output[0])
     return result_text
@@ -0,0 +1,68 @@
+"""Checks on CPU that warmup moves first-request latency off the request path, using a tiny UNet.
+
+Measures the first and the steady-state UNet call at a cold size, then warms
+the buckets and measures the first call at a warmed size and at a size the
+bucket policy snaps onto it. Set TORCH_COMPILE (e.g. TORCH_COMPILE=default)
+to include compilation, and run twice to see the on-disk compile cache.
+
+Run with:
+    python benchmark_warmup.py
+"""
+import os
+import sys
+import time
+
+import torch
+from diffusers import UNet2DConditionModel
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "server_common"))
+from warmup import from_env
+
+
+def tiny_unet() -> UNet2DConditionModel:
+    torch.manual_seed(0)
+    return UNet2DConditionModel(
+        block_out_channels=(32, 64),
+        layers_per_block=1,
+        sample_size=32,
+        in_channels=4,
+        out_channels=4,
+        down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"),
+        up_block_types=("CrossAttnUpBlock2D", "UpBlock2D"),
+        cross_attention_dim=32,
+        attention_head_dim=8,
+    ).eval()
+
+
+def main():
+    warmup = from_env("256x256x1,256x256x2,320x192x1")
+    unet = warmup.compile(tiny_unet())
+    encoder_hidden_states = torch.randn(1, 77, 32)
+
+    def render(width, height, batch_size):
+        latents = torch.randn(batch_size, 4, height // 8, width // 8)
+        with torch.inference_mode():
+            unet(latents, 999, encoder_hidden_states.expand(batch_size, -1, -1))
+
+    def timed_render(width, height):
+        start = time.perf_counter()
+        render(width, height, 1)
+        return (time.perf_counter() - start) * 1000
+
+    cold_first = timed_render(192, 320)
+    cold_steady = min(timed_render(192, 320) for _ in range(5))
+    print(f"Cold size 192x320: first call {cold_first:.1f}ms, steady {cold_steady:.1f}ms")
+
+    start = time.perf_counter()
+    warmup.run(render)
+    print(f"Warmup of {len(warmup.buckets)} buckets took {time.perf_counter() - start:.2f} seconds")
+
+    print(f"Warmed size 256x256: first call {timed_render(256, 256):.1f}ms")
+    snapped = warmup.snap(248, 256)
+    print(f"Request 248x256 snaps to {snapped[0]}x{snapped[1]}: first call {timed_render(*snapped):.1f}ms")
+    unsnapped = warmup.snap(512, 128)
+    print(f"Request 512x128 is left at {unsnapped[0]}x{unsnapped[1]}: first call {timed_render(*unsnapped):.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+import asyncio
+import json
+import os
+import uuid
+from collections import OrderedDict
+
+import aiohttp
+
+
+class ComfyUIError(Exception):
+    pass
+
+
+class ComfyUIClient:
+    """Async client for a ComfyUI server.
+
+    Workflows are queued over one pooled HTTP session and their completion is
+    learned from ComfyUI's websocket events rather than by polling /history, so
+    a result is fetched as soon as the last node has executed. Any number of
+    prompts can be in flight at once; each `run` waits only for its own.
+    """
+
+    def __init__(self, base_url="http://127.0.0.1:8188", timeout_seconds=300):
+        self.base_url = base_url.rstrip("/")
+        self.client_id = uuid.uuid4().hex
+        self.timeout_seconds = timeout_seconds
+        self.session = None
+        self._listener = None
+        self._connected = asyncio.Event()
+        # prompt_id -> future resolved with the outputs of every executed node
+        self._completions = {}
+        self._outputs = {}
+        # Prompts already returned, so trailing events don't register them again
+        self._finished = OrderedDict()
+        # prompt_id -> when its first event arrived, for events of prompts nobody has queued (yet)
+        self._unclaimed = OrderedDict()
+
+    async def start(self):
+        if self.session is None:
+            self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=32))
+        if self._listener is None:
+            self._listener = asyncio.create_task(self._listen())
+        await asyncio.wait_for(self._connected.wait(), self.timeout_seconds)
+
+    async def stop(self):
+        if self._listener is not None:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except asyncio.CancelledError:
+                pass
+            self._listener = None
+        for future in self._completions.values():
+            if not future.done():
+                future.cancel()
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def run(self, prompt):
+        """Queue a workflow and return the bytes of every image it outputs."""
+        prompt_id = await self.queue_prompt(prompt)
+        try:
+            outputs = await asyncio.wait_for(asyncio.shield(self._completion(prompt_id)), self.timeout_seconds)
+        finally:
+            self._completions.pop(prompt_id, None)
+            self._outputs.pop(prompt_id, None)
+            self._finished[prompt_id] = None
+            while len(self._finished) > 1024:
+                self._finished.popitem(last=False)
+        if not outputs:
+            # Fully cached workflows don't send "executed" events, only the history has their outputs
+            outputs = ((await self.get_history(prompt_id)) or {}).get("outputs", {})
+        images = [image for output in outputs.values() for image in output.get("images", [])]
+        return await asyncio.gather(*[self.fetch_image(image) for image in images])
+
+    async def queue_prompt(self, prompt):
+        async with self.session.post(f"{self.base_url}/prompt", json={"prompt": prompt, "client_id": self.client_id}) as response:
+            if response.status != 200:
+                raise ComfyUIError(f"HTTP error! status: {response.status}, {await response.text()}")
+            data = await response.json()
+        print('Prompt queued:', data)
+        # Events for the prompt may already have arrived; make sure they have somewhere to go
+        self._unclaimed.pop(data["prompt_id"], None)
+        self._completion(data["prompt_id"])
+        return data["prompt_id"]
+
+    async def get_history(self, prompt_id):
+        async with self.session.get(f"{self.base_url}/history/{prompt_id}") as response:
+            if response.status != 200:
+                raise ComfyUIError(f"HTTP error! status: {response.status}")
+            return (await response.json()).get(prompt_id)
+
+    async def fetch_image(self, image):
+        params = {"filename": image["filename"], "subfolder": image.get("subfolder", ""), "type": image.get("type", "output")}
+        async with self.session.get(f"{self.base_url}/view", params=params) as response:
+            if response.status != 200:
+                raise ComfyUIError(f"HTTP error! status: {response.status}")
+            return await response.read()
+
+    def _completion(self, prompt_id):
+        if prompt_id not in self._completions:
+            self._completions[prompt_id] = asyncio.get_running_loop().create_future()
+        return self._completions[prompt_id]
+
+    def _finish(self, prompt_id, outputs=None, error=None):
+        future = self._completion(prompt_id)
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(ComfyUIError(error))
+            # Waiters re-raise it; make sure an unawaited future doesn't log a warning
+            future.exception()
+        else:
+            future.set_result(outputs if outputs is not None else self._outputs.get(prompt_id, {}))
+
+    def _drop_unclaimed(self):
+        """Forget events of prompts that no `run` has claimed within the timeout."""
+        expired = asyncio.get_running_loop().time() - self.timeout_seconds
+        while self._unclaimed and next(iter(self._unclaimed.values())) < expired:
+            prompt_id, _ = self._unclaimed.popitem(last=False)
+            self._completions.pop(prompt_id, None)
+            self._outputs.pop(prompt_id, None)
+
+    def _handle_event(self, message):
+        event_type, data = message.get("type"), message.get("data") or {}
+        prompt_id = data.get("prompt_id")
+        self._drop_unclaimed()
+        if prompt_id is None or prompt_id in self._finished:
+            return
+        if prompt_id not in self._completions and prompt_id not in self._unclaimed:
+            # Usually queue_prompt just hasn't returned yet, but the prompt may not be ours at all
+            self._unclaimed[prompt_id] = asyncio.get_running_loop().time()
+        if event_type == "executed":
+            self._outputs.setdefault(prompt_id, {})[data["node"]] = data.get("output") or {}
+        elif event_type == "execution_success" or (event_type == "executing" and data.get("node") is None):
+            self._finish(prompt_id)
+        elif event_type == "execution_error":
+            self._finish(prompt_id, error=f"Generation failed: {data.get('exception_message', data)}")
+        elif event_type == "execution_interrupted":
+            self._finish(prompt_id, error="Generation interrupted")
+
+    async def _listen(self):
+        ws_url = self.base_url.replace("http", "ws", 1) + f"/ws?clientId={self.client_id}"
+        while True:
+            try:
+                async with self.session.ws_connect(ws_url, heartbeat=30) as ws:
+                    self._connected.set()
+                    # Anything that finished while we were disconnected only shows up in the history
+                    await self._catch_up()
+                    async for message in ws:
+                        # Binary messages are latent previews
+                        if message.type == aiohttp.WSMsgType.TEXT:
+                            self._handle_event(json.loads(message.data))
+                        elif message.type == aiohttp.WSMsgType.ERROR:
+                            break
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"ComfyUI websocket error: {e}")
+            self._connected.clear()
+            await asyncio.sleep(1)
+
+    async def _catch_up(self):
+        for prompt_id, future in list(self._completions.items()):
+            if future.done():
+                continue
+            prompt_history = await self.get_history(prompt_id)
+            status = (prompt_history or {}).get("status", {})
+            if status.get("completed"):
+                self._finish(prompt_id, outputs=prompt_history.get("outputs", {}))
+            elif status.get("status_str") == "error":
+                self._finish(prompt_id, error=f"Generation failed: {prompt_history}")
+
+
+def from_env():
+    return ComfyUIClient(
+        base_url=os.getenv("COMFYUI_URL", "http://127.0.0.1:8188"),
+        timeout_seconds=float(os.getenv("COMFYUI_TIMEOUT", "300")),
+    )
@@ -0,0 +1,97 @@
+import os
+import threading
+from collections import OrderedDict
+
+import torch
+
+
+def normalize_prompt(prompt):
+    """Prompts that only differ in whitespace produce the same conditioning."""
+    return " ".join(prompt.split())
+
+
+def _tensors(value):
+    return value if isinstance(value, (tuple, list)) else (value,)
+
+
+def _size_in_bytes(value):
+    return sum(t.element_size() * t.nelement() for t in _tensors(value) if isinstance(t, torch.Tensor))
+
+
+class ConditioningCache:
+    """LRU cache of text-encoder outputs, bounded by the memory its tensors use.
+
+    Entries are keyed by encoder identity and normalized prompt text; a value is
+    whatever the encoder returns for one prompt, e.g. a conditioning tensor or
+    a (prompt_embeds, pooled_prompt_embeds) tuple with a batch dimension of 1.
+    Pinned entries, such as the empty prompt used for unconditional guidance,
+    are computed once and never evicted.
+    """
+
+    def __init__(self, max_bytes=512 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.pinned = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self.entries), "bytes": self.bytes}
+
+    def pin(self, encoder_id, prompt, compute):
+        """Compute the conditioning for `prompt` once and keep it for the lifetime of the process."""
+        key = (encoder_id, normalize_prompt(prompt))
+        if key not in self.pinned:
+            self.pinned[key] = compute(prompt)
+        return self.pinned[key]
+
+    def get_many(self, encoder_id, prompts, compute_batch):
+        """Conditioning for every prompt; `compute_batch(prompts)` encodes the misses in one call
+        and returns one value per prompt."""
+        keys = [(encoder_id, normalize_prompt(prompt)) for prompt in prompts]
+        values = [None] * len(prompts)
+        with self.lock:
+            for idx, key in enumerate(keys):
+                value = self.pinned.get(key)
+                if value is None:
+                    value = self.entries.get(key)
+                    if value is not None:
+                        self.entries.move_to_end(key)
+                values[idx] = value
+        missing = [idx for idx, value in enumerate(values) if value is None]
+        self.hits += len(prompts) - len(missing)
+        self.misses += len(missing)
+        if not missing:
+            return values
+
+        # Duplicates inside one call are encoded once
+        unique_keys = list(OrderedDict.fromkeys(keys[idx] for idx in missing))
+        computed = dict(zip(unique_keys, compute_batch([key[1] for key in unique_keys])))
+        for idx in missing:
+            values[idx] = computed[keys[idx]]
+
+        with self.lock:
+            for key, value in computed.items():
+                if key in self.entries:
+                    continue
+                self.entries[key] = value
+                self.bytes += _size_in_bytes(value)
+            while self.bytes > self.max_bytes and self.entries:
+                _, evicted = self.entries.popitem(last=False)
+                self.bytes -= _size_in_bytes(evicted)
+        return values
+
+
+def split_batch(value, count):
+    """Split batched encoder output into `count` per-prompt values with their own storage,
+    so a cached prompt doesn't keep the rest of its batch alive."""
+    if isinstance(value, (tuple, list)):
+        parts = [split_batch(t, count) for t in value]
+        return [tuple(part[idx] for part in parts) for idx in range(count)]
+    return [value[idx:idx + 1].clone() for idx in range(count)]
+
+
+def from_env():
+    return ConditioningCache(max_bytes=int(float(os.getenv("CONDITIONING_CACHE_MB", "512")) * 1024 * 1024))
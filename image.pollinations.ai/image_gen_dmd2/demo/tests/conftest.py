@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The demo servers import their helpers flat, as they are when run from this directory
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
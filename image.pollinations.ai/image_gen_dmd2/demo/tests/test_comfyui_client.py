@@ -0,0 +1,144 @@
+import asyncio
+import json
+import uuid
+
+import pytest
+from aiohttp import web
+
+from comfyui_client import ComfyUIClient, ComfyUIError
+
+
+class FakeComfyUI:
+    """Queues prompts and reports them over the websocket the way ComfyUI does.
+
+    A prompt whose "text" is "fail" errors, "cached" finishes without any
+    "executed" event, anything else outputs one image named after its id.
+    """
+
+    def __init__(self, delay=0.05):
+        self.delay = delay
+        self.sockets = []
+        self.history = {}
+        self.runner = None
+        self.url = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/ws", self.ws)
+        app.router.add_post("/prompt", self.prompt)
+        app.router.add_get("/history/{prompt_id}", self.get_history)
+        app.router.add_get("/view", self.view)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        host, port = self.runner.addresses[0][:2]
+        self.url = f"http://{host}:{port}"
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    async def broadcast(self, event_type, **data):
+        for ws in self.sockets:
+            await ws.send_str(json.dumps({"type": event_type, "data": data}))
+
+    async def ws(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self.sockets.append(ws)
+        async for _ in ws:
+            pass
+        return ws
+
+    async def prompt(self, request):
+        body = await request.json()
+        prompt_id = uuid.uuid4().hex
+        asyncio.create_task(self.execute(prompt_id, body["prompt"]["text"]))
+        return web.json_response({"prompt_id": prompt_id})
+
+    async def execute(self, prompt_id, text):
+        await asyncio.sleep(self.delay)
+        outputs = {"9": {"images": [{"filename": f"{prompt_id}.png", "subfolder": "", "type": "output"}]}}
+        for ws in self.sockets:
+            # Latent previews arrive as binary messages
+            await ws.send_bytes(b"preview")
+        if text == "fail":
+            await self.broadcast("execution_error", prompt_id=prompt_id, exception_message="out of memory")
+        elif text != "cached":
+            await self.broadcast("executed", prompt_id=prompt_id, node="9", output=outputs["9"])
+        await self.broadcast("executing", prompt_id=prompt_id, node=None)
+        self.history[prompt_id] = {"status": {"completed": text != "fail"}, "outputs": outputs}
+
+    async def get_history(self, request):
+        prompt_id = request.match_info["prompt_id"]
+        return web.json_response({prompt_id: self.history[prompt_id]} if prompt_id in self.history else {})
+
+    async def view(self, request):
+        return web.Response(body=f"image:{request.query['filename']}".encode())
+
+
+def run_against_fake(scenario, timeout_seconds=5):
+    async def main():
+        server = FakeComfyUI()
+        await server.start()
+        client = ComfyUIClient(server.url, timeout_seconds=timeout_seconds)
+        await client.start()
+        try:
+            return await scenario(server, client)
+        finally:
+            await client.stop()
+            await server.stop()
+
+    return asyncio.run(main())
+
+
+def test_concurrent_prompts_each_get_their_own_images():
+    async def scenario(server, client):
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        results = await asyncio.gather(*[client.run({"text": str(i)}) for i in range(20)])
+        return results, loop.time() - started, client
+
+    results, elapsed, client = run_against_fake(scenario)
+
+    assert len(results) == 20
+    assert all(len(images) == 1 and images[0].startswith(b"image:") for images in results)
+    assert len({images[0] for images in results}) == 20
+    # The prompts run concurrently instead of one after the other
+    assert elapsed < 20 * 0.05
+    assert client._completions == {} and client._outputs == {}
+
+
+def test_fully_cached_workflow_is_read_from_history():
+    async def scenario(server, client):
+        return await client.run({"text": "cached"})
+
+    images = run_against_fake(scenario)
+
+    assert len(images) == 1 and images[0].startswith(b"image:")
+
+
+def test_execution_error_is_raised():
+    async def scenario(server, client):
+        with pytest.raises(ComfyUIError, match="out of memory"):
+            await client.run({"text": "fail"})
+
+    run_against_fake(scenario)
+
+
+def test_events_of_unknown_prompts_are_dropped():
+    async def scenario(server, client):
+        await server.broadcast("executed", prompt_id="someone-else", node="9", output={"images": []})
+        await server.broadcast("executing", prompt_id="someone-else", node=None)
+        await asyncio.sleep(0.05)
+        assert "someone-else" in client._completions
+        await asyncio.sleep(client.timeout_seconds)
+        # Any later event prunes what nobody claimed in time
+        await client.run({"text": "next"})
+        return client
+
+    client = run_against_fake(scenario, timeout_seconds=0.5)
+
+    assert "someone-else" not in client._completions
+    assert "someone-else" not in client._outputs
+    assert not client._unclaimed
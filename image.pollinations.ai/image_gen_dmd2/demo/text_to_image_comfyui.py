@@ -1,11 +1,20 @@
 from fastapi import FastAPI, Request
 from fastapi.responses import JSONResponse
+from contextlib import asynccontextmanager
+from PIL import Image
+import asyncio
 import time
 import io
 import base64
 import os
-import requests
+import sys
 from safety_checker.censor import check_safety
+# Run as demo.text_to_image_comfyui, so the client next to this file and the modules
+# shared with the FLUX server (the safety service client) are added to the path
+demo_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(demo_dir)
+sys.path.append(os.path.join(demo_dir, "..", "..", "server_common"))
+from comfyui_client import from_env as comfyui_client_from_env
 import uvicorn
 
 SAFETY_CHECKER = False
@@ -15,7 +24,18 @@ total_request_time_accumulated = 0
 first_request_time = None
 request_count = 0
 
-app = FastAPI()
+# One client, and one websocket subscription, shared by every request
+comfyui = comfyui_client_from_env()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await comfyui.start()
+    try:
+        yield
+    finally:
+        await comfyui.stop()
+
+app = FastAPI(lifespan=lifespan)
 
 def create_prompt(dynamic_text, width=1024, height=1024, seed=711058089000452):
     return {
@@ -78,32 +98,6 @@ def create_prompt(dynamic_text, width=1024, height=1024, seed=711058089000452):
         }
     }
 
-async def queue_prompt(prompt):
-    response = await requests.post("http://127.0.0.1:8188/prompt", json={"prompt": prompt})
-    if response.status_code != 200:
-        raise Exception(f"HTTP error! status: {response.status_code}")
-    return response.json()
-
-async def get_history(prompt_id):
-    response = await requests.get(f"http://127.0.0.1:8188/history/{prompt_id}")
-    if response.status_code != 200:
-        raise Exception(f"HTTP error! status: {response.status_code}")
-    return response.json()
-
-async def poll_history(prompt_id):
-    while True:
-        history = await get_history(prompt_id)
-        print(history)
-        prompt_history = history.get(prompt_id)
-        if prompt_history and prompt_history.get('status', {}).get('completed'):
-            print('Generation completed:', prompt_history)
-            return list(prompt_history['outputs'].values())[0]['images'][0]['filename']
-        elif prompt_history and prompt_history.get('status', {}).get('status_str') == 'error':
-            print('Generation failed:', prompt_history)
-            raise Exception('Generation failed:', prompt_history)
-        print('Generation in progress:', prompt_history)
-        await asyncio.sleep(1)  # Wait for 1 second before polling again
-
 @app.post('/generate')
 async def generate(request: Request):
     global total_request_time_accumulated, first_request_time, request_count
@@ -140,24 +134,18 @@ async def generate(request: Request):
     # Log the start time for the entire request processing
     request_start_time = time.time()
 
-    # Prepare payload for ComfyUI
-    prompt = create_prompt(prompts[0], width, height, seed if seed != -1 else None)
+    # Prepare payload for ComfyUI; KSampler needs a concrete seed
+    prompt = create_prompt(prompts[0], width, height, seed if seed != -1 else int.from_bytes(os.urandom(4), "big"))
 
-    # Queue the prompt and then poll for results
+    # Queue the prompt and wait for ComfyUI to report it done
     try:
-        data = await queue_prompt(prompt)
-        print('Prompt queued:', data)
-        filename = await poll_history(data['prompt_id'])
+        images = await comfyui.run(prompt)
     except Exception as e:
         return JSONResponse(content={"error": str(e)}, status_code=500)
 
-    # Load the generated image
-    image_path = os.path.join(os.getenv("HOME"), "ComfyUI", "output", filename)
-    if not os.path.exists(image_path):
+    if not images:
         return JSONResponse(content={"error": "Generated image not found"}, status_code=500)
-
-    with open(image_path, "rb") as image_file:
-        img_byte_arr = image_file.read()
+    img_byte_arr = images[0]
 
     # Convert image to base64
     img_base64 = base64.b64encode(img_byte_arr).decode('utf-8')
@@ -165,7 +153,8 @@ async def generate(request: Request):
     # Log the start time for the safety checker
     safety_check_start_time = time.time()
     print("starting safety check")
-    concepts, has_nsfw_concepts_list = check_safety([img_byte_arr], safety_checker_adj=0.0)
+    image = Image.open(io.BytesIO(img_byte_arr)).convert("RGB")
+    concepts, has_nsfw_concepts_list = await asyncio.to_thread(check_safety, [image], safety_checker_adj=0.0)
     print("end safety check")
     # Log the end time for the safety checker
     safety_check_end_time = time.time()
@@ -1,18 +1,31 @@
 import torch
-from diffusers import DiffusionPipeline, UNet2DConditionModel, LCMScheduler, AutoencoderTiny, DDIMScheduler, EulerAncestralDiscreteScheduler
+from diffusers import DiffusionPipeline, UNet2DConditionModel, LCMScheduler, AutoencoderTiny
 from huggingface_hub import hf_hub_download
 from fastapi import FastAPI, Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
 import time
-import io
-import base64
-import cv2
-import numpy as np
-from safety_checker.censor import check_safety
-import uvicorn
+import asyncio
 import os
-from hidiffusion import apply_hidiffusion, remove_hidiffusion
-from compel import Compel, ReturnedEmbeddingsType
+import sys
+from safety_checker.censor import check_safety, safety_cache
+# Run as demo.text_to_image_sdxl, so the helpers next to this file and the modules
+# shared with the FLUX server are added to the path
+demo_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(demo_dir)
+sys.path.append(os.path.join(demo_dir, "..", "..", "server_common"))
+from inference_executor import RequestTooLargeError, ServerBusyError, from_env as executor_from_env, timed
+from image_responses import build_response, encode_jpeg, wants_binary
+from result_cache import cache_key, from_env as result_cache_from_env
+from conditioning_cache import from_env as conditioning_cache_from_env, split_batch
+from resolutions import ResolutionIndex
+from metrics import Metrics
+from startup import LazyImport, StartupTimeline, from_env as warm_start_from_env, load_parallel
+from warmup import from_env as warmup_from_env
+import uvicorn
+import importlib
+# hidiffusion is only imported if it is applied
+apply_hidiffusion = LazyImport("hidiffusion", "apply_hidiffusion")
+remove_hidiffusion = LazyImport("hidiffusion", "remove_hidiffusion")
 
 base_model_id = "GraydientPlatformAPI/boltning-xl"
 repo_name = "tianweiy/DMD2"
@@ -29,39 +42,164 @@ repo_name = "tianweiy/DMD2"
 # pipe.vae = AutoencoderTiny.from_pretrained("madebyollin/taesdxl", torch_dtype=torch.float16).to("cuda", torch.float16)
 
 ckpt_name = "dmd2_sdxl_4step_lora_fp16.safetensors"
-# Load model.
-pipe = DiffusionPipeline.from_pretrained(base_model_id, torch_dtype=torch.float32).to("cuda")
-pipe.load_lora_weights(hf_hub_download(repo_name, ckpt_name))
-pipe.fuse_lora(lora_scale=0.5)  # we might want to make the scale smaller for community models
-pipe.vae = AutoencoderTiny.from_pretrained("madebyollin/taesdxl", torch_dtype=torch.float16).to("cuda", torch.float16)
+LORA_SCALE = 0.5  # we might want to make the scale smaller for community models
+
+timeline = StartupTimeline("dmd2")
+# The fused fp16 UNet is saved on the first start and memory-mapped on later ones
+warm_start = warm_start_from_env()
+
+def load_tiny_vae():
+    return AutoencoderTiny.from_pretrained("madebyollin/taesdxl", torch_dtype=torch.float16).to("cuda")
+
+def build_fused_unet():
+    # The LoRA is fused in fp32 and only then converted to fp16
+    fusing = DiffusionPipeline.from_pretrained(base_model_id, torch_dtype=torch.float32, text_encoder=None, text_encoder_2=None, vae=load_tiny_vae()).to("cuda")
+    fusing.load_lora_weights(hf_hub_download(repo_name, ckpt_name))
+    fusing.fuse_lora(components=["unet"], lora_scale=LORA_SCALE)
+    fusing.unload_lora_weights()
+    return fusing.unet.to(torch.float16)
+
+def load_unet():
+    return warm_start.load_or_build(
+        "dmd2-unet",
+        build_fused_unet,
+        load=lambda path: UNet2DConditionModel.from_pretrained(path, torch_dtype=torch.float16).to("cuda"),
+        model=base_model_id,
+        lora=f"{repo_name}/{ckpt_name}",
+        lora_scale=LORA_SCALE,
+        dtype="float16",
+    )
+
+# Load model. The UNet, the text encoders and the compel import run in parallel
+components = load_parallel({
+    "unet": load_unet,
+    "pipeline": lambda: DiffusionPipeline.from_pretrained(base_model_id, torch_dtype=torch.float16, unet=None, vae=load_tiny_vae()).to("cuda"),
+    "compel": lambda: importlib.import_module("compel"),
+}, timeline)
+compel_module = components["compel"]
+pipe = components["pipeline"]
+pipe.register_modules(unet=components["unet"])
 pipe.scheduler = LCMScheduler.from_config(pipe.scheduler.config)
 
 print("scheduler config", pipe.scheduler.config)
 print("scheduler timesteps", pipe.scheduler.timesteps)
 print("pipe timesteps", pipe.scheduler.timesteps)
 
-pipe.to(torch.float16)
 # apply_hidiffusion(pipe)
-compel = Compel(
+compel = compel_module.Compel(
   tokenizer=[pipe.tokenizer, pipe.tokenizer_2] ,
   text_encoder=[pipe.text_encoder, pipe.text_encoder_2],
-  returned_embeddings_type=ReturnedEmbeddingsType.PENULTIMATE_HIDDEN_STATES_NON_NORMALIZED,
+  returned_embeddings_type=compel_module.ReturnedEmbeddingsType.PENULTIMATE_HIDDEN_STATES_NON_NORMALIZED,
   requires_pooled=[False, True]
 )
 
 SAFETY_CHECKER = False
 
-# Global variables to track time
-total_request_time_accumulated = 0
-first_request_time = None
-request_count = 0
+# Sides in multiples of 8, scaled up to at least 800x800 keeping the aspect ratio
+SDXL_RESOLUTIONS = ResolutionIndex(multiple=8, area_multiple=64, min_pixels=800 * 800)
+
+# Sizes and batch sizes rendered once before serving; TORCH_COMPILE compiles the UNet per bucket
+warmup = warmup_from_env("1024x1024x1,1024x1024x4,832x1216x1,1216x832x1", snap_size=SDXL_RESOLUTIONS.snap)
+pipe.unet = warmup.compile(pipe.unet)
+
+# Renders run on one dedicated GPU thread, JPEG encoding and safety checks on a CPU pool
+executor = executor_from_env(default_max_in_flight=16)
+result_cache = result_cache_from_env()
+
+# Compel conditioning per prompt; repeated prompts skip the text encoders
+conditioning_cache = conditioning_cache_from_env()
+ENCODER_ID = f"{base_model_id}/compel"
+
+# Stage latencies, throughput, GPU utilization and cache stats, served on /metrics
+metrics = Metrics("dmd2")
+metrics.add_cache("results", result_cache.stats)
+metrics.add_cache("conditioning", conditioning_cache.stats)
+metrics.add_cache("safety", safety_cache.stats)
 
 app = FastAPI()
 
+def encode_uncached(prompts):
+    prompt_embeds, pooled_prompt_embeds = compel(prompts)
+    return split_batch((prompt_embeds, pooled_prompt_embeds), len(prompts))
+
+def encode_prompts(prompts):
+    embeds = conditioning_cache.get_many(ENCODER_ID, prompts, encode_uncached)
+    prompt_embeds = [prompt_embeds for prompt_embeds, _ in embeds]
+    if len(set(e.shape for e in prompt_embeds)) > 1:
+        # Prompts encoded in different batches can differ in token length
+        prompt_embeds = compel.pad_conditioning_tensors_to_same_length(prompt_embeds)
+    return torch.cat(prompt_embeds), torch.cat([pooled for _, pooled in embeds])
+
+# The empty prompt is common enough to keep around for good
+conditioning_cache.pin(ENCODER_ID, "", lambda prompt: encode_uncached([prompt])[0])
+def render_warmup(width, height, batch_size):
+    prompt_embeds, pooled_prompt_embeds = encode_prompts([""] * batch_size)
+    pipe(prompt_embeds=prompt_embeds, pooled_prompt_embeds=pooled_prompt_embeds, num_inference_steps=4, guidance_scale=0, width=width, height=height, timesteps=[999, 749, 499, 249])
+
+warmup.run(render_warmup, timeline)
+timeline.report()
+
+def render(prompts, width, height, generator, queued_at):
+    metrics.observe("queue_wait", time.perf_counter() - queued_at)
+    with metrics.gpu(torch.cuda.synchronize) as timer:
+        prompt_embeds, pooled_prompt_embeds = encode_prompts(prompts)
+        timer.mark("text_encode")
+        images = pipe(prompt_embeds=prompt_embeds, pooled_prompt_embeds=pooled_prompt_embeds, num_inference_steps=4, guidance_scale=0, generator=generator, width=width, height=height, timesteps=[999, 749, 499, 249], callback_on_step_end=timer.step_end).images
+        timer.mark("vae_decode")
+    metrics.count_images(len(images))
+    return images
+
+def encode_images(images):
+    """Encode images as JPEG, returning views of the encoder buffers."""
+    return [encode_jpeg(image) for image in images]
+
+class NoImagesError(Exception):
+    pass
+
+async def render_request(prompts, width, height, seed):
+    # Set the seed for reproducibility, with a per-request generator so
+    # concurrent requests don't share the global RNG state
+    if seed != -1:
+        generator = torch.Generator().manual_seed(seed)
+    else:
+        generator = None
+
+    with executor.admit(len(prompts)):
+        # Generate images for each prompt
+        images, render_time = await executor.run_gpu(timed, render, prompts, width, height, generator, time.perf_counter())
+        print(f"Render time: {render_time:.2f} seconds")
+
+        if not images:
+            raise NoImagesError()
+
+        # Encoding and the safety check run concurrently on the CPU pool, while the
+        # GPU thread is already free to render the next request
+        (img_byte_arr_list, image_creation_time), ((concepts, has_nsfw_concepts_list), safety_check_time) = await asyncio.gather(
+            executor.run_cpu(timed, encode_images, images),
+            executor.run_cpu(timed, check_safety, images, safety_checker_adj=0.0),
+        )
+        print(f"Image creation time: {image_creation_time:.2f} seconds")
+        print(f"Safety check time: {safety_check_time:.2f} seconds")
+        metrics.observe("encode", image_creation_time)
+        metrics.observe("safety", safety_check_time)
+
+    response_content = []
+    for img_byte_arr, prompt, has_nsfw_concept, concept in zip(img_byte_arr_list, prompts, has_nsfw_concepts_list, concepts):
+        image_content = {
+            "image": img_byte_arr,
+            "has_nsfw_concept": has_nsfw_concept,
+            "concept": concept,
+            "width": width,
+            "height": height,
+            "seed": seed,
+            "prompt": prompt
+        }
+
+        response_content.append(image_content)
+    return response_content
+
 @app.post('/generate')
 async def generate(request: Request):
-    global total_request_time_accumulated, first_request_time, request_count
-
     data = await request.json()
     prompts = data.get('prompts', ['children'])
 
@@ -73,17 +211,8 @@ async def generate(request: Request):
     width = max((convert_to_int(data.get('width', 1024), 1024)), 32)
     height = max((convert_to_int(data.get('height', 1024), 1024)), 32)
 
-    min_pixels = 800 * 800
-    current_pixels = width * height
-
-    if current_pixels < min_pixels:
-        scale_factor = (min_pixels / current_pixels) ** 0.5
-        width = int(width * scale_factor)
-        height = int(height * scale_factor)
-
-    # esnsure height and width are divisible by 8
-    width = (width // 8) * 8
-    height = (height // 8) * 8
+    width, height = SDXL_RESOLUTIONS.snap(width, height)
+    width, height = warmup.snap(width, height)
 
     seed = convert_to_int(data.get('seed', -1), -1)
 
@@ -95,99 +224,37 @@ async def generate(request: Request):
 
     # Log the start time for the entire request processing
     request_start_time = time.time()
-    # Set the seed for reproducibility
-    if seed != -1:
-        generator = torch.manual_seed(seed)
-    else:
-        generator = None
-
-
-    prompt_embeds,pooled_prompt_embeds = compel(prompts)
-    # Generate images for each prompt
-    images = pipe(prompt_embeds=prompt_embeds, pooled_prompt_embeds=pooled_prompt_embeds, num_inference_steps=4, guidance_scale=0, generator=generator, width=width, height=height, timesteps=[999, 749, 499, 249]).images
-    # images = pipe(prompt=prompts, num_inference_steps=4, guidance_scale=0, generator=generator, width=width, height=height, 
-    # timesteps=[999, 749, 499, 249]
-    # ).images
-
-    if not images:
+    try:
+        if seed != -1:
+            # Seeded requests are deterministic, so repeats are served from the result cache
+            key = cache_key(model=base_model_id, lora=ckpt_name, prompts=prompts, seed=seed, width=width, height=height, steps=4)
+            response_content = await result_cache.get_or_compute(key, lambda: render_request(prompts, width, height, seed))
+        else:
+            response_content = await render_request(prompts, width, height, seed)
+    except RequestTooLargeError as e:
+        # Retrying would never help, unlike when the server is busy
+        return JSONResponse(content={"error": str(e)}, status_code=400)
+    except ServerBusyError as e:
+        print(f"Rejecting request: {e}")
+        return JSONResponse(content={"error": "Server busy, retry later"}, status_code=503, headers={"Retry-After": "1"})
+    except NoImagesError:
         return JSONResponse(content={"error": "No images generated"}, status_code=500)
 
-    response_content = []
-    total_image_creation_time = 0
-    total_safety_check_time = 0
-
-    # Log the start time for image creation
-    image_creation_start_time = time.time()
-
-    # Process images in batch
-    img_byte_arr_list = []
-    for idx, image in enumerate(images):
-        img_byte_arr = io.BytesIO()
-        image.save(img_byte_arr, format='JPEG')
-        img_byte_arr_list.append(img_byte_arr.getvalue())
-
-        # Save image to a tmp file and log it
-        # tmp_file_path = f"/tmp/generated_image_{idx}.png"
-        # with open(tmp_file_path, "wb") as f:
-        #     f.write(img_byte_arr.getvalue())
-        # print(f"Image saved to {tmp_file_path}")
-
-    # Convert images to base64
-    img_base64_list = [base64.b64encode(img_byte_arr).decode('utf-8') for img_byte_arr in img_byte_arr_list]
-
-    # Log the end time for image creation
-    image_creation_end_time = time.time()
-    image_creation_time = image_creation_end_time - image_creation_start_time
-    total_image_creation_time += image_creation_time
-    print(f"Image creation time: {image_creation_time:.2f} seconds")
-
-    # Log the start time for the safety checker
-    safety_check_start_time = time.time()
-    print("starting safety check")
-    concepts, has_nsfw_concepts_list = check_safety(images, safety_checker_adj=0.0)
-    print("end safety check")
-    # concepts, has_nsfw_concepts_list = [None]*len(images), [None]*len(images)
-    # Log the end time for the safety checker
-    safety_check_end_time = time.time()
-    safety_check_time = safety_check_end_time - safety_check_start_time
-    total_safety_check_time += safety_check_time
-    print(f"Safety check time: {safety_check_time:.2f} seconds")
-
-    for img_base64, prompt, has_nsfw_concept, concept in zip(img_base64_list, prompts, has_nsfw_concepts_list, concepts):
-        image_content = {
-            "image": img_base64,
-            "has_nsfw_concept": has_nsfw_concept,
-            "concept": concept,
-            "width": width,
-            "height": height,
-            "seed": seed,
-            "prompt": prompt
-        }
-
-        response_content.append(image_content)
-
     # Log the end time for the entire request processing
     request_end_time = time.time()
     total_request_time = request_end_time - request_start_time
 
-    # Update global time accumulators and request count
-    total_request_time_accumulated += total_request_time
-    request_count += 1
-
-    # Record the time of the first request
-    if first_request_time is None:
-        first_request_time = request_start_time
-
-    # Calculate the total time passed since the first request
-    total_time_passed = request_end_time - first_request_time
-
-    # Calculate the percentage of time spent processing requests
-    percentage_time_processing = (total_request_time_accumulated / total_time_passed) * 100
-
     print(f"Total request time: {total_request_time:.2f} seconds")
-    print(f"Percentage of time spent processing requests: {percentage_time_processing:.2f}%")
+    print(f"GPU utilization over the last minute: {metrics.gpu_utilization() * 100:.2f}%")
+
+    # Images are returned as base64 in JSON unless the client opts in to binary responses
+    binary = wants_binary(data.get('response_format'), request.headers.get('accept'))
+    return build_response(response_content, binary)
 
-    return JSONResponse(content=response_content, media_type="application/json")
+@app.get('/metrics')
+async def get_metrics(format: str = None):
+    body, content_type = metrics.export(format)
+    return Response(content=body, media_type=content_type)
 
 if __name__ == "__main__":
     uvicorn.run(app, host='0.0.0.0', port=5003)
@@ -0,0 +1,123 @@
+import heapq
+import itertools
+import numbers
+import threading
+import time
+from concurrent.futures import Future
+
+
+class DeadlineExceeded(Exception):
+    """The request's deadline passed before its work reached the GPU."""
+
+
+class WorkItem:
+    __slots__ = ("priority", "seq", "key", "payload", "future", "deadline", "enqueued_at")
+
+    def __init__(self, priority, seq, key, payload, future, deadline):
+        self.enqueued_at = time.monotonic()
+        self.priority = priority
+        self.seq = seq
+        self.key = key
+        self.payload = payload
+        self.future = future
+        self.deadline = deadline
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class GPUWorkQueue:
+    """One GPU worker thread fed by a priority queue, shared by all request threads.
+
+    `submit` queues one item per payload and returns a future for each. The
+    worker takes the most urgent item (lowest priority value, then oldest) and
+    merges every other queued item with the same key into its batch, up to
+    `max_batch_size`, so requests with the same model and size share pipeline
+    calls. `run_batch(key, payloads)` must return one result per payload.
+    Items whose deadline has passed or whose future was cancelled are dropped
+    before they reach the GPU. A failing batch fails only its own futures and
+    the worker keeps running. With `metrics`, each item's time in the queue is
+    observed as "queue_wait".
+    """
+
+    def __init__(self, run_batch, max_batch_size=16, max_wait_ms=5, metrics=None):
+        self.run_batch = run_batch
+        self.metrics = metrics
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.heap = []
+        self.seq = itertools.count()
+        self.condition = threading.Condition()
+        self.worker = threading.Thread(target=self._run, name="gpu-worker", daemon=True)
+        self.worker.start()
+
+    def queue_depth(self):
+        with self.condition:
+            return len(self.heap)
+
+    def submit(self, key, payloads, priority=0, timeout=None):
+        if isinstance(priority, bool) or not isinstance(priority, numbers.Real):
+            # Anything else would break the ordering of the whole heap
+            raise TypeError(f"priority must be a number, not {priority!r}")
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        futures = []
+        with self.condition:
+            for payload in payloads:
+                future = Future()
+                heapq.heappush(self.heap, WorkItem(priority, next(self.seq), key, payload, future, deadline))
+                futures.append(future)
+            self.condition.notify()
+        return futures
+
+    def _take_batch(self):
+        """Pop the most urgent live item and the queued items sharing its key. Holds the condition."""
+        now = time.monotonic()
+        batch, rest = [], []
+        while self.heap and len(batch) < self.max_batch_size:
+            item = heapq.heappop(self.heap)
+            if item.future.cancelled():
+                continue
+            if item.deadline is not None and item.deadline < now:
+                # Marking it running first means a concurrent cancel() can't race the exception
+                if item.future.set_running_or_notify_cancel():
+                    item.future.set_exception(DeadlineExceeded(f"Dropped {now - item.deadline:.1f}s after its deadline"))
+                continue
+            if batch and item.key != batch[0].key:
+                rest.append(item)
+                continue
+            if item.future.set_running_or_notify_cancel():
+                batch.append(item)
+        for item in rest:
+            heapq.heappush(self.heap, item)
+        return batch
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.heap:
+                    self.condition.wait()
+                # Give concurrent requests a moment to join the batch
+                if len(self.heap) < self.max_batch_size and self.max_wait > 0:
+                    self.condition.wait(self.max_wait)
+                try:
+                    batch = self._take_batch()
+                except Exception as e:
+                    # Every request depends on this thread; an error must never end it
+                    print(f"GPU queue error: {e!r}")
+                    continue
+            if not batch:
+                continue
+            try:
+                if self.metrics is not None:
+                    started = time.monotonic()
+                    for item in batch:
+                        self.metrics.observe("queue_wait", started - item.enqueued_at)
+                results = list(self.run_batch(batch[0].key, [item.payload for item in batch]))
+                if len(results) != len(batch):
+                    raise RuntimeError(f"run_batch returned {len(results)} results for {len(batch)} payloads")
+            except BaseException as e:
+                for item in batch:
+                    item.future.set_exception(e)
+                continue
+            for item, result in zip(batch, results):
+                item.future.set_result(result)
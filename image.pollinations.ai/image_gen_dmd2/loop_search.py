@@ -0,0 +1,170 @@
+import itertools
+import multiprocessing
+import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+# A candidate matches when its tempo, or half or double of it, is this close to the request
+BPM_TOLERANCE = 15
+# Tempo estimates this close to half or double the request are octave errors
+OCTAVE_TOLERANCE = 10
+# Seconds warm() waits for every worker to start and load BeatNet
+WARM_TIMEOUT = 300
+
+_beatnet = None
+# Id of the search whose candidates are still wanted, shared with the parent process
+_current_search = None
+_warm_barrier = None
+
+
+def _init_worker(current_search, warm_barrier):
+    global _beatnet, _current_search, _warm_barrier
+    _current_search = current_search
+    _warm_barrier = warm_barrier
+    import madmom.audio.filters
+
+    # Hack madmom to work with recent python
+    madmom.audio.filters.np.float = float
+    from BeatNet.BeatNet import BeatNet
+
+    _beatnet = BeatNet(1, mode="offline", inference_model="DBN", plot=[], thread=False, device="cpu")
+
+
+def _ready(timeout):
+    # Hold this worker until every other one is here too, so each worker runs
+    # exactly one of the warm() calls and the pool has to start all of them
+    _warm_barrier.wait(timeout)
+    return _beatnet is not None
+
+
+def loop_points(beats):
+    """Start and end time of the longest run of whole 4-bar phrases, end None when there is none."""
+    # extract an even number of bars
+    downbeat_times = beats[:, 0][beats[:, 1] == 1]
+    num_bars = len(downbeat_times) - 1
+    if num_bars < 1:
+        return None, None
+
+    even_num_bars = max(4, int((num_bars // 4) * 4))
+    start_time = downbeat_times[0]
+    if num_bars < even_num_bars:
+        return start_time, None
+    return start_time, downbeat_times[even_num_bars]
+
+
+def _cancelled(search_id):
+    return search_id is not None and _current_search.value != search_id
+
+
+def analyze(wav, sample_rate, bpm, shift_to_start=False, search_id=None):
+    """Beats, loop points and tempo of one candidate, or None when it has no whole 4-bar loop.
+
+    Runs in a worker process with its own BeatNet. Once the search `search_id`
+    is over, it gives up between stages and returns None.
+    """
+    import librosa
+
+    if _cancelled(search_id):
+        return None
+    # resample to BeatNet's sample rate
+    wav = librosa.resample(wav, orig_sr=sample_rate, target_sr=_beatnet.sample_rate)
+    if _cancelled(search_id):
+        return None
+    beats = _beatnet.process(wav)
+    if _cancelled(search_id):
+        return None
+    start_time, end_time = loop_points(beats)
+    if not end_time:
+        return None
+    # shift to start 0
+    if shift_to_start:
+        end_time = end_time - start_time
+        start_time = 0
+
+    num_beats = len(beats[(beats[:, 0] >= start_time) & (beats[:, 0] < end_time)])
+    duration = end_time - start_time
+    actual_bpm = num_beats / duration * 60
+    bpm_error = min(abs(actual_bpm - bpm), abs(actual_bpm / 2 - bpm), abs(actual_bpm * 2 - bpm))
+    # Allow octave errors
+    if abs(actual_bpm / 2 - bpm) <= OCTAVE_TOLERANCE:
+        actual_bpm = actual_bpm / 2
+    elif abs(actual_bpm * 2 - bpm) <= OCTAVE_TOLERANCE:
+        actual_bpm = actual_bpm * 2
+    return {
+        "start_time": float(start_time),
+        "end_time": float(end_time),
+        "actual_bpm": float(actual_bpm),
+        "bpm_error": float(bpm_error),
+        "matched": bpm_error <= BPM_TOLERANCE,
+        "beats": beats,
+    }
+
+
+def _fit(analysis):
+    # Closest tempo first, then the longest loop
+    return analysis["bpm_error"], analysis["start_time"] - analysis["end_time"]
+
+
+class LoopSearch:
+    """Finds the generated candidate that loops best at a requested tempo.
+
+    Beat tracking and loop-point extraction run on all candidates at once, one
+    per worker process, each with its own CPU BeatNet. The first candidate that
+    matches the tempo is returned without waiting for the others; otherwise
+    the one closest to the tempo, then the longest loop, wins. The analyses
+    of the others are then abandoned: queued ones are cancelled, and running
+    ones stop at their next stage, as BeatNet itself can't be interrupted.
+    Searches run one at a time.
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        # spawn, since the parent process holds a CUDA context
+        context = multiprocessing.get_context("spawn")
+        self.current_search = context.Value("q", 0, lock=False)
+        self.warm_barrier = context.Barrier(workers)
+        self.search_ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.pool = ProcessPoolExecutor(workers, mp_context=context, initializer=_init_worker,
+                                        initargs=(self.current_search, self.warm_barrier))
+
+    def warm(self):
+        """Start the workers and load their BeatNets before the first request."""
+        for future in [self.pool.submit(_ready, WARM_TIMEOUT) for _ in range(self.workers)]:
+            future.result()
+
+    def best(self, candidates, sample_rate, bpm, shift_to_start=False):
+        """(index, analysis) of the best candidate, or (None, None) when none of them has a loop."""
+        with self.lock:
+            search_id = next(self.search_ids)
+            self.current_search.value = search_id
+            try:
+                return self._search(candidates, sample_rate, bpm, shift_to_start, search_id)
+            finally:
+                # Whatever is still queued or running is no longer wanted
+                self.current_search.value = 0
+
+    def _search(self, candidates, sample_rate, bpm, shift_to_start, search_id):
+        pending = {self.pool.submit(analyze, wav, sample_rate, bpm, shift_to_start, search_id): idx
+                   for idx, wav in enumerate(candidates)}
+        best_idx, best = None, None
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                idx = pending.pop(future)
+                analysis = future.result()
+                if analysis is None:
+                    continue
+                print(f"Candidate {idx}: {analysis['actual_bpm']:.1f} bpm, "
+                      f"loop {analysis['start_time']:.2f}s-{analysis['end_time']:.2f}s")
+                if analysis["matched"]:
+                    for other in pending:
+                        other.cancel()
+                    return idx, analysis
+                if best is None or _fit(analysis) < _fit(best):
+                    best_idx, best = idx, analysis
+        return best_idx, best
+
+
+def from_env(candidates):
+    return LoopSearch(int(os.getenv("LOOP_SEARCH_WORKERS", str(min(candidates, os.cpu_count() or 1)))))
@@ -0,0 +1,208 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import requests
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class ModelFileCache:
+    """Content-addressed disk cache for downloaded LoRAs and checkpoints.
+
+    Files are streamed to disk in chunks while being hashed and stored once per
+    content hash under `blobs/`, so two URLs serving the same file share it;
+    `refs/` maps each URL to its blob. When the blobs outgrow `max_bytes` the
+    least recently used ones are deleted, together with the symlinks
+    `link_into` made to them, which `links/` records per blob. Concurrent
+    fetches of the same URL share one download.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.blob_dir = os.path.join(directory, "blobs")
+        self.ref_dir = os.path.join(directory, "refs")
+        self.link_dir = os.path.join(directory, "links")
+        os.makedirs(self.blob_dir, exist_ok=True)
+        os.makedirs(self.ref_dir, exist_ok=True)
+        os.makedirs(self.link_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        self.downloads = {}  # url -> Future of the blob path
+
+    def fetch(self, url, suffix=""):
+        """Local path of the file at `url`, downloading it unless it is cached."""
+        with self.lock:
+            path = self._lookup(url)
+            if path is not None:
+                return path
+            future = self.downloads.get(url)
+            is_owner = future is None
+            if is_owner:
+                future = self.downloads[url] = Future()
+        if not is_owner:
+            return future.result()
+
+        try:
+            path = self._download(url, suffix)
+            future.set_result(path)
+            return path
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.downloads[url]
+
+    def _ref_path(self, url):
+        return os.path.join(self.ref_dir, hashlib.sha256(url.encode("utf-8")).hexdigest())
+
+    def _lookup(self, url):
+        try:
+            with open(self._ref_path(url)) as f:
+                path = os.path.join(self.blob_dir, f.read().strip())
+            # Access time drives eviction
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def _download(self, url, suffix):
+        start_time = time.time()
+        digest = hashlib.sha256()
+        tmp_path = os.path.join(self.blob_dir, f".{threading.get_ident()}-{time.time_ns()}.tmp")
+        try:
+            with requests.get(url, stream=True, allow_redirects=True, timeout=60) as response:
+                response.raise_for_status()
+                with open(tmp_path, "wb") as f:
+                    for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                        digest.update(chunk)
+                        f.write(chunk)
+            blob_name = f"{digest.hexdigest()}{suffix}"
+            path = os.path.join(self.blob_dir, blob_name)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        ref_path = self._ref_path(url)
+        with open(f"{ref_path}.tmp", "w") as f:
+            f.write(blob_name)
+        os.replace(f"{ref_path}.tmp", ref_path)
+        print(f"Downloaded {url} ({os.path.getsize(path) / 1024 ** 2:.1f} MB) in {time.time() - start_time:.1f} seconds")
+
+        with self.lock:
+            self._evict(keep=path)
+        return path
+
+    def _evict(self, keep):
+        blobs = []
+        for entry in os.scandir(self.blob_dir):
+            if entry.is_file() and not entry.name.startswith("."):
+                stat = entry.stat()
+                blobs.append((stat.st_mtime, entry.path, stat.st_size))
+        total = sum(size for _, _, size in blobs)
+        # Refs to evicted blobs are left behind and simply miss on the next lookup
+        for _, path, size in sorted(blobs):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            os.remove(path)
+            self._unlink(path)
+            total -= size
+            print(f"Evicted {os.path.basename(path)} from the model cache")
+
+    def link_into(self, path, folder, filename):
+        """Expose a cached file under `folder/filename`, where tools that scan folders expect it.
+
+        The link is removed when the file is evicted, so the folder never holds dangling links.
+        """
+        path = os.path.abspath(path)
+        os.makedirs(folder, exist_ok=True)
+        link_path = os.path.abspath(os.path.join(folder, filename))
+        with self.lock:
+            if not (os.path.islink(link_path) and os.readlink(link_path) == path):
+                if os.path.lexists(link_path):
+                    os.remove(link_path)
+                os.symlink(path, link_path)
+            record = os.path.join(self.link_dir, os.path.basename(path))
+            links = self._links(record)
+            if link_path not in links:
+                with open(record, "a") as f:
+                    f.write(link_path + "\n")
+        return link_path
+
+    @staticmethod
+    def _links(record):
+        try:
+            with open(record) as f:
+                return f.read().splitlines()
+        except FileNotFoundError:
+            return []
+
+    def _unlink(self, path):
+        record = os.path.join(self.link_dir, os.path.basename(path))
+        for link_path in self._links(record):
+            # The link may since have been pointed at another file
+            if os.path.islink(link_path) and os.readlink(link_path) == path:
+                os.remove(link_path)
+        if os.path.exists(record):
+            os.remove(record)
+
+
+class LoraAdapters:
+    """Hot-swaps LoRA adapters on a diffusers pipeline without fusing them.
+
+    Each file is loaded into the pipeline once, as a named adapter, and requests
+    then only switch which adapters are active (`set_adapters`) or turn them
+    all off (`disable_lora`). At most `max_loaded` adapters stay loaded per
+    UNet; the least recently used ones are deleted.
+    """
+
+    def __init__(self, max_loaded=8):
+        self.max_loaded = max_loaded
+        self.loaded = {}  # id(unet) -> OrderedDict of adapter names, least recently used first
+
+    @staticmethod
+    def adapter_name(path):
+        return "lora_" + hashlib.sha256(os.path.basename(path).encode("utf-8")).hexdigest()[:16]
+
+    def activate(self, pipe, loras):
+        """Make exactly `loras`, a list of (path, weight), active on `pipe`."""
+        # Pipelines built from the same components share the UNet, and its adapters
+        loaded = self.loaded.setdefault(id(pipe.unet), OrderedDict())
+        if not loras:
+            if loaded:
+                pipe.disable_lora()
+            return
+
+        names = []
+        for path, _ in loras:
+            name = self.adapter_name(path)
+            if name not in loaded:
+                start_time = time.time()
+                pipe.load_lora_weights(path, adapter_name=name)
+                print(f"Loaded LoRA adapter {name} in {time.time() - start_time:.1f} seconds")
+            loaded[name] = None
+            loaded.move_to_end(name)
+            names.append(name)
+
+        stale = [name for name in list(loaded)[:-self.max_loaded] if name not in names]
+        if stale:
+            pipe.delete_adapters(stale)
+            for name in stale:
+                del loaded[name]
+
+        pipe.enable_lora()
+        pipe.set_adapters(names, adapter_weights=[weight for _, weight in loras])
+
+
+def from_env():
+    return ModelFileCache(
+        directory=os.getenv("MODEL_CACHE_DIR", "/tmp/model-cache"),
+        max_bytes=int(float(os.getenv("MODEL_CACHE_GB", "20")) * 1024 ** 3),
+    )
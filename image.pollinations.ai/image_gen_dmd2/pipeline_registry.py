@@ -0,0 +1,110 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import torch
+
+
+def module_bytes(module):
+    return sum(p.numel() * p.element_size() for p in module.parameters())
+
+
+class PipelineRegistry:
+    """Named pipelines, built on first use and kept resident under a GPU memory budget.
+
+    Factories are registered per model name and step count; `get` picks the
+    registered step count closest to the requested one, or builds a single
+    pipeline for models that work at any step count. Only UNets count
+    against `max_gpu_bytes`: when loading or reactivating a pipeline pushes the
+    resident UNets over budget, the least recently used ones are offloaded to
+    CPU memory and moved back on their next use. Components that don't change
+    between variants (VAEs, text encoders, tokenizers) are loaded once through
+    `shared` and handed to every factory that asks for them.
+    """
+
+    def __init__(self, device="cuda", max_gpu_bytes=12 * 1024 ** 3, default=None, offload_device="cpu"):
+        self.device = device
+        self.offload_device = offload_device
+        self.max_gpu_bytes = max_gpu_bytes
+        self.default = default
+        self.factories = {}  # name -> {steps: factory}
+        self.aliases = {}
+        self.pipes = OrderedDict()  # (name, steps) -> pipeline, least recently used first
+        self.shared_components = {}
+        self.lock = threading.RLock()
+
+    def register(self, name, factory, steps=None):
+        """`factory(steps)` builds the pipeline for one of the given step counts.
+
+        Without `steps`, one pipeline serves any step count and is built with `factory(None)`.
+        """
+        for step_count in steps or (None,):
+            self.factories.setdefault(name, {})[step_count] = factory
+
+    def alias(self, alias, name, steps=None):
+        self.aliases[alias] = (name, steps)
+
+    def shared(self, key, load):
+        """Component loaded once by `load()` and reused by every pipeline that asks for `key`."""
+        with self.lock:
+            if key not in self.shared_components:
+                self.shared_components[key] = load()
+            return self.shared_components[key]
+
+    def resolve(self, name, steps):
+        """Key of the registered pipeline that serves a request, and the step count to run it with."""
+        if name not in self.aliases and name not in self.factories:
+            print(f"Unknown model {name}, using {self.default}")
+            name = self.default
+        if name in self.aliases:
+            name, alias_steps = self.aliases[name]
+            steps = alias_steps or steps
+        registered = self.factories[name]
+        if None in registered:
+            return (name, None), steps
+        steps = min(registered, key=lambda step_count: (abs(step_count - steps), -step_count))
+        return (name, steps), steps
+
+    def get(self, name, steps):
+        """Return (pipeline, steps) for a request, loading or reactivating the pipeline as needed."""
+        key, steps = self.resolve(name, steps)
+        with self.lock:
+            pipe = self.pipes.get(key)
+            if pipe is None:
+                start_time = time.time()
+                pipe = self.factories[key[0]][key[1]](key[1])
+                print(f"Loaded pipeline {key} in {time.time() - start_time:.1f} seconds")
+                self.pipes[key] = pipe
+            elif not self.is_resident(pipe):
+                start_time = time.time()
+                pipe.unet.to(self.device)
+                print(f"Moved pipeline {key} back to {self.device} in {time.time() - start_time:.1f} seconds")
+            self.pipes.move_to_end(key)
+            self._enforce_budget()
+        return pipe, steps
+
+    def is_resident(self, pipe):
+        return next(pipe.unet.parameters()).device.type == torch.device(self.device).type
+
+    def resident_bytes(self):
+        return sum(module_bytes(pipe.unet) for pipe in self.pipes.values() if self.is_resident(pipe))
+
+    def _enforce_budget(self):
+        # Never offload the pipeline that was just requested, it's the last one
+        for key, pipe in list(self.pipes.items())[:-1]:
+            if self.resident_bytes() <= self.max_gpu_bytes:
+                break
+            if self.is_resident(pipe):
+                pipe.unet.to(self.offload_device)
+                print(f"Offloaded UNet of pipeline {key} to {self.offload_device}")
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+
+def from_env(device="cuda", default=None):
+    return PipelineRegistry(
+        device=device,
+        max_gpu_bytes=int(float(os.getenv("PIPELINE_GPU_BUDGET_GB", "12")) * 1024 ** 3),
+        default=default,
+    )
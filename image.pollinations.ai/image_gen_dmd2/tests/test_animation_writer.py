@@ -0,0 +1,53 @@
+import shutil
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from animation_writer import AnimationWriter, ping_pong
+
+pytestmark = pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="needs ffmpeg")
+
+WIDTH, HEIGHT = 16, 8
+# Copy the frames through unchanged, so the output can be compared byte for byte
+RAW_OUTPUT = ["-f", "rawvideo", "-pix_fmt", "rgb24"]
+
+
+def frame(value):
+    array = np.zeros((HEIGHT, WIDTH, 3), dtype=np.uint8)
+    array[..., 0] = value
+    array[:, : WIDTH // 2, 1] = np.arange(HEIGHT, dtype=np.uint8)[:, None]
+    return array
+
+
+def test_writes_array_and_image_frames(tmp_path):
+    path = str(tmp_path / "frames.rgb")
+    frames = [frame(10), Image.fromarray(frame(20)), frame(30).astype(np.int64),
+              np.asfortranarray(frame(40))]
+    with AnimationWriter(path, WIDTH, HEIGHT, fps=4, video_args=RAW_OUTPUT) as writer:
+        for item in frames:
+            writer.write(item)
+
+    expected = b"".join(frame(value).tobytes() for value in (10, 20, 30, 40))
+    with open(path, "rb") as f:
+        assert f.read() == expected
+
+
+def test_reused_frames_are_written_every_time(tmp_path):
+    path = str(tmp_path / "frames.rgb")
+    frames = [frame(value) for value in (10, 20, 30)]
+    with AnimationWriter(path, WIDTH, HEIGHT, fps=4, reuse_frames=True, video_args=RAW_OUTPUT) as writer:
+        for item in ping_pong(frames):
+            writer.write(item)
+
+    expected = b"".join(frame(value).tobytes() for value in (10, 20, 30, 20, 10))
+    with open(path, "rb") as f:
+        assert f.read() == expected
+
+
+def test_rejects_frames_of_the_wrong_shape(tmp_path):
+    writer = AnimationWriter(str(tmp_path / "frames.rgb"), WIDTH, HEIGHT, fps=4, video_args=RAW_OUTPUT)
+    # Same number of bytes, but transposed
+    writer.write(np.zeros((WIDTH, HEIGHT, 3), dtype=np.uint8))
+    with pytest.raises(RuntimeError, match=f"not {WIDTH}x{HEIGHT} RGB"):
+        writer.close()
@@ -0,0 +1,108 @@
+import threading
+import time
+
+import pytest
+
+from gpu_queue import DeadlineExceeded, GPUWorkQueue
+
+
+class StubRenderer:
+    """Records every batch; `gate`, when given, holds the first batch until it is set."""
+
+    def __init__(self, gate=None, fail_keys=()):
+        self.batches = []
+        self.gate = gate
+        self.fail_keys = fail_keys
+        self.started = threading.Event()
+
+    def __call__(self, key, payloads):
+        self.batches.append((key, list(payloads)))
+        self.started.set()
+        if self.gate is not None:
+            self.gate.wait(5)
+            self.gate = None
+        if key in self.fail_keys:
+            raise RuntimeError(f"render of {key} failed")
+        return [f"{key}:{payload}" for payload in payloads]
+
+
+def results(futures):
+    return [future.result(timeout=5) for future in futures]
+
+
+def blocked_queue(**queue_args):
+    """A queue whose worker is busy with a first batch until the returned gate is set."""
+    gate = threading.Event()
+    renderer = StubRenderer(gate=gate, **queue_args.pop("renderer_args", {}))
+    queue = GPUWorkQueue(renderer, max_wait_ms=0, **queue_args)
+    first = queue.submit("warm", ["first"])
+    assert renderer.started.wait(5)
+    return queue, renderer, gate, first
+
+
+def test_items_with_the_same_key_are_merged_into_one_batch():
+    queue, renderer, gate, first = blocked_queue(max_batch_size=3)
+    a = queue.submit("a", [1, 2])
+    b = queue.submit("b", [3])
+    a2 = queue.submit("a", [4, 5])
+    gate.set()
+
+    assert results(first) == ["warm:first"]
+    assert results(a) == ["a:1", "a:2"]
+    assert results(a2) == ["a:4", "a:5"]
+    assert results(b) == ["b:3"]
+    assert renderer.batches[1:] == [("a", [1, 2, 4]), ("b", [3]), ("a", [5])]
+
+
+def test_lower_priority_values_are_served_first():
+    queue, renderer, gate, first = blocked_queue(max_batch_size=1)
+    futures = {
+        "late": queue.submit("late", [0], priority=5),
+        "urgent": queue.submit("urgent", [0], priority=-1),
+        "normal": queue.submit("normal", [0]),
+        "normal2": queue.submit("normal2", [0]),
+    }
+    gate.set()
+    for future in futures.values():
+        results(future)
+
+    assert [key for key, _ in renderer.batches[1:]] == ["urgent", "normal", "normal2", "late"]
+
+
+def test_items_past_their_deadline_are_dropped_before_the_gpu():
+    queue, renderer, gate, first = blocked_queue()
+    expired = queue.submit("a", [1], timeout=0.01)
+    alive = queue.submit("b", [2], timeout=10)
+    time.sleep(0.05)
+    gate.set()
+
+    with pytest.raises(DeadlineExceeded):
+        expired[0].result(timeout=5)
+    assert results(alive) == ["b:2"]
+    assert all(key != "a" for key, _ in renderer.batches)
+
+
+def test_the_worker_survives_failing_batches_and_bad_priorities():
+    renderer = StubRenderer(fail_keys=("bad",))
+    queue = GPUWorkQueue(renderer, max_wait_ms=0)
+
+    with pytest.raises(TypeError):
+        queue.submit("a", [1], priority="high")
+    failed = queue.submit("bad", [1, 2])
+    for future in failed:
+        with pytest.raises(RuntimeError, match="render of bad failed"):
+            future.result(timeout=5)
+
+    assert results(queue.submit("a", [3], priority=1)) == ["a:3"]
+    assert queue.worker.is_alive()
+    assert queue.queue_depth() == 0
+
+
+def test_a_short_result_list_fails_the_batch():
+    queue = GPUWorkQueue(lambda key, payloads: payloads[:1], max_wait_ms=20)
+    futures = queue.submit("a", [1, 2])
+
+    for future in futures:
+        with pytest.raises(RuntimeError, match="1 results for 2 payloads"):
+            future.result(timeout=5)
+    assert results(queue.submit("a", [3])) == [3]
@@ -0,0 +1,114 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from model_cache import ModelFileCache
+
+LORA_BYTES = 64 * 1024
+
+
+def synthetic_lora(name):
+    """Bytes standing in for a LoRA file, distinct per name."""
+    header = f'{{"__metadata__":{{"name":"{name}"}}}}'.encode()
+    return (len(header).to_bytes(8, "little") + header).ljust(LORA_BYTES, b"\0")
+
+
+@pytest.fixture
+def lora_server():
+    """Serves /<name>.safetensors, counting requests per path and taking `delay` seconds for each."""
+    requests_seen = {}
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests_seen[self.path] = requests_seen.get(self.path, 0) + 1
+            time.sleep(server.delay)
+            body = synthetic_lora(self.path.strip("/").split(".")[0].split("-mirror")[0])
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.delay = 0
+    server.requests_seen = requests_seen
+    server.url = f"http://127.0.0.1:{server.server_address[1]}"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_concurrent_fetches_share_one_download(tmp_path, lora_server):
+    lora_server.delay = 0.2
+    cache = ModelFileCache(str(tmp_path / "cache"), max_bytes=10 * LORA_BYTES)
+    url = f"{lora_server.url}/style.safetensors"
+
+    with ThreadPoolExecutor(8) as pool:
+        paths = list(pool.map(lambda _: cache.fetch(url, suffix=".safetensors"), range(8)))
+
+    assert lora_server.requests_seen == {"/style.safetensors": 1}
+    assert len(set(paths)) == 1
+    with open(paths[0], "rb") as f:
+        assert f.read() == synthetic_lora("style")
+    # Later fetches are served from disk
+    assert cache.fetch(url, suffix=".safetensors") == paths[0]
+    assert lora_server.requests_seen == {"/style.safetensors": 1}
+
+
+def test_identical_files_share_one_blob(tmp_path, lora_server):
+    cache = ModelFileCache(str(tmp_path / "cache"), max_bytes=10 * LORA_BYTES)
+
+    first = cache.fetch(f"{lora_server.url}/style.safetensors")
+    second = cache.fetch(f"{lora_server.url}/style-mirror.safetensors")
+
+    assert first == second
+    assert len(os.listdir(cache.blob_dir)) == 1
+
+
+def test_least_recently_used_blob_is_evicted_with_its_links(tmp_path, lora_server):
+    cache = ModelFileCache(str(tmp_path / "cache"), max_bytes=int(2.5 * LORA_BYTES))
+    lora_dir = str(tmp_path / "models" / "Lora")
+    urls = {name: f"{lora_server.url}/{name}.safetensors" for name in ("a", "b", "c")}
+
+    links = {}
+    for name in ("a", "b"):
+        links[name] = cache.link_into(cache.fetch(urls[name]), lora_dir, f"{name}.safetensors")
+        time.sleep(0.01)
+    # Using "a" again makes "b" the least recently used
+    cache.fetch(urls["a"])
+    time.sleep(0.01)
+    links["c"] = cache.link_into(cache.fetch(urls["c"]), lora_dir, "c.safetensors")
+
+    assert len(os.listdir(cache.blob_dir)) == 2
+    assert sorted(os.listdir(lora_dir)) == ["a.safetensors", "c.safetensors"]
+    for name in ("a", "c"):
+        with open(links[name], "rb") as f:
+            assert f.read() == synthetic_lora(name)
+
+    # The evicted file is downloaded again, and linked again, on its next use
+    link = cache.link_into(cache.fetch(urls["b"]), lora_dir, "b.safetensors")
+    assert lora_server.requests_seen["/b.safetensors"] == 2
+    with open(link, "rb") as f:
+        assert f.read() == synthetic_lora("b")
+    assert all(os.path.exists(os.path.join(lora_dir, name)) for name in os.listdir(lora_dir))
+
+
+def test_relinked_name_survives_eviction_of_its_old_target(tmp_path, lora_server):
+    cache = ModelFileCache(str(tmp_path / "cache"), max_bytes=int(1.5 * LORA_BYTES))
+    lora_dir = str(tmp_path / "models" / "Lora")
+
+    cache.link_into(cache.fetch(f"{lora_server.url}/old.safetensors"), lora_dir, "style.safetensors")
+    time.sleep(0.01)
+    # The same name now points at a new file, and fetching it evicts the old one
+    link = cache.link_into(cache.fetch(f"{lora_server.url}/new.safetensors"), lora_dir, "style.safetensors")
+
+    with open(link, "rb") as f:
+        assert f.read() == synthetic_lora("new")
@@ -0,0 +1,74 @@
+import math
+
+import numpy as np
+import pytest
+import torch
+
+from trajectory import keyframe_path, slerp, slerp_path
+
+
+def numpy_slerp(t, v0, v1, DOT_THRESHOLD=0.9995, nonlinear=False):
+    """The per-frame numpy slerp the predictors used before trajectory.py."""
+    if nonlinear:
+        t = 1 - math.exp(-t * 8)
+    v0 = v0.cpu().numpy()
+    v1 = v1.cpu().numpy()
+    dot = np.sum(v0 * v1 / (np.linalg.norm(v0) * np.linalg.norm(v1)))
+    if np.abs(dot) > DOT_THRESHOLD:
+        v2 = (1 - t) * v0 + t * v1
+    else:
+        theta_0 = np.arccos(dot)
+        sin_theta_0 = np.sin(theta_0)
+        theta_t = theta_0 * t
+        s0 = np.sin(theta_0 - theta_t) / sin_theta_0
+        s1 = np.sin(theta_t) / sin_theta_0
+        v2 = s0 * v0 + s1 * v1
+    return torch.from_numpy(v2)
+
+
+def random_tensors(count, shape, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    return [torch.randn(*shape, generator=generator) for _ in range(count)]
+
+
+T = [0.0, 0.1, 0.25, 0.5, 0.9, 1.0]
+
+
+@pytest.mark.parametrize("nonlinear", [False, True])
+def test_slerp_path_matches_numpy_slerp(nonlinear):
+    v0, v1 = random_tensors(2, (1, 4, 8, 8))
+    path = slerp_path(T, v0, v1, nonlinear=nonlinear)
+
+    assert len(path) == len(T)
+    expected = torch.stack([numpy_slerp(t, v0, v1, nonlinear=nonlinear) for t in T])
+    torch.testing.assert_close(path.stack(), expected, rtol=1e-4, atol=1e-5)
+    torch.testing.assert_close(slerp(0.25, v0, v1, nonlinear=nonlinear), expected[2], rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.parametrize("scale", [2.0, -0.5])
+def test_colinear_endpoints_fall_back_to_linear(scale):
+    [v0] = random_tensors(1, (1, 4, 8, 8))
+    v1 = v0 * scale
+    path = slerp_path(T, v0, v1)
+
+    expected = torch.stack([numpy_slerp(t, v0, v1) for t in T])
+    torch.testing.assert_close(path.stack(), expected, rtol=1e-4, atol=1e-5)
+    assert torch.isfinite(path.stack()).all()
+    torch.testing.assert_close(path[3], (v0 + v1) / 2)
+
+
+def test_keyframe_path_cat_keeps_the_old_frame_order():
+    keyframes = random_tensors(4, (1, 77, 32), seed=1)
+    steps = 5
+    path = keyframe_path(keyframes, steps, nonlinear=True)
+
+    # The frames the predictor used to build one by one and torch.cat in batches
+    interpolated = [numpy_slerp(float(t), a, b, nonlinear=True)
+                    for a, b in zip(keyframes, keyframes[1:]) for t in np.linspace(0, 1, steps)]
+    assert len(path) == len(interpolated) == 3 * steps
+    for start in range(0, len(path), 4):
+        torch.testing.assert_close(path.cat(start, start + 4), torch.cat(interpolated[start:start + 4]),
+                                   rtol=1e-4, atol=1e-5)
+    # Each segment starts exactly on its keyframe
+    for segment, keyframe in enumerate(keyframes[:-1]):
+        torch.testing.assert_close(path[segment * steps], keyframe)
@@ -0,0 +1,90 @@
+import torch
+
+DOT_THRESHOLD = 0.9995
+
+
+def ease_out(t):
+    """Goes from 0 to 1, growing quickly and then slowing down."""
+    return 1 - torch.exp(-t * 8)
+
+
+def slerp_coefficients(t, v0, v1, segment, dot_threshold=DOT_THRESHOLD, nonlinear=False):
+    """Weights (s0, s1) so that s0[i] * v0[segment[i]] + s1[i] * v1[segment[i]] is the slerp at t[i].
+
+    `v0` and `v1` hold pairs of endpoints along their first dimension; angles
+    are computed once per pair. Pairs that are nearly colinear
+    (|cos| > dot_threshold) fall back to linear interpolation. Everything stays
+    on the endpoints' device, with no synchronization, so thousands of frames
+    cost a handful of kernels.
+    """
+    t = torch.as_tensor(t, dtype=torch.float32, device=v0.device).reshape(-1)
+    if nonlinear:
+        t = ease_out(t)
+    a = v0.reshape(v0.shape[0], -1).float()
+    b = v1.reshape(v1.shape[0], -1).float()
+    dot = (a * b).sum(dim=1) / (torch.linalg.vector_norm(a, dim=1) * torch.linalg.vector_norm(b, dim=1))
+    dot = dot[segment]
+    theta_0 = torch.arccos(dot.clamp(-1, 1))
+    sin_theta_0 = torch.sin(theta_0)
+    theta_t = theta_0 * t
+    linear = dot.abs() > dot_threshold
+    s0 = torch.where(linear, 1 - t, torch.sin(theta_0 - theta_t) / sin_theta_0)
+    s1 = torch.where(linear, t, torch.sin(theta_t) / sin_theta_0)
+    return s0, s1
+
+
+class Trajectory:
+    """Frames along slerp paths between consecutive keyframes.
+
+    Each frame is stored as its row of weights over the keyframes, two of them
+    non-zero; a slice of frames is materialized with one matmul on the
+    keyframes' device, so a schedule of thousands of conditionings or start
+    codes never holds them all in memory or round-trips through the host.
+    """
+
+    def __init__(self, keyframes, segment, t, dot_threshold=DOT_THRESHOLD, nonlinear=False):
+        self.keyframes = keyframes
+        segment = torch.as_tensor(segment, dtype=torch.long, device=keyframes.device)
+        s0, s1 = slerp_coefficients(t, keyframes[:-1], keyframes[1:], segment, dot_threshold, nonlinear)
+        frames = torch.arange(segment.shape[0], device=keyframes.device)
+        self.weights = torch.zeros(segment.shape[0], keyframes.shape[0], device=keyframes.device)
+        self.weights.index_put_((frames, segment), s0, accumulate=True)
+        self.weights.index_put_((frames, segment + 1), s1, accumulate=True)
+        self._flat = keyframes.reshape(keyframes.shape[0], -1).float()
+
+    def __len__(self):
+        return self.weights.shape[0]
+
+    def stack(self, start=0, stop=None):
+        """Frames start..stop stacked along a new first dimension."""
+        frames = self.weights[start:stop] @ self._flat
+        return frames.view(-1, *self.keyframes.shape[1:]).to(self.keyframes.dtype)
+
+    def cat(self, start=0, stop=None):
+        """Frames start..stop concatenated along their first dimension, like torch.cat of single frames."""
+        return self.stack(start, stop).flatten(0, 1)
+
+    def __getitem__(self, index):
+        return self.stack(index, index + 1)[0]
+
+
+def slerp_path(t, v0, v1, dot_threshold=DOT_THRESHOLD, nonlinear=False):
+    """The slerp from `v0` to `v1` at every value of `t`."""
+    t = torch.as_tensor(t, dtype=torch.float32, device=v0.device).reshape(-1)
+    segment = torch.zeros(t.shape[0], dtype=torch.long, device=v0.device)
+    return Trajectory(torch.stack([v0, v1]), segment, t, dot_threshold, nonlinear)
+
+
+def keyframe_path(keyframes, steps_per_segment, dot_threshold=DOT_THRESHOLD, nonlinear=False):
+    """`steps_per_segment` frames from each keyframe to the next, both ends included."""
+    keyframes = torch.stack(list(keyframes)) if isinstance(keyframes, (list, tuple)) else keyframes
+    device = keyframes.device
+    segments = keyframes.shape[0] - 1
+    t = torch.linspace(0, 1, steps_per_segment, device=device).repeat(segments)
+    segment = torch.arange(segments, device=device).repeat_interleave(steps_per_segment)
+    return Trajectory(keyframes, segment, t, dot_threshold, nonlinear)
+
+
+def slerp(t, v0, v1, DOT_THRESHOLD=DOT_THRESHOLD, nonlinear=False):
+    """Spherical interpolation of two tensors at a single `t`, on their device."""
+    return slerp_path(t, v0, v1, DOT_THRESHOLD, nonlinear)[0]
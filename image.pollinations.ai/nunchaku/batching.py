@@ -0,0 +1,201 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Hashable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class BatchItem:
+    key: Hashable
+    payload: Any
+    future: asyncio.Future
+    enqueued_at: float = field(default_factory=time.monotonic)
+
+
+class MicroBatcher:
+    """Groups concurrent requests into batches that share a bucket key.
+
+    `process_batch(key, payloads)` is called with up to `max_batch_size` payloads
+    that all share the same key and must return one result per payload, in order.
+    A bucket is flushed as soon as it is full or its oldest item has waited
+    `max_wait_ms`. Results (or the raised exception) are fanned back to the
+    coroutines waiting in `submit`.
+
+    If `postprocess(key, payloads, output)` is given, `process_batch` only runs the
+    GPU stage and its output is handed to `postprocess` in a background task, so
+    the next batch starts rendering while the previous one is still being
+    post-processed. At most `max_postprocess_batches` batches are post-processed
+    at once; beyond that the GPU stage waits.
+
+    With `metrics`, each item's time in the queue is observed as "queue_wait".
+    """
+
+    def __init__(self, process_batch: Callable, max_batch_size: int = 4, max_wait_ms: float = 20,
+                 postprocess: Optional[Callable] = None, max_postprocess_batches: int = 2,
+                 metrics: Optional[Any] = None):
+        self.process_batch = process_batch
+        self.metrics = metrics
+        self.postprocess = postprocess
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, max_wait_ms / 1000)
+        self._pending: Dict[Hashable, List[BatchItem]] = {}
+        self._wakeup = asyncio.Event()
+        self._worker = None
+        self._postprocess_slots = asyncio.Semaphore(max(1, max_postprocess_batches))
+        self._postprocess_tasks = set()
+        # Accumulated seconds spent per stage, for logging and metrics
+        self.stage_seconds = {"queue": 0.0, "gpu": 0.0, "postprocess": 0.0}
+        self.batches_processed = 0
+
+    def start(self):
+        if self._worker is None:
+            self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._worker is None:
+            return
+        self._worker.cancel()
+        try:
+            await self._worker
+        except asyncio.CancelledError:
+            pass
+        self._worker = None
+        # Batches still being post-processed cancel their own futures
+        tasks = list(self._postprocess_tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for items in self._pending.values():
+            self._cancel(items)
+        self._pending.clear()
+
+    def queue_depth(self) -> int:
+        return sum(len(items) for items in self._pending.values())
+
+    async def submit(self, key: Hashable, payload: Any) -> Any:
+        future = asyncio.get_running_loop().create_future()
+        self._pending.setdefault(key, []).append(BatchItem(key, payload, future))
+        self._wakeup.set()
+        return await future
+
+    def _next_ready(self):
+        """Returns (key, seconds until that bucket must be flushed) for the most urgent bucket."""
+        now = time.monotonic()
+        best_key, best_deadline = None, None
+        for key, items in self._pending.items():
+            deadline = now if len(items) >= self.max_batch_size else items[0].enqueued_at + self.max_wait
+            if best_deadline is None or deadline < best_deadline:
+                best_key, best_deadline = key, deadline
+        return best_key, max(0.0, best_deadline - now)
+
+    def _take(self, key: Hashable) -> List[BatchItem]:
+        items = self._pending.pop(key)
+        batch, rest = items[:self.max_batch_size], items[self.max_batch_size:]
+        if rest:
+            self._pending[key] = rest
+        # Requests whose client went away are dropped before they reach the GPU
+        return [item for item in batch if not item.future.done()]
+
+    async def _run(self):
+        while True:
+            if not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            key, timeout = self._next_ready()
+            if timeout > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            batch = self._take(key)
+            if batch:
+                await self._dispatch(key, batch)
+
+    async def _dispatch(self, key: Hashable, batch: List[BatchItem]):
+        started = time.monotonic()
+        queue_seconds = started - batch[0].enqueued_at
+        if self.metrics is not None:
+            for item in batch:
+                self.metrics.observe("queue_wait", started - item.enqueued_at)
+        try:
+            output = await _maybe_await(self.process_batch(key, [item.payload for item in batch]))
+        except asyncio.CancelledError:
+            self._cancel(batch)
+            raise
+        except Exception as e:
+            self._fail(batch, e)
+            return
+        gpu_seconds = time.monotonic() - started
+
+        if self.postprocess is None:
+            self._resolve(batch, output)
+            self._record(key, batch, queue_seconds, gpu_seconds, 0.0)
+            return
+
+        try:
+            await self._postprocess_slots.acquire()
+        except asyncio.CancelledError:
+            self._cancel(batch)
+            raise
+        task = asyncio.create_task(self._run_postprocess(key, batch, output, queue_seconds, gpu_seconds))
+        self._postprocess_tasks.add(task)
+        task.add_done_callback(self._postprocess_tasks.discard)
+
+    async def _run_postprocess(self, key: Hashable, batch: List[BatchItem], output: Any,
+                               queue_seconds: float, gpu_seconds: float):
+        started = time.monotonic()
+        try:
+            results = await _maybe_await(self.postprocess(key, [item.payload for item in batch], output))
+        except asyncio.CancelledError:
+            self._cancel(batch)
+            raise
+        except Exception as e:
+            self._fail(batch, e)
+            return
+        finally:
+            self._postprocess_slots.release()
+        self._resolve(batch, results)
+        self._record(key, batch, queue_seconds, gpu_seconds, time.monotonic() - started)
+
+    def _record(self, key: Hashable, batch: List[BatchItem], queue_seconds: float, gpu_seconds: float,
+                postprocess_seconds: float):
+        self.stage_seconds["queue"] += queue_seconds
+        self.stage_seconds["gpu"] += gpu_seconds
+        self.stage_seconds["postprocess"] += postprocess_seconds
+        self.batches_processed += 1
+        logger.info(
+            f"Batch of {len(batch)} for bucket {key}: queue {queue_seconds * 1000:.0f}ms, "
+            f"gpu {gpu_seconds * 1000:.0f}ms, postprocess {postprocess_seconds * 1000:.0f}ms"
+        )
+
+    @staticmethod
+    def _resolve(batch: List[BatchItem], results: List[Any]):
+        for item, result in zip(batch, results):
+            if not item.future.done():
+                item.future.set_result(result)
+
+    @staticmethod
+    def _fail(batch: List[BatchItem], error: Exception):
+        for item in batch:
+            if not item.future.done():
+                item.future.set_exception(error)
+
+    @staticmethod
+    def _cancel(batch: List[BatchItem]):
+        for item in batch:
+            if not item.future.done():
+                item.future.cancel()
+
+
+async def _maybe_await(value):
+    if asyncio.iscoroutine(value):
+        return await value
+    return value
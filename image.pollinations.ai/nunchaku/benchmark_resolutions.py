@@ -0,0 +1,82 @@
+"""Checks ResolutionIndex against the spiral search it replaced and times both.
+
+Run with:
+    python benchmark_resolutions.py
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server_common"))
+from resolutions import FLUX_MAX_PIXELS, FLUX_RESOLUTIONS
+
+
+def spiral_search(width: float, height: float) -> tuple[int, int]:
+    """The previous find_nearest_valid_dimensions from server.py, verbatim apart from the name."""
+    MAX_PIXELS = FLUX_MAX_PIXELS
+    start_w = round(width)
+    start_h = round(height)
+
+    current_pixels = start_w * start_h
+    if current_pixels > MAX_PIXELS:
+        scale = (MAX_PIXELS / current_pixels) ** 0.5
+        start_w = round(start_w * scale)
+        start_h = round(start_h * scale)
+
+    def is_valid(w: int, h: int) -> bool:
+        return w % 8 == 0 and h % 8 == 0 and (w * h) % 65536 == 0
+
+    nearest_w = round(start_w / 8) * 8
+    nearest_h = round(start_h / 8) * 8
+
+    offset = 0
+    while offset < 100:
+        for w in range(nearest_w - offset * 8, nearest_w + offset * 8 + 1, 8):
+            if w <= 0:
+                continue
+            for h in range(nearest_h - offset * 8, nearest_h + offset * 8 + 1, 8):
+                if h <= 0:
+                    continue
+                if is_valid(w, h):
+                    return w, h
+        offset += 1
+
+    return nearest_w, nearest_h
+
+
+def sizes():
+    # Sizes up to 2048x2048 on a grid coprime with 8, plus random and degenerate requests
+    grid = [(w, h) for w in range(1, 2049, 13) for h in range(1, 2049, 13)]
+    rng = random.Random(0)
+    floats = [(rng.uniform(1, 4096), rng.uniform(1, 4096)) for _ in range(20000)]
+    extremes = [(rng.randint(1, 100000), rng.randint(1, 16)) for _ in range(2000)]
+    extremes += [(h, w) for w, h in extremes] + [(0, 0), (0, 512), (3, 3), (100000, 100000)]
+    return grid + floats + extremes
+
+
+def main():
+    requests = sizes()
+
+    start = time.perf_counter()
+    expected = [spiral_search(w, h) for w, h in requests]
+    spiral_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    actual = [FLUX_RESOLUTIONS.snap(w, h) for w, h in requests]
+    index_time = time.perf_counter() - start
+
+    mismatches = [(r, e, a) for r, e, a in zip(requests, expected, actual) if e != a]
+    for request, e, a in mismatches[:10]:
+        print(f"Mismatch for {request}: spiral {e}, index {a}")
+
+    count = len(requests)
+    print(f"{count} sizes, {len(mismatches)} mismatches")
+    print(f"spiral search: {spiral_time / count * 1e6:.1f} us per call")
+    print(f"resolution index: {index_time / count * 1e6:.1f} us per call")
+    if mismatches:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+import asyncio
+import logging
+import os
+from typing import Any, Callable, Dict, Optional
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+REGISTER_URL = "https://image.pollinations.ai/register"
+PUBLIC_IP_URL = "https://api.ipify.org"
+
+
+class HeartbeatClient:
+    """Registers this worker with the image registry and keeps the registration fresh.
+
+    One pooled session is used for the lifetime of the server and the public IP
+    is resolved once. `notify()` never blocks the caller: it schedules a send
+    in the background, and while one is in flight further notifications are
+    coalesced into a single follow-up send. Each heartbeat carries the load
+    reported by `load_fn` so the registry can route by it.
+    """
+
+    def __init__(self, port: int, service_type: str = "flux", public_ip: Optional[str] = None,
+                 register_url: str = REGISTER_URL, public_ip_url: str = PUBLIC_IP_URL,
+                 interval_seconds: float = 30, timeout_seconds: float = 10,
+                 load_fn: Optional[Callable[[], Dict[str, Any]]] = None):
+        self.port = port
+        self.service_type = service_type
+        self.public_ip = public_ip
+        self.register_url = register_url
+        self.public_ip_url = public_ip_url
+        self.interval_seconds = interval_seconds
+        self.timeout = aiohttp.ClientTimeout(total=timeout_seconds)
+        self.load_fn = load_fn
+        self.session: Optional[aiohttp.ClientSession] = None
+        self._in_flight: Optional[asyncio.Task] = None
+        self._pending = False
+        self._periodic: Optional[asyncio.Task] = None
+        self.sent = 0
+        self.failed = 0
+
+    async def start(self):
+        """Open the session, send the first heartbeat and start the periodic one."""
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                timeout=self.timeout, connector=aiohttp.TCPConnector(limit=2, keepalive_timeout=60)
+            )
+        await self.send()
+        if self._periodic is None:
+            self._periodic = asyncio.create_task(self._run_periodic())
+
+    async def stop(self):
+        for task in (self._periodic, self._in_flight):
+            if task is not None:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._periodic = None
+        self._in_flight = None
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def notify(self):
+        """Schedule a heartbeat without waiting for it."""
+        if self.session is None:
+            return
+        if self._in_flight is not None and not self._in_flight.done():
+            self._pending = True
+            return
+        self._in_flight = asyncio.create_task(self._send_coalesced())
+
+    async def _send_coalesced(self):
+        await self.send()
+        while self._pending:
+            self._pending = False
+            await self.send()
+
+    async def _run_periodic(self):
+        while True:
+            await asyncio.sleep(self.interval_seconds)
+            self.notify()
+
+    async def _resolve_public_ip(self) -> Optional[str]:
+        if self.public_ip is None:
+            try:
+                async with self.session.get(self.public_ip_url) as response:
+                    response.raise_for_status()
+                    self.public_ip = (await response.text()).strip()
+                logger.info(f"Resolved public IP {self.public_ip}")
+            except Exception as e:
+                # Not cached, so the next heartbeat tries again
+                logger.error(f"Error resolving public IP: {str(e)}")
+        return self.public_ip
+
+    def payload(self, public_ip: str) -> Dict[str, Any]:
+        payload = {"url": f"http://{public_ip}:{self.port}", "type": self.service_type}
+        if self.load_fn is not None:
+            try:
+                payload["load"] = self.load_fn()
+            except Exception as e:
+                logger.error(f"Error collecting load for heartbeat: {str(e)}")
+        return payload
+
+    async def send(self) -> bool:
+        public_ip = await self._resolve_public_ip()
+        if not public_ip:
+            self.failed += 1
+            return False
+        payload = self.payload(public_ip)
+        try:
+            async with self.session.post(self.register_url, json=payload) as response:
+                await response.read()
+                if response.status == 200:
+                    self.sent += 1
+                    logger.debug(f"Heartbeat sent successfully. URL: {payload['url']}")
+                    return True
+                logger.error(f"Failed to send heartbeat. Status code: {response.status}")
+        except Exception as e:
+            logger.error(f"Error sending heartbeat: {str(e)}")
+        self.failed += 1
+        return False
+
+
+def from_env(load_fn: Optional[Callable[[], Dict[str, Any]]] = None) -> HeartbeatClient:
+    # PUBLIC_PORT is the port the registry should use, when it differs from the one we listen on
+    port = int(os.getenv("PUBLIC_PORT") or os.getenv("PORT", "10001"))
+    return HeartbeatClient(
+        port=port,
+        service_type=os.getenv("SERVICE_TYPE", "flux"),
+        public_ip=os.getenv("PUBLIC_IP") or None,
+        register_url=os.getenv("REGISTER_URL", REGISTER_URL),
+        interval_seconds=float(os.getenv("HEARTBEAT_INTERVAL", "30")),
+        load_fn=load_fn,
+    )
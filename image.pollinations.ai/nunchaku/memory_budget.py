@@ -0,0 +1,143 @@
+import gc
+import logging
+import os
+import threading
+from typing import Any, Callable, List, Tuple
+
+import torch
+
+from resolutions import ResolutionIndex
+
+logger = logging.getLogger(__name__)
+
+
+def free_cuda_memory():
+    """Drop unreferenced tensors and return cached blocks to the driver after an OOM."""
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+class MemoryBudget:
+    """Largest render the GPU is trusted with, lowered whenever a CUDA OOM is observed.
+
+    An OOM in a batch of several images halves `max_batch_size`; an OOM rendering
+    a single image lowers `max_pixels` by `pixel_step`, down to `min_pixels`.
+    After `recover_after` successful renders in a row the budget takes one step
+    back up towards its configured ceiling. `consecutive_ooms` counts failures
+    with no success in between, which is what decides whether a restart is the
+    only way out.
+
+    `render` runs a batch through this recovery. `inject_oom(count)` (or
+    FAULT_INJECT_OOM) makes its next `count` render calls raise an OOM, so the
+    recovery path can be exercised without a GPU.
+    """
+
+    def __init__(self, max_pixels: int, max_batch_size: int, min_pixels: int = 256 * 256,
+                 pixel_step: float = 0.75, recover_after: int = 200, max_consecutive_ooms: int = 3,
+                 multiple: int = 8, area_multiple: int = 65536):
+        self.ceiling_pixels = max_pixels
+        self.ceiling_batch_size = max_batch_size
+        self.min_pixels = min_pixels
+        self.pixel_step = pixel_step
+        self.recover_after = recover_after
+        self.max_consecutive_ooms = max_consecutive_ooms
+        self.resolutions = ResolutionIndex(multiple=multiple, area_multiple=area_multiple, max_pixels=max_pixels)
+        self.max_batch_size = max_batch_size
+        self.consecutive_ooms = 0
+        self.total_ooms = 0
+        self._successes = 0
+        self._injected_ooms = 0
+        self._lock = threading.Lock()
+
+    @property
+    def max_pixels(self) -> int:
+        return self.resolutions.max_pixels
+
+    def snap(self, width: float, height: float) -> Tuple[int, int]:
+        """Nearest valid size within the current pixel budget."""
+        size = nearest = self.resolutions.snap(width, height)
+        # Valid sizes are sparse, so the nearest one can be larger than the budget
+        scale = 1.0
+        for _ in range(50):
+            if size[0] * size[1] <= self.max_pixels:
+                break
+            scale *= 0.95
+            size = self.resolutions.snap(nearest[0] * scale, nearest[1] * scale)
+        return size
+
+    def record_oom(self, pixels: int, batch_size: int):
+        with self._lock:
+            self.consecutive_ooms += 1
+            self.total_ooms += 1
+            self._successes = 0
+            if batch_size > 1:
+                self.max_batch_size = max(1, min(self.max_batch_size, batch_size // 2))
+            else:
+                self.resolutions.max_pixels = max(self.min_pixels, int(min(self.max_pixels, pixels) * self.pixel_step))
+        logger.warning(f"CUDA OOM at {pixels} pixels x {batch_size}; budget now {self.max_pixels} pixels, "
+                       f"batches of {self.max_batch_size} ({self.consecutive_ooms} in a row)")
+
+    def record_success(self):
+        with self._lock:
+            self.consecutive_ooms = 0
+            self._successes += 1
+            if self._successes < self.recover_after:
+                return
+            self._successes = 0
+            if self.max_pixels < self.ceiling_pixels:
+                self.resolutions.max_pixels = min(self.ceiling_pixels, int(self.max_pixels / self.pixel_step))
+            elif self.max_batch_size < self.ceiling_batch_size:
+                self.max_batch_size = min(self.ceiling_batch_size, self.max_batch_size * 2)
+            else:
+                return
+        logger.info(f"Raised memory budget to {self.max_pixels} pixels, batches of {self.max_batch_size}")
+
+    def render(self, render_batch: Callable[[Tuple[int, int, int], List[Any]], list],
+               bucket: Tuple[int, int, int], payloads: List[Any]) -> list:
+        """`render_batch(bucket, payloads)`; after a CUDA OOM, free memory, shrink the budget and retry once.
+
+        The retry renders a batch one image at a time, and a single image at the
+        largest size the lowered budget allows. A second OOM is left to the caller.
+        """
+        width, height, steps = bucket
+        try:
+            self.maybe_inject_oom()
+            images = render_batch(bucket, payloads)
+        except torch.cuda.OutOfMemoryError as e:
+            logger.error(f"CUDA OOM Error: {str(e)} - retrying")
+            free_cuda_memory()
+            self.record_oom(width * height, len(payloads))
+            if len(payloads) == 1:
+                bucket = (*self.snap(width, height), steps)
+            images = []
+            for payload in payloads:
+                self.maybe_inject_oom()
+                images.extend(render_batch(bucket, [payload]))
+        self.record_success()
+        return images
+
+    def should_restart(self) -> bool:
+        return self.consecutive_ooms >= self.max_consecutive_ooms
+
+    def inject_oom(self, count: int = 1):
+        with self._lock:
+            self._injected_ooms += count
+
+    def maybe_inject_oom(self):
+        with self._lock:
+            if self._injected_ooms <= 0:
+                return
+            self._injected_ooms -= 1
+        raise torch.cuda.OutOfMemoryError("CUDA out of memory (injected fault)")
+
+
+def from_env(max_pixels: int, max_batch_size: int) -> MemoryBudget:
+    budget = MemoryBudget(
+        max_pixels=max_pixels,
+        max_batch_size=max_batch_size,
+        min_pixels=int(os.getenv("MIN_PIXELS", str(256 * 256))),
+        max_consecutive_ooms=int(os.getenv("MAX_CONSECUTIVE_OOMS", "3")),
+    )
+    budget.inject_oom(int(os.getenv("FAULT_INJECT_OOM", "0")))
+    return budget
@@ -1,6 +1,5 @@
 import modal
 import os
-import httpx
 
 # Create a Modal app
 app = modal.App("flux-svdquant-service")
@@ -9,6 +8,7 @@ app = modal.App("flux-svdquant-service")
 image = (
     modal.Image.from_registry("voodoohop/flux-svdquant:modal-v1")
     .pip_install("httpx")  # Install httpx for proxying requests
+    .add_local_python_source("streaming_proxy")
 )
 
 @app.function(
@@ -57,40 +57,10 @@ def web_app():
 )
 @modal.asgi_app()
 def proxy_app():
-    from fastapi import FastAPI, Request
-    from fastapi.responses import StreamingResponse
-    import asyncio
+    from streaming_proxy import from_env as proxy_from_env
 
-    app = FastAPI()
-    
-    @app.api_route("/{path:path}", methods=["GET", "POST", "PUT", "DELETE"])
-    async def proxy(request: Request, path: str):
-        # Forward request to the internal service
-        url = f"http://localhost:8000/{path}"
-        
-        # Wait a bit for the internal service to start
-        for _ in range(5):
-            try:
-                async with httpx.AsyncClient() as client:
-                    # Forward the request with the same method, headers, and body
-                    response = await client.request(
-                        method=request.method,
-                        url=url,
-                        headers=dict(request.headers),
-                        content=await request.body()
-                    )
-                    return StreamingResponse(
-                        response.aiter_bytes(),
-                        status_code=response.status_code,
-                        headers=dict(response.headers)
-                    )
-            except httpx.ConnectError:
-                await asyncio.sleep(1)
-                continue
-        
-        return {"error": "Internal service not available"}
-
-    return app
+    # One pooled client and concurrency limit for the container's lifetime
+    return proxy_from_env().create_app()
 
 if __name__ == "__main__":
     web_app.spawn()  # Start the server in the background
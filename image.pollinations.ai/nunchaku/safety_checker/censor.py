@@ -1,4 +1,8 @@
-import os.path
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
 
 # import gradio as gr
 import numpy as np
@@ -31,8 +35,122 @@ def numpy_to_pil(images):
     return pil_images
 
 
+def to_pil_images(x_image):
+    if isinstance(x_image, np.ndarray) or not isinstance(x_image[0], Image.Image):
+        return numpy_to_pil(np.asarray(x_image))
+    return list(x_image)
+
+
+def perceptual_hash(image) -> int:
+    """64-bit difference hash: robust to re-encoding and small resizes."""
+    pixels = np.asarray(image.convert("L").resize((9, 8), Image.BILINEAR), dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int(np.packbits(bits).view(">u8")[0])
+
+
+class SafetyResultCache:
+    """Bounded LRU + TTL cache of per-image (concept, has_nsfw) results.
+
+    Images are keyed on an exact content hash. With `phash_distance` set,
+    images whose perceptual hash is within that Hamming distance of a cached
+    image also count as hits; by default only exact matches do.
+    """
+
+    def __init__(self, max_entries=4096, ttl_seconds=3600, phash_distance=None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.phash_distance = phash_distance
+        self.entries = OrderedDict()  # (content hash, adj) -> (expires_at, phash, result)
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.entries)}
+
+    def _keys(self, image, safety_checker_adj):
+        digest = hashlib.blake2b(image.tobytes(), digest_size=16)
+        digest.update(f"{image.mode}{image.size}".encode())
+        phash = perceptual_hash(image) if self.phash_distance is not None else None
+        return (digest.digest(), safety_checker_adj), phash
+
+    def _lookup(self, key, phash, now):
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] < now:
+            del self.entries[key]
+            entry = None
+        if entry is None and phash is not None:
+            for other_key, other in self.entries.items():
+                if other_key[1] == key[1] and other[0] >= now and bin(phash ^ other[1]).count("1") <= self.phash_distance:
+                    key, entry = other_key, other
+                    break
+        if entry is None:
+            return None
+        self.entries.move_to_end(key)
+        return entry[2]
+
+    def check(self, x_image, safety_checker_adj: float, check_fn):
+        """Like check_fn(x_image, safety_checker_adj), only running it on images not cached yet."""
+        images = to_pil_images(x_image)
+        keys = [self._keys(image, safety_checker_adj) for image in images]
+        results = [None] * len(images)
+
+        now = time.monotonic()
+        with self.lock:
+            for idx, (key, phash) in enumerate(keys):
+                results[idx] = self._lookup(key, phash, now)
+            missing = [idx for idx, result in enumerate(results) if result is None]
+            self.hits += len(images) - len(missing)
+            self.misses += len(missing)
+
+        if missing:
+            concepts, has_nsfw_concept = check_fn([images[idx] for idx in missing], safety_checker_adj)
+            expires_at = time.monotonic() + self.ttl_seconds
+            with self.lock:
+                for idx, concept, nsfw in zip(missing, concepts, has_nsfw_concept):
+                    results[idx] = (concept, nsfw)
+                    key, phash = keys[idx]
+                    self.entries[key] = (expires_at, phash, results[idx])
+                    self.entries.move_to_end(key)
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+
+        return [result[0] for result in results], [result[1] for result in results]
+
+
+# Repeated images (replayed prompt + seed, retries, refetches) skip the CLIP forward pass
+phash_distance = os.getenv("SAFETY_CACHE_PHASH_DISTANCE")
+safety_cache = SafetyResultCache(
+    max_entries=int(os.getenv("SAFETY_CACHE_SIZE", "4096")),
+    ttl_seconds=float(os.getenv("SAFETY_CACHE_TTL", "3600")),
+    phash_distance=int(phash_distance) if phash_distance else None,
+)
+
+
+# When set, checks are sent to the shared safety service (server_common/safety_service.py)
+# instead of loading a separate copy of the model into this process
+safety_service_socket = os.getenv("SAFETY_SERVICE_SOCKET")
+safety_service_client = None
+
+
 # check and replace nsfw content
 def check_safety(x_image, safety_checker_adj: float):
+    return safety_cache.check(x_image, safety_checker_adj, check_safety_uncached)
+
+
+def check_safety_uncached(x_image, safety_checker_adj: float):
+    global safety_service_client
+
+    if safety_service_socket:
+        if safety_service_client is None:
+            from safety_service import SafetyServiceClient
+            safety_service_client = SafetyServiceClient(safety_service_socket)
+        return safety_service_client.check(x_image, safety_checker_adj)
+
+    return check_safety_local(x_image, safety_checker_adj)
+
+
+def check_safety_local(x_image, safety_checker_adj: float):
     global safety_feature_extractor, safety_checker
 
     if safety_feature_extractor is None:
@@ -44,16 +162,17 @@ def check_safety(x_image, safety_checker_adj: float):
         x_image = numpy_to_pil(x_image)
     
     safety_checker_input = safety_feature_extractor(x_image, return_tensors="pt").to("cuda")
-    has_nsfw_concept, concepts = safety_checker(
+    has_nsfw_concept, scores = safety_checker(
         images=x_image,
         clip_input=safety_checker_input.pixel_values,
         safety_checker_adj=safety_checker_adj,  # customize adjustment
     )
 
+    # Scores come back as arrays; to_json() builds the per-image dicts with plain Python types
+    concepts = scores.to_json()
     print("concept", concepts, "has_nsfw_concept", has_nsfw_concept)
 
-    # Convert both numpy types and sets to Python types
-    return replace_numpy_with_python(replace_sets_with_lists(concepts)), replace_numpy_with_python(replace_sets_with_lists(has_nsfw_concept))
+    return concepts, has_nsfw_concept
 
 
 def censor_batch(x, safety_checker_adj: float):
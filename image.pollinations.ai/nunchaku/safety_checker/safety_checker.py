@@ -1,4 +1,5 @@
 from abc import ABC
+from typing import List, NamedTuple
 
 import numpy as np
 import torch
@@ -9,6 +10,54 @@ from transformers import CLIPConfig
 
 logger = logging.get_logger(__name__)
 
+# Once an image matches a special-care concept, the remaining concepts are scored with this adjustment
+SPECIAL_CARE_ADJUSTMENT = 0.01
+
+
+class SafetyScores(NamedTuple):
+    special_scores: np.ndarray  # (batch, special care concepts), rounded to 3 decimals
+    concept_scores: np.ndarray  # (batch, concepts), rounded to 3 decimals
+    has_nsfw: np.ndarray  # (batch,) bool
+
+    def to_json(self) -> List[dict]:
+        """Per-image dicts in the legacy `concept` layout, using plain Python types only."""
+        special_scores = self.special_scores.tolist()
+        concept_scores = self.concept_scores.tolist()
+        result = []
+        for special, concepts in zip(special_scores, concept_scores):
+            result.append({
+                "special_scores": dict(enumerate(special)),
+                "special_care": [[idx, score] for idx, score in enumerate(special) if score > 0],
+                "concept_scores": dict(enumerate(concepts)),
+                "bad_concepts": [idx for idx, score in enumerate(concepts) if score > 0],
+            })
+        return result
+
+
+def score_concepts(special_cos_dist, cos_dist, special_thresholds, concept_thresholds, safety_checker_adj: float):
+    """Score every image against every concept with tensor ops and a single device-to-host copy."""
+    special_raw = special_cos_dist - special_thresholds
+    special_scores = torch.round(special_raw + safety_checker_adj, decimals=3)
+    special_hits = (special_scores > 0).int()
+
+    # Concepts after the first special-care hit use the special-care adjustment instead
+    hit_earlier = (torch.cumsum(special_hits, dim=1) - special_hits) > 0
+    special_scores = torch.where(
+        hit_earlier, torch.round(special_raw + SPECIAL_CARE_ADJUSTMENT, decimals=3), special_scores
+    )
+
+    has_special_care = special_hits.any(dim=1, keepdim=True)
+    adjustment = torch.where(
+        has_special_care,
+        torch.full_like(special_scores[:, :1], SPECIAL_CARE_ADJUSTMENT),
+        torch.full_like(special_scores[:, :1], safety_checker_adj),
+    )
+    concept_scores = torch.round(cos_dist - concept_thresholds + adjustment, decimals=3)
+
+    scores = torch.cat([special_scores, concept_scores], dim=1).cpu().numpy()
+    special_scores, concept_scores = scores[:, :special_cos_dist.shape[1]], scores[:, special_cos_dist.shape[1]:]
+    return SafetyScores(special_scores, concept_scores, (concept_scores > 0).any(axis=1))
+
 
 class StableDiffusionSafetyChecker(BaseSafetyChecker, ABC):
     def __init__(self, config: CLIPConfig):
@@ -20,36 +69,20 @@ class StableDiffusionSafetyChecker(BaseSafetyChecker, ABC):
         image_embeds = self.visual_projection(pooled_output)
 
         # we always cast to float32 as this does not cause significant overhead and is compatible with bfloa16
-        special_cos_dist = cosine_distance(image_embeds, self.special_care_embeds).cpu().float().numpy()
-        cos_dist = cosine_distance(image_embeds, self.concept_embeds).cpu().float().numpy()
-
-        result = []
-        batch_size = image_embeds.shape[0]
-        for i in range(batch_size):
-            result_img = {"special_scores": {}, "special_care": [], "concept_scores": {}, "bad_concepts": []}
-
-            # increase this value to create a stronger `nfsw` filter
-            # at the cost of increasing the possibility of filtering benign images
-            adjustment = safety_checker_adj
-
-            for concept_idx in range(len(special_cos_dist[0])):
-                concept_cos = special_cos_dist[i][concept_idx]
-                concept_threshold = self.special_care_embeds_weights[concept_idx].item()
-                result_img["special_scores"][concept_idx] = round(concept_cos - concept_threshold + adjustment, 3)
-                if result_img["special_scores"][concept_idx] > 0:
-                    result_img["special_care"].append({concept_idx, result_img["special_scores"][concept_idx]})
-                    adjustment = 0.01
-
-            for concept_idx in range(len(cos_dist[0])):
-                concept_cos = cos_dist[i][concept_idx]
-                concept_threshold = self.concept_embeds_weights[concept_idx].item()
-                result_img["concept_scores"][concept_idx] = round(concept_cos - concept_threshold + adjustment, 3)
-                if result_img["concept_scores"][concept_idx] > 0:
-                    result_img["bad_concepts"].append(concept_idx)
+        special_cos_dist = cosine_distance(image_embeds, self.special_care_embeds).float()
+        cos_dist = cosine_distance(image_embeds, self.concept_embeds).float()
 
-            result.append(result_img)
+        # increase safety_checker_adj to create a stronger `nfsw` filter
+        # at the cost of increasing the possibility of filtering benign images
+        scores = score_concepts(
+            special_cos_dist,
+            cos_dist,
+            self.special_care_embeds_weights.float(),
+            self.concept_embeds_weights.float(),
+            safety_checker_adj,
+        )
 
-        has_nsfw_concepts = [len(res["bad_concepts"]) > 0 for res in result]
+        has_nsfw_concepts = scores.has_nsfw.tolist()
 
         # for idx, has_nsfw_concept in enumerate(has_nsfw_concepts):
         #     if has_nsfw_concept:
@@ -61,4 +94,4 @@ class StableDiffusionSafetyChecker(BaseSafetyChecker, ABC):
         #         " Try again with a different prompt and/or seed."
         #     )
 
-        return has_nsfw_concepts, result
+        return has_nsfw_concepts, scores
@@ -1,21 +1,27 @@
 import os
 import sys
-import time
-import uuid
 from typing import List, Dict, Any
 from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
 from pydantic import BaseModel
 import torch
 from diffusers import FluxPipeline
 from nunchaku.models import NunchakuFluxTransformer2dModel
-from safety_checker.censor import check_safety
-import requests
+from safety_checker.censor import check_safety, safety_cache
+# Modules shared with the DMD2 server live in ../server_common
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server_common"))
+from batching import MicroBatcher
+from inference_executor import RequestTooLargeError, ServerBusyError, from_env as executor_from_env, gather_or_cancel, timed
+from image_responses import build_response, encode_jpeg, wants_binary
+from result_cache import cache_key, from_env as result_cache_from_env
+from resolutions import FLUX_MAX_PIXELS
+from memory_budget import free_cuda_memory, from_env as memory_budget_from_env
+from heartbeat import from_env as heartbeat_from_env
+from metrics import Metrics
+from startup import StartupTimeline, load_parallel
+from warmup import from_env as warmup_from_env
 import logging
 import asyncio
-import aiohttp
-import io
-import base64
 from contextlib import asynccontextmanager
 
 # Configure logging
@@ -26,6 +32,10 @@ MODEL_ID = "black-forest-labs/FLUX.1-schnell"
 MODEL_CACHE = "model-cache"
 QUANT_MODEL_PATH = "mit-han-lab/svdq-int4-flux.1-schnell"
 
+# Concurrent requests with the same (width, height, steps) are rendered in one pipeline call
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "4"))
+MAX_BATCH_WAIT_MS = float(os.getenv("MAX_BATCH_WAIT_MS", "20"))
+
 class ImageRequest(BaseModel):
     prompts: List[str] = ["a photo of an astronaut riding a horse on mars"]
     width: int = 1024
@@ -33,201 +43,253 @@ class ImageRequest(BaseModel):
     steps: int = 4
     seed: int | None = None
     safety_checker_adj: float = 0.5  # Controls sensitivity of NSFW detection
+    response_format: str | None = None  # "binary" for raw image/jpeg (multipart/mixed for several prompts)
 
 pipe = None
+batcher = None
+# Pipeline calls run on one dedicated GPU thread, encoding and safety checks on a CPU pool
+executor = executor_from_env(default_max_in_flight=4 * MAX_BATCH_SIZE)
+# Renders with an explicit seed are deterministic and served from this cache when repeated
+result_cache = result_cache_from_env()
+# Pixel and batch limits, lowered when renders run out of memory
+memory_budget = memory_budget_from_env(max_pixels=FLUX_MAX_PIXELS, max_batch_size=MAX_BATCH_SIZE)
 
-# Function to get public IP address
-def get_public_ip():
-    try:
-        response = requests.get('https://api.ipify.org')
-        return response.text
-    except:
-        return None
-
-# Heartbeat function
-async def send_heartbeat():
-    # Check for PUBLIC_IP environment variable first, otherwise auto-detect
-    public_ip = os.getenv("PUBLIC_IP")
-    if not public_ip:
-        public_ip = await asyncio.get_event_loop().run_in_executor(None, get_public_ip)
-    if public_ip:
-        try:
-            # Use PUBLIC_PORT if set, otherwise use PORT
-            public_port = os.getenv("PUBLIC_PORT")
-            if public_port:
-                port = int(public_port)
-            else:
-                port = int(os.getenv("PORT", "10001"))
-            url = f"http://{public_ip}:{port}"
-            service_type = os.getenv("SERVICE_TYPE", "flux")  # Get service type from environment variable
-            async with aiohttp.ClientSession() as session:
-                async with session.post('https://image.pollinations.ai/register', json={'url': url, 'type': service_type}) as response:
-                    if response.status == 200:
-                        logger.info(f"Heartbeat sent successfully. URL: {url}")
-                    else:
-                        logger.error(f"Failed to send heartbeat. Status code: {response.status}")
-        except Exception as e:
-            logger.error(f"Error sending heartbeat: {str(e)}")
-
-# Periodic heartbeat function
-async def periodic_heartbeat():
-    while True:
-        try:
-            await send_heartbeat()
-            await asyncio.sleep(30)  # Send heartbeat every 30 seconds
-        except asyncio.CancelledError:
-            logger.info("Heartbeat task cancelled")
-            raise
-        except Exception as e:
-            logger.error(f"Error in periodic heartbeat: {str(e)}")
-            await asyncio.sleep(5)  # Wait a bit before retrying
+# Stage latencies, throughput, GPU utilization and cache stats, served on /metrics;
+# throughput and utilization are also reported with each heartbeat
+metrics = Metrics("flux")
+metrics.add_cache("results", result_cache.stats)
+metrics.add_cache("safety", safety_cache.stats)
+
+def worker_load() -> Dict[str, Any]:
+    free_vram, total_vram = torch.cuda.mem_get_info()
+    return {
+        "queue_depth": batcher.queue_depth() if batcher is not None else 0,
+        "in_flight": executor.in_flight,
+        "images_per_second": round(metrics.images_per_second(), 3),
+        "gpu_utilization": round(metrics.gpu_utilization(), 3),
+        "free_vram_mb": free_vram // (1024 * 1024),
+        "total_vram_mb": total_vram // (1024 * 1024),
+    }
+
+heartbeat = heartbeat_from_env(load_fn=worker_load)
+
+# Sizes and batch sizes rendered once before registering, so requests don't pay for first-use autotuning
+warmup = warmup_from_env(f"768x768x1,768x768x{MAX_BATCH_SIZE},1024x576x1,576x1024x1", snap_size=memory_budget.snap)
+
+def render_warmup(width: int, height: int, batch_size: int):
+    with torch.inference_mode():
+        pipe(prompt=["warmup"] * batch_size, width=width, height=height, num_inference_steps=4,
+             generator=torch.Generator("cuda").manual_seed(0))
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup
-    global pipe
-    heartbeat_task = None
+    global pipe, batcher
     try:
         print("Loading FLUX pipeline...")
-        transformer = NunchakuFluxTransformer2dModel.from_pretrained(QUANT_MODEL_PATH)
-        pipe = FluxPipeline.from_pretrained(
-            MODEL_ID,
-            transformer=transformer,
-            torch_dtype=torch.bfloat16
-        ).to("cuda")
+        timeline = StartupTimeline("flux")
+        # The quantized transformer and the rest of the pipeline don't depend on each other
+        components = await asyncio.to_thread(load_parallel, {
+            "transformer": lambda: NunchakuFluxTransformer2dModel.from_pretrained(QUANT_MODEL_PATH),
+            "pipeline": lambda: FluxPipeline.from_pretrained(MODEL_ID, transformer=None, torch_dtype=torch.bfloat16),
+        }, timeline)
+        with timeline.phase("to_cuda"):
+            pipe = components["pipeline"]
+            pipe.register_modules(transformer=components["transformer"])
+            pipe.to("cuda")
         print("FLUX pipeline loaded successfully")
+        # The quantized transformer runs its own kernels, so it's warmed up but not compiled
+        await asyncio.to_thread(warmup.run, render_warmup, timeline)
+        timeline.report()
+
+        batcher = MicroBatcher(
+            run_batch,
+            max_batch_size=MAX_BATCH_SIZE,
+            max_wait_ms=MAX_BATCH_WAIT_MS,
+            postprocess=postprocess_batch,
+            metrics=metrics,
+        )
+        batcher.start()
         
-        # Send initial heartbeat and start periodic task
-        try:
-            await send_heartbeat()
-            logger.info("Initial heartbeat sent successfully")
-            # Store the task in app.state to prevent garbage collection
-            heartbeat_task = asyncio.create_task(periodic_heartbeat())
-            app.state.heartbeat_task = heartbeat_task
-            logger.info("Periodic heartbeat task started")
-        except Exception as e:
-            logger.error(f"Error in heartbeat initialization: {str(e)}")
-            if heartbeat_task:
-                heartbeat_task.cancel()
-                try:
-                    await heartbeat_task
-                except asyncio.CancelledError:
-                    pass
-            raise
+        # Register with the registry and keep the registration fresh
+        await heartbeat.start()
+        logger.info("Periodic heartbeat task started")
     except Exception as e:
         logger.error(f"Error during startup: {str(e)}")
-        if heartbeat_task:
-            heartbeat_task.cancel()
-            try:
-                await heartbeat_task
-            except asyncio.CancelledError:
-                pass
+        await heartbeat.stop()
         raise
 
     try:
         yield  # Server is running
     finally:
         # Shutdown
-        if hasattr(app.state, "heartbeat_task"):
-            app.state.heartbeat_task.cancel()
-            try:
-                await app.state.heartbeat_task
-            except asyncio.CancelledError:
-                pass
-
-def find_nearest_valid_dimensions(width: float, height: float) -> tuple[int, int]:
-    """Find the nearest dimensions that are multiples of 8 and their product is divisible by 65536.
-    Also enforces a maximum total pixel count to prevent CUDA OOM errors."""
-    # Cap total pixels to prevent CUDA OOM with quantized models (1024x1024 = 1,048,576)
-    MAX_PIXELS = 768 * 768
-    start_w = round(width)
-    start_h = round(height)
-    
-    # Scale down proportionally if total pixels exceed limit
-    current_pixels = start_w * start_h
-    if current_pixels > MAX_PIXELS:
-        scale = (MAX_PIXELS / current_pixels) ** 0.5
-        start_w = round(start_w * scale)
-        start_h = round(start_h * scale)
-    
-    def is_valid(w: int, h: int) -> bool:
-        return w % 8 == 0 and h % 8 == 0 and (w * h) % 65536 == 0
-    
-    # Find nearest multiple of 8 for each dimension
-    nearest_w = round(start_w / 8) * 8
-    nearest_h = round(start_h / 8) * 8
-    
-    # Search in a spiral pattern from the nearest multiples of 8
-    offset = 0
-    while offset < 100:  # Limit search to reasonable range
-        for w in range(nearest_w - offset * 8, nearest_w + offset * 8 + 1, 8):
-            if w <= 0:
-                continue
-            for h in range(nearest_h - offset * 8, nearest_h + offset * 8 + 1, 8):
-                if h <= 0:
-                    continue
-                if is_valid(w, h):
-                    return w, h
-        offset += 1
-    
-    # If no valid dimensions found, return the nearest multiples of 8
-    return nearest_w, nearest_h
+        if batcher is not None:
+            await batcher.stop()
+        executor.shutdown()
+        await heartbeat.stop()
+
+def render_batch(bucket: tuple[int, int, int], payloads: List[Dict[str, Any]]) -> list:
+    """Render a batch of prompts that share (width, height, steps) with a single pipeline call."""
+    width, height, steps = bucket
+    prompts = [payload["prompt"] for payload in payloads]
+    generators = [torch.Generator("cuda").manual_seed(payload["seed"]) for payload in payloads]
+
+    with metrics.gpu(torch.cuda.synchronize) as timer, torch.inference_mode():
+        # Encoding the prompts separately lets text encoding be timed apart from denoising
+        prompt_embeds, pooled_prompt_embeds, _ = pipe.encode_prompt(prompt=prompts, prompt_2=None)
+        timer.mark("text_encode")
+        output = pipe(
+            prompt_embeds=prompt_embeds,
+            pooled_prompt_embeds=pooled_prompt_embeds,
+            generator=generators,
+            width=width,
+            height=height,
+            num_inference_steps=steps,
+            callback_on_step_end=timer.step_end,
+        )
+        timer.mark("vae_decode")
+    return output.images
+
+def check_batch_safety(images: list, payloads: List[Dict[str, Any]]) -> list[tuple]:
+    """Return (concept, has_nsfw) per image."""
+    # The NSFW adjustment is per request, so check images sharing the same value together
+    safety_results = [None] * len(images)
+    indices_by_adj = {}
+    for idx, payload in enumerate(payloads):
+        indices_by_adj.setdefault(payload["safety_checker_adj"], []).append(idx)
+    for safety_checker_adj, indices in indices_by_adj.items():
+        concepts, has_nsfw = check_safety([images[idx] for idx in indices], safety_checker_adj)
+        for idx, concept, nsfw in zip(indices, concepts, has_nsfw):
+            safety_results[idx] = (concept, nsfw)
+    return safety_results
+
+async def run_batch(bucket: tuple[int, int, int], payloads: List[Dict[str, Any]]) -> list:
+    try:
+        # After a CUDA OOM the budget is lowered and the batch retried once
+        images = await executor.run_gpu(memory_budget.render, render_batch, bucket, payloads)
+    finally:
+        batcher.max_batch_size = memory_budget.max_batch_size
+    metrics.count_images(len(images))
+    return images
+
+async def postprocess_batch(bucket: tuple[int, int, int], payloads: List[Dict[str, Any]], images: list) -> List[Dict[str, Any]]:
+    """Safety check and encode a rendered batch while the GPU renders the next one."""
+    (safety_results, safety_check_time), encoded = await asyncio.gather(
+        executor.run_cpu(timed, check_batch_safety, images, payloads),
+        asyncio.gather(*[executor.run_cpu(timed, encode_jpeg, image, quality=95) for image in images]),
+    )
+    logger.info(f"Safety check time: {safety_check_time:.2f} seconds")
+    metrics.observe("safety", safety_check_time)
+    encoded_images = []
+    for image_buffer, encode_time in encoded:
+        metrics.observe("encode", encode_time)
+        encoded_images.append(image_buffer)
+
+    results = []
+    for image, image_buffer, payload, (concept, nsfw) in zip(images, encoded_images, payloads, safety_results):
+        # After an OOM retry the image can be smaller than the bucket
+        width, height = image.size
+        results.append({
+            "image": image_buffer,
+            "has_nsfw_concept": nsfw,
+            "concept": concept,
+            "width": width,
+            "height": height,
+            "seed": payload["seed"],
+            "prompt": payload["prompt"]
+        })
+    return results
+
+async def render_image(bucket: tuple[int, int, int], payload: Dict[str, Any]) -> List[Dict[str, Any]]:
+    return [await batcher.submit(bucket, payload)]
+
+async def generate_image(bucket: tuple[int, int, int], payload: Dict[str, Any], cacheable: bool) -> Dict[str, Any]:
+    if not cacheable:
+        return (await render_image(bucket, payload))[0]
+    width, height, steps = bucket
+    key = cache_key(
+        model=MODEL_ID,
+        transformer=QUANT_MODEL_PATH,
+        prompt=payload["prompt"],
+        seed=payload["seed"],
+        width=width,
+        height=height,
+        steps=steps,
+        safety_checker_adj=payload["safety_checker_adj"],
+    )
+    # Identical concurrent requests share one render
+    # Renders downsized after an OOM aren't what the key describes, so they aren't stored
+    results = await result_cache.get_or_compute(
+        key,
+        lambda: render_image(bucket, payload),
+        store=lambda results: (results[0]["width"], results[0]["height"]) == (width, height),
+    )
+    return results[0]
 
 app = FastAPI(title="FLUX Image Generation API", lifespan=lifespan)
 
+@app.get("/health")
+async def health():
+    # Ready once the pipeline is loaded and warmed up
+    if pipe is None or batcher is None or not warmup.ready:
+        return JSONResponse(content={"status": "starting"}, status_code=503)
+    return {"status": "ok"}
+
+@app.get("/metrics")
+async def get_metrics(format: str | None = None):
+    body, content_type = metrics.export(format)
+    return Response(content=body, media_type=content_type)
+
 @app.post("/generate")
-async def generate(request: ImageRequest):
+async def generate(request: ImageRequest, http_request: Request):
     print(f"Request: {request}")
-    if pipe is None:
+    if pipe is None or batcher is None:
         raise HTTPException(status_code=503, detail="Model not loaded")
         
     seed = request.seed if request.seed is not None else int.from_bytes(os.urandom(2), "big")
     print(f"Using seed: {seed}")
 
-    generator = torch.Generator("cuda").manual_seed(seed)
-    
-    # Find nearest valid dimensions
-    width, height = find_nearest_valid_dimensions(request.width, request.height)
+    # Find nearest valid dimensions within the current memory budget, preferring warmed sizes
+    width, height = memory_budget.snap(request.width, request.height)
+    width, height = warmup.snap(width, height, max_pixels=memory_budget.max_pixels)
     print(f"Original dimensions: {request.width}x{request.height}")
     print(f"Adjusted dimensions: {width}x{height}")
 
     try:
-        with torch.inference_mode():
-            output = pipe(
-                prompt=request.prompts[0],
-                generator=generator,
-                width=width,
-                height=height,
-                num_inference_steps=request.steps,
-            )
-
-        # Check for NSFW content
-        image = output.images[0]
-        concepts, has_nsfw = check_safety([image], request.safety_checker_adj)
-        
-        # Convert image to base64
-        img_byte_arr = io.BytesIO()
-        image.save(img_byte_arr, format='JPEG', quality=95)
-        img_base64 = base64.b64encode(img_byte_arr.getvalue()).decode('utf-8')
-        
-        response_content = [{
-            "image": img_base64,
-            "has_nsfw_concept": has_nsfw[0],
-            "concept": concepts[0],
-            "width": width,
-            "height": height,
-            "seed": seed,
-            "prompt": request.prompts[0]
-        }]
+        # Every prompt is queued separately so it can share a batch with other requests.
+        # Each one gets its own seed, so repeated prompts still vary and are cached apart.
+        # The request is admitted as a whole, so it is either rendered or rejected up front
+        bucket = (width, height, request.steps)
+        with executor.admit(len(request.prompts)):
+            response_content = await gather_or_cancel(*[
+                generate_image(bucket, {
+                    "prompt": prompt,
+                    "seed": seed + idx,
+                    "safety_checker_adj": request.safety_checker_adj
+                }, cacheable=request.seed is not None)
+                for idx, prompt in enumerate(request.prompts)
+            ])
         
-        # Send heartbeat after successful generation
-        await send_heartbeat()
-        return JSONResponse(content=response_content)
+        # Refresh the registration in the background, off the response path
+        heartbeat.notify()
+        binary = wants_binary(request.response_format, http_request.headers.get("accept"))
+        return build_response(list(response_content), binary)
+
+    except RequestTooLargeError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    except ServerBusyError as e:
+        logger.warning(f"Rejecting request: {str(e)}")
+        raise HTTPException(status_code=503, detail="Server busy, retry later", headers={"Retry-After": "1"})
     
     except torch.cuda.OutOfMemoryError as e:
-        logger.error(f"CUDA OOM Error: {str(e)} - Exiting to trigger systemd restart")
-        # Exit with non-zero status to trigger systemd restart
-        sys.exit(1)
+        free_cuda_memory()
+        if memory_budget.should_restart():
+            logger.error(f"CUDA OOM Error: {str(e)} - {memory_budget.consecutive_ooms} in a row, exiting to trigger systemd restart")
+            # Exit with non-zero status to trigger systemd restart
+            sys.exit(1)
+        logger.error(f"CUDA OOM Error: {str(e)} - retry with the lowered budget")
+        raise HTTPException(status_code=503, detail="Out of GPU memory, retry later", headers={"Retry-After": "1"})
 
 if __name__ == "__main__":
     import uvicorn
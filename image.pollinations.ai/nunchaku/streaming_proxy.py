@@ -0,0 +1,187 @@
+import asyncio
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Optional
+
+import httpx
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
+
+logger = logging.getLogger(__name__)
+
+# Headers that describe one connection rather than the message, so they aren't forwarded
+HOP_BY_HOP_HEADERS = {
+    "connection", "keep-alive", "proxy-authenticate", "proxy-authorization",
+    "te", "trailer", "trailers", "transfer-encoding", "upgrade", "host",
+}
+
+
+def forwarded_headers(headers) -> list:
+    return [(name, value) for name, value in headers.items() if name.lower() not in HOP_BY_HOP_HEADERS]
+
+
+class UpstreamUnavailable(Exception):
+    pass
+
+
+class StreamingProxy:
+    """Reverse proxy to one upstream worker, for the lifetime of an app.
+
+    A single pooled keep-alive client is shared by all requests. Request and
+    response bodies are streamed through chunk by chunk, never buffered. At
+    most `max_concurrency` requests are forwarded at once, which should match
+    what the worker accepts (its MAX_IN_FLIGHT); others wait up to
+    `queue_timeout_seconds` for a slot and then get a 503. Before forwarding,
+    and again after the upstream refuses a connection, requests wait for
+    `health_path` to answer 200, probed with exponential backoff.
+    """
+
+    def __init__(self, upstream_url: str, max_concurrency: int = 16, health_path: str = "/health",
+                 ready_timeout_seconds: float = 600, queue_timeout_seconds: float = 30,
+                 request_timeout_seconds: float = 600):
+        self.upstream_url = upstream_url.rstrip("/")
+        self.max_concurrency = max_concurrency
+        self.health_path = health_path
+        self.ready_timeout_seconds = ready_timeout_seconds
+        self.queue_timeout_seconds = queue_timeout_seconds
+        self.request_timeout_seconds = request_timeout_seconds
+        self.client: Optional[httpx.AsyncClient] = None
+        self._slots = asyncio.Semaphore(max_concurrency)
+        self._ready = False
+        self._probe: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if self.client is None:
+            self.client = httpx.AsyncClient(
+                base_url=self.upstream_url,
+                limits=httpx.Limits(max_connections=self.max_concurrency + 2,
+                                    max_keepalive_connections=self.max_concurrency, keepalive_expiry=60),
+                timeout=httpx.Timeout(self.request_timeout_seconds, connect=5),
+            )
+
+    async def stop(self):
+        if self._probe is not None:
+            self._probe.cancel()
+            self._probe = None
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    async def wait_until_ready(self):
+        """Return once the upstream health endpoint answers 200; concurrent callers share one probe."""
+        if self._ready:
+            return
+        if self._probe is None or self._probe.done():
+            self._probe = asyncio.create_task(self._probe_health())
+        await asyncio.shield(self._probe)
+
+    async def _probe_health(self):
+        deadline = time.monotonic() + self.ready_timeout_seconds
+        delay = 0.05
+        while True:
+            try:
+                response = await self.client.get(self.health_path, timeout=5)
+                if response.status_code == 200:
+                    self._ready = True
+                    logger.info(f"Upstream {self.upstream_url} is ready")
+                    return
+            except httpx.TransportError:
+                pass
+            if time.monotonic() + delay > deadline:
+                raise UpstreamUnavailable(f"{self.upstream_url} not ready after {self.ready_timeout_seconds}s")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 2)
+
+    async def forward(self, request: Request, path: str):
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.queue_timeout_seconds)
+        except asyncio.TimeoutError:
+            return JSONResponse({"error": "Server busy, retry later"}, status_code=503, headers={"Retry-After": "1"})
+
+        try:
+            response = await self._send(request, path)
+        except UpstreamUnavailable as e:
+            self._slots.release()
+            logger.error(str(e))
+            return JSONResponse({"error": "Internal service not available"}, status_code=503, headers={"Retry-After": "5"})
+        except BaseException:
+            self._slots.release()
+            raise
+
+        released = False
+
+        async def close():
+            nonlocal released
+            if not released:
+                released = True
+                self._slots.release()
+                await response.aclose()
+
+        async def body():
+            try:
+                async for chunk in response.aiter_raw():
+                    yield chunk
+            finally:
+                await close()
+
+        # The slot is held until the body has been streamed to the client. It is freed when the
+        # stream ends, however it ends, since the background task is skipped when streaming fails
+        return StreamingResponse(
+            body(),
+            status_code=response.status_code,
+            headers=dict(forwarded_headers(response.headers)),
+            background=BackgroundTask(close),
+        )
+
+    async def _send(self, request: Request, path: str) -> httpx.Response:
+        # Bodiless requests stay bodiless instead of being sent chunked
+        has_body = "content-length" in request.headers or "transfer-encoding" in request.headers
+        body = request.stream() if has_body else None
+        for attempt in range(2):
+            await self.wait_until_ready()
+            upstream_request = self.client.build_request(
+                request.method,
+                f"/{path}",
+                params=request.query_params,
+                headers=forwarded_headers(request.headers),
+                content=body,
+            )
+            try:
+                return await self.client.send(upstream_request, stream=True)
+            except httpx.ConnectError:
+                # Nothing was sent, so the body is untouched; wait for the worker to come back and retry
+                self._ready = False
+                if attempt == 1:
+                    raise UpstreamUnavailable(f"{self.upstream_url} refused the connection")
+
+    def create_app(self) -> FastAPI:
+        @asynccontextmanager
+        async def lifespan(app: FastAPI):
+            await self.start()
+            try:
+                yield
+            finally:
+                await self.stop()
+
+        app = FastAPI(lifespan=lifespan)
+
+        @app.api_route("/{path:path}", methods=["GET", "POST", "PUT", "DELETE"])
+        async def proxy(request: Request, path: str):
+            return await self.forward(request, path)
+
+        return app
+
+
+def from_env() -> StreamingProxy:
+    # Matches the worker's admission limit, 4 * MAX_BATCH_SIZE unless MAX_IN_FLIGHT is set
+    default_concurrency = 4 * int(os.getenv("MAX_BATCH_SIZE", "4"))
+    return StreamingProxy(
+        upstream_url=os.getenv("UPSTREAM_URL", "http://localhost:8000"),
+        max_concurrency=int(os.getenv("MAX_IN_FLIGHT", str(default_concurrency))),
+        health_path=os.getenv("UPSTREAM_HEALTH_PATH", "/health"),
+        ready_timeout_seconds=float(os.getenv("UPSTREAM_READY_TIMEOUT", "600")),
+        queue_timeout_seconds=float(os.getenv("PROXY_QUEUE_TIMEOUT", "30")),
+    )
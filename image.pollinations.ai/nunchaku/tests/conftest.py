@@ -0,0 +1,8 @@
+import os
+import sys
+
+# The server modules are imported flat, as they are when run from this directory,
+# and so are the modules shared with the DMD2 server
+tests_dir = os.path.dirname(__file__)
+sys.path.insert(0, os.path.join(tests_dir, ".."))
+sys.path.append(os.path.join(tests_dir, "..", "..", "server_common"))
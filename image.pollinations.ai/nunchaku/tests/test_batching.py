@@ -0,0 +1,142 @@
+import asyncio
+
+from batching import MicroBatcher
+
+
+class StubRenderer:
+    """Records every batch and returns "<key>:<payload>" for each payload."""
+
+    def __init__(self, fail_with=None):
+        self.batches = []
+        self.fail_with = fail_with
+
+    async def __call__(self, key, payloads):
+        self.batches.append((key, list(payloads)))
+        if self.fail_with is not None:
+            raise self.fail_with
+        return [f"{key}:{payload}" for payload in payloads]
+
+
+async def _run(batcher, submissions):
+    batcher.start()
+    try:
+        return await asyncio.gather(*[batcher.submit(key, payload) for key, payload in submissions],
+                                    return_exceptions=True)
+    finally:
+        await batcher.stop()
+
+
+def test_batches_only_share_a_bucket():
+    renderer = StubRenderer()
+    batcher = MicroBatcher(renderer, max_batch_size=8, max_wait_ms=10)
+    submissions = [("a", 1), ("b", 2), ("a", 3), ("b", 4), ("c", 5)]
+
+    results = asyncio.run(_run(batcher, submissions))
+
+    assert results == ["a:1", "b:2", "a:3", "b:4", "c:5"]
+    assert sorted(renderer.batches) == [("a", [1, 3]), ("b", [2, 4]), ("c", [5])]
+
+
+def test_full_bucket_is_flushed_without_waiting():
+    renderer = StubRenderer()
+    # A wait far longer than the test would time out if a full bucket waited for it
+    batcher = MicroBatcher(renderer, max_batch_size=2, max_wait_ms=60_000)
+
+    async def scenario():
+        return await asyncio.wait_for(_run(batcher, [("a", 1), ("a", 2), ("a", 3), ("a", 4)]), 5)
+
+    results = asyncio.run(scenario())
+
+    assert results == ["a:1", "a:2", "a:3", "a:4"]
+    assert renderer.batches == [("a", [1, 2]), ("a", [3, 4])]
+
+
+def test_partial_bucket_is_flushed_after_max_wait():
+    renderer = StubRenderer()
+    batcher = MicroBatcher(renderer, max_batch_size=4, max_wait_ms=50)
+
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        results = await _run(batcher, [("a", 1), ("a", 2)])
+        return results, loop.time() - started
+
+    results, elapsed = asyncio.run(scenario())
+
+    assert results == ["a:1", "a:2"]
+    assert renderer.batches == [("a", [1, 2])]
+    assert 0.04 <= elapsed < 1
+
+
+def test_errors_are_fanned_out_to_the_whole_batch():
+    error = RuntimeError("CUDA out of memory")
+    renderer = StubRenderer(fail_with=error)
+    batcher = MicroBatcher(renderer, max_batch_size=3, max_wait_ms=10)
+
+    results = asyncio.run(_run(batcher, [("a", 1), ("a", 2), ("a", 3)]))
+
+    assert results == [error, error, error]
+    assert renderer.batches == [("a", [1, 2, 3])]
+
+
+def test_postprocess_errors_are_fanned_out():
+    renderer = StubRenderer()
+
+    def postprocess(key, payloads, output):
+        raise ValueError("encoding failed")
+
+    batcher = MicroBatcher(renderer, max_batch_size=2, max_wait_ms=10, postprocess=postprocess)
+
+    async def scenario():
+        batcher.start()
+        try:
+            return await asyncio.gather(batcher.submit("a", 1), batcher.submit("a", 2), return_exceptions=True)
+        finally:
+            await batcher.stop()
+
+    results = asyncio.run(scenario())
+
+    assert [str(result) for result in results] == ["encoding failed", "encoding failed"]
+
+
+async def _stop_when(batcher, submissions, reached):
+    """Submit, stop the batcher once `reached()` is true, and wait for every submission to finish."""
+    batcher.start()
+    tasks = [asyncio.create_task(batcher.submit(key, payload)) for key, payload in submissions]
+    while not reached():
+        await asyncio.sleep(0.01)
+    await batcher.stop()
+    return await asyncio.wait_for(asyncio.gather(*tasks, return_exceptions=True), 5)
+
+
+def test_stop_cancels_batches_in_postprocess_and_waiting_for_it():
+    renderer = StubRenderer()
+    started = []
+
+    async def postprocess(key, payloads, output):
+        started.append(payloads)
+        await asyncio.Event().wait()
+
+    # One post-process slot: a:1 holds it, a:2 finished on the GPU and waits for it, a:3 is still queued
+    batcher = MicroBatcher(renderer, max_batch_size=1, max_wait_ms=0, postprocess=postprocess,
+                           max_postprocess_batches=1)
+
+    results = asyncio.run(_stop_when(batcher, [("a", 1), ("a", 2), ("a", 3)],
+                                     lambda: started and len(renderer.batches) == 2))
+
+    assert all(isinstance(result, asyncio.CancelledError) for result in results)
+    assert not batcher._postprocess_tasks
+
+
+def test_stop_cancels_the_batch_on_the_gpu():
+    class BlockingRenderer(StubRenderer):
+        async def __call__(self, key, payloads):
+            self.batches.append((key, list(payloads)))
+            await asyncio.Event().wait()
+
+    renderer = BlockingRenderer()
+    batcher = MicroBatcher(renderer, max_batch_size=2, max_wait_ms=0)
+
+    results = asyncio.run(_stop_when(batcher, [("a", 1), ("a", 2)], lambda: renderer.batches))
+
+    assert all(isinstance(result, asyncio.CancelledError) for result in results)
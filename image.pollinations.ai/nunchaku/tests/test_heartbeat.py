@@ -0,0 +1,116 @@
+import asyncio
+
+from aiohttp import web
+
+from heartbeat import HeartbeatClient
+
+
+class StubRegistry:
+    """Records every registration, answering each after `delay` seconds with `status`."""
+
+    def __init__(self, delay=0.0, status=200):
+        self.delay = delay
+        self.status = status
+        self.registrations = []
+        self.ip_lookups = 0
+        self.runner = None
+        self.url = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post("/register", self.register)
+        app.router.add_get("/ip", self.ip)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, "127.0.0.1", 0).start()
+        host, port = self.runner.addresses[0][:2]
+        self.url = f"http://{host}:{port}"
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    async def register(self, request):
+        self.registrations.append(await request.json())
+        await asyncio.sleep(self.delay)
+        return web.Response(status=self.status)
+
+    async def ip(self, request):
+        self.ip_lookups += 1
+        return web.Response(text="203.0.113.7\n")
+
+
+def run_heartbeat(scenario, registry=None, **client_args):
+    async def main():
+        stub = registry or StubRegistry()
+        await stub.start()
+        client = HeartbeatClient(port=10001, register_url=f"{stub.url}/register", public_ip_url=f"{stub.url}/ip",
+                                 interval_seconds=3600, **client_args)
+        await client.start()
+        try:
+            await scenario(client, stub)
+        finally:
+            await client.stop()
+            await stub.stop()
+        return client, stub
+
+    return asyncio.run(main())
+
+
+async def settle(client):
+    while client._in_flight is not None and not client._in_flight.done():
+        await asyncio.sleep(0.01)
+
+
+def test_payload_carries_the_url_and_load():
+    loads = iter(range(100))
+
+    async def scenario(client, registry):
+        client.notify()
+        await settle(client)
+
+    client, registry = run_heartbeat(scenario, load_fn=lambda: {"queue_depth": next(loads), "in_flight": 1})
+
+    assert registry.registrations == [
+        {"url": "http://203.0.113.7:10001", "type": "flux", "load": {"queue_depth": 0, "in_flight": 1}},
+        {"url": "http://203.0.113.7:10001", "type": "flux", "load": {"queue_depth": 1, "in_flight": 1}},
+    ]
+    # The public IP is resolved once, not per heartbeat
+    assert registry.ip_lookups == 1
+    assert (client.sent, client.failed) == (2, 0)
+
+
+def test_notifications_during_a_send_are_coalesced():
+    async def scenario(client, registry):
+        client.notify()
+        await asyncio.sleep(0.05)
+        for _ in range(10):
+            client.notify()
+        await settle(client)
+
+    client, registry = run_heartbeat(scenario, registry=StubRegistry(delay=0.2))
+
+    # The start heartbeat, the one in flight and a single follow-up for the ten notifications
+    assert len(registry.registrations) == 3
+    assert client.sent == 3
+
+
+def test_failing_load_fn_still_sends_a_heartbeat():
+    def load_fn():
+        raise RuntimeError("no GPU")
+
+    async def scenario(client, registry):
+        pass
+
+    client, registry = run_heartbeat(scenario, load_fn=load_fn)
+
+    assert registry.registrations == [{"url": "http://203.0.113.7:10001", "type": "flux"}]
+    assert client.sent == 1
+
+
+def test_rejected_heartbeats_are_counted_as_failed():
+    async def scenario(client, registry):
+        pass
+
+    client, registry = run_heartbeat(scenario, registry=StubRegistry(status=500))
+
+    assert (client.sent, client.failed) == (0, 1)
@@ -0,0 +1,124 @@
+import pytest
+import torch
+
+from memory_budget import MemoryBudget, from_env
+
+MAX_PIXELS = 768 * 768
+
+
+class StubRenderer:
+    """Records every render call and returns one (width, height) per payload."""
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, bucket, payloads):
+        self.calls.append((bucket, list(payloads)))
+        width, height, _ = bucket
+        return [(width, height)] * len(payloads)
+
+
+def make_budget(**overrides):
+    return MemoryBudget(max_pixels=MAX_PIXELS, max_batch_size=4, **overrides)
+
+
+def test_ooms_halve_the_batch_before_shrinking_images():
+    budget = make_budget()
+
+    budget.record_oom(MAX_PIXELS, 4)
+    assert (budget.max_batch_size, budget.max_pixels) == (2, MAX_PIXELS)
+    budget.record_oom(MAX_PIXELS, 2)
+    assert (budget.max_batch_size, budget.max_pixels) == (1, MAX_PIXELS)
+    budget.record_oom(MAX_PIXELS, 1)
+    assert (budget.max_batch_size, budget.max_pixels) == (1, int(MAX_PIXELS * 0.75))
+    width, height = budget.snap(768, 768)
+    assert width * height <= budget.max_pixels
+
+
+def test_pixels_never_drop_below_the_minimum():
+    budget = make_budget(min_pixels=256 * 256)
+    for _ in range(20):
+        budget.record_oom(MAX_PIXELS, 1)
+    assert budget.max_pixels == 256 * 256
+
+
+def test_a_batch_that_runs_out_of_memory_is_retried_one_image_at_a_time():
+    budget = make_budget()
+    render = StubRenderer()
+    budget.inject_oom(1)
+
+    images = budget.render(render, (768, 768, 4), ["a", "b", "c"])
+
+    assert images == [(768, 768)] * 3
+    # The failed batch call never reached the renderer
+    assert render.calls == [((768, 768, 4), ["a"]), ((768, 768, 4), ["b"]), ((768, 768, 4), ["c"])]
+    assert budget.max_batch_size == 1
+    assert (budget.total_ooms, budget.consecutive_ooms) == (1, 0)
+
+
+def test_a_single_image_is_retried_at_a_smaller_size():
+    budget = make_budget()
+    render = StubRenderer()
+    budget.inject_oom(1)
+
+    [(width, height)] = budget.render(render, (768, 768, 4), ["a"])
+
+    assert width * height <= int(MAX_PIXELS * 0.75)
+    assert render.calls == [((width, height, 4), ["a"])]
+
+
+def test_a_second_oom_is_left_to_the_caller():
+    budget = make_budget()
+    budget.inject_oom(2)
+
+    with pytest.raises(torch.cuda.OutOfMemoryError):
+        budget.render(StubRenderer(), (768, 768, 4), ["a"])
+    assert budget.consecutive_ooms == 1
+    assert not budget.should_restart()
+
+
+def test_restart_after_three_failed_renders_in_a_row():
+    budget = make_budget()
+
+    for _ in range(3):
+        assert not budget.should_restart()
+        budget.inject_oom(2)
+        with pytest.raises(torch.cuda.OutOfMemoryError):
+            budget.render(StubRenderer(), (768, 768, 4), ["a"])
+    assert budget.should_restart()
+
+    # A success in between starts the count again
+    budget.render(StubRenderer(), (512, 512, 4), ["a"])
+    assert budget.consecutive_ooms == 0 and not budget.should_restart()
+
+
+def test_budget_steps_back_up_after_200_successes():
+    budget = make_budget()
+    budget.record_oom(MAX_PIXELS, 4)
+    budget.record_oom(MAX_PIXELS, 1)
+    lowered = budget.max_pixels
+
+    for _ in range(199):
+        budget.record_success()
+    assert (budget.max_pixels, budget.max_batch_size) == (lowered, 2)
+    budget.record_success()
+    # Pixels come back first, then the batch size
+    assert (budget.max_pixels, budget.max_batch_size) == (MAX_PIXELS, 2)
+    for _ in range(200):
+        budget.record_success()
+    assert budget.max_batch_size == 4
+    for _ in range(200):
+        budget.record_success()
+    assert (budget.max_pixels, budget.max_batch_size) == (MAX_PIXELS, 4)
+
+
+def test_fault_injection_from_the_environment(monkeypatch):
+    monkeypatch.setenv("FAULT_INJECT_OOM", "1")
+    budget = from_env(max_pixels=MAX_PIXELS, max_batch_size=4)
+    render = StubRenderer()
+
+    budget.render(render, (768, 768, 4), ["a", "b"])
+    budget.render(render, (768, 768, 4), ["c", "d"])
+
+    assert budget.total_ooms == 1
+    assert render.calls[-1] == ((768, 768, 4), ["c", "d"])
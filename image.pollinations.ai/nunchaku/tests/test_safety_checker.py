@@ -0,0 +1,91 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from diffusers.pipelines.stable_diffusion.safety_checker import cosine_distance  # noqa: E402
+
+from safety_checker.safety_checker import SPECIAL_CARE_ADJUSTMENT, score_concepts  # noqa: E402
+
+
+def legacy_scores(special_cos_dist, cos_dist, special_thresholds, concept_thresholds, safety_checker_adj):
+    """The per-image loop StableDiffusionSafetyChecker.forward ran before scoring was vectorized."""
+    special_cos_dist = special_cos_dist.cpu().float().numpy()
+    cos_dist = cos_dist.cpu().float().numpy()
+    result = []
+    for i in range(special_cos_dist.shape[0]):
+        result_img = {"special_scores": {}, "special_care": [], "concept_scores": {}, "bad_concepts": []}
+        adjustment = safety_checker_adj
+        for concept_idx in range(len(special_cos_dist[0])):
+            concept_threshold = special_thresholds[concept_idx].item()
+            result_img["special_scores"][concept_idx] = round(
+                special_cos_dist[i][concept_idx] - concept_threshold + adjustment, 3)
+            if result_img["special_scores"][concept_idx] > 0:
+                result_img["special_care"].append(concept_idx)
+                adjustment = SPECIAL_CARE_ADJUSTMENT
+        for concept_idx in range(len(cos_dist[0])):
+            concept_threshold = concept_thresholds[concept_idx].item()
+            result_img["concept_scores"][concept_idx] = round(
+                cos_dist[i][concept_idx] - concept_threshold + adjustment, 3)
+            if result_img["concept_scores"][concept_idx] > 0:
+                result_img["bad_concepts"].append(concept_idx)
+        result.append(result_img)
+    return result
+
+
+def assert_matches_legacy(special_cos_dist, cos_dist, special_thresholds, concept_thresholds, adj):
+    scores = score_concepts(special_cos_dist, cos_dist, special_thresholds, concept_thresholds, adj)
+    legacy = legacy_scores(special_cos_dist, cos_dist, special_thresholds, concept_thresholds, adj)
+
+    assert scores.has_nsfw.tolist() == [bool(img["bad_concepts"]) for img in legacy]
+    for new, old in zip(scores.to_json(), legacy):
+        assert new["special_scores"] == pytest.approx(old["special_scores"], abs=1e-3)
+        assert new["concept_scores"] == pytest.approx(old["concept_scores"], abs=1e-3)
+        assert new["bad_concepts"] == old["bad_concepts"]
+        # special_care used to be a list of {index, score} sets; it is now [index, score] pairs
+        assert [idx for idx, _ in new["special_care"]] == old["special_care"]
+        assert all(score == new["special_scores"][idx] for idx, score in new["special_care"])
+    return scores
+
+
+@pytest.mark.parametrize("adj", [0.0, -0.05, 0.05])
+def test_matches_legacy_loop_on_random_embeddings(adj):
+    generator = torch.Generator().manual_seed(0)
+    image_embeds = torch.randn(32, 64, generator=generator)
+    special_cos_dist = cosine_distance(image_embeds, torch.randn(3, 64, generator=generator))
+    cos_dist = cosine_distance(image_embeds, torch.randn(17, 64, generator=generator))
+    special_thresholds = torch.rand(3, generator=generator) * 0.3
+    concept_thresholds = 0.2 + torch.rand(17, generator=generator) * 0.2
+
+    scores = assert_matches_legacy(special_cos_dist, cos_dist, special_thresholds, concept_thresholds, adj)
+    # The batch exercises both sides of every threshold
+    assert scores.has_nsfw.any() and not scores.has_nsfw.all()
+    assert (scores.special_scores > 0).any()
+
+
+def test_special_care_adjustment_applies_before_concept_threshold():
+    special_thresholds = torch.tensor([0.5, 0.5, 0.5])
+    concept_thresholds = torch.tensor([0.5, 0.5])
+    special_cos_dist = torch.tensor([
+        [0.40, 0.56, 0.495],  # hits the second special concept, so the rest use the special-care adjustment
+        [0.40, 0.40, 0.40],  # no special-care hit, the caller's adjustment applies throughout
+    ])
+    # Both images sit just under every concept threshold
+    cos_dist = torch.tensor([[0.495, 0.495], [0.495, 0.495]])
+
+    scores = assert_matches_legacy(special_cos_dist, cos_dist, special_thresholds, concept_thresholds, -0.05)
+    first, second = scores.to_json()
+    assert first["special_scores"] == pytest.approx({0: -0.15, 1: 0.01, 2: 0.005})
+    assert first["special_care"] == [[1, pytest.approx(0.01)], [2, pytest.approx(0.005)]]
+    assert first["concept_scores"] == pytest.approx({0: 0.005, 1: 0.005})
+    assert second["special_care"] == []
+    assert second["concept_scores"] == pytest.approx({0: -0.055, 1: -0.055})
+    assert scores.has_nsfw.tolist() == [True, False]
+
+    # A larger adjustment than the special-care one is replaced by it after the hit
+    scores = assert_matches_legacy(special_cos_dist, cos_dist, special_thresholds, concept_thresholds, 0.03)
+    first, second = scores.to_json()
+    assert first["special_scores"] == pytest.approx({0: -0.07, 1: 0.09, 2: 0.005})
+    assert first["concept_scores"] == pytest.approx({0: 0.005, 1: 0.005})
+    assert second["concept_scores"] == pytest.approx({0: 0.025, 1: 0.025})
+    assert scores.has_nsfw.tolist() == [True, True]
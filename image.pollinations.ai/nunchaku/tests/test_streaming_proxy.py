@@ -0,0 +1,193 @@
+import asyncio
+import socket
+
+import httpx
+import pytest
+import uvicorn
+from aiohttp import web
+
+from streaming_proxy import StreamingProxy
+
+CHUNK_DELAY = 0.2
+
+
+class StubUpstream:
+    """A worker whose /stream sends three chunks CHUNK_DELAY apart and whose /slow
+    holds each request briefly, recording how many were in flight at once."""
+
+    def __init__(self):
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.runner = None
+        self.url = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/health", self.health)
+        app.router.add_get("/stream", self.stream)
+        app.router.add_get("/drop", self.drop)
+        app.router.add_post("/slow", self.slow)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, "127.0.0.1", 0).start()
+        host, port = self.runner.addresses[0][:2]
+        self.url = f"http://{host}:{port}"
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    async def health(self, request):
+        return web.Response(text="ok")
+
+    async def stream(self, request):
+        response = web.StreamResponse()
+        await response.prepare(request)
+        for idx in range(3):
+            if idx:
+                await asyncio.sleep(CHUNK_DELAY)
+            await response.write(f"chunk{idx};".encode())
+        await response.write_eof()
+        return response
+
+    async def drop(self, request):
+        """Sends the start of a body it announced as longer, then drops the connection."""
+        response = web.StreamResponse(headers={"Content-Length": "1000"})
+        await response.prepare(request)
+        await response.write(b"partial")
+        await asyncio.sleep(0.05)
+        request.transport.abort()
+        return response
+
+    async def slow(self, request):
+        body = await request.read()
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(0.1)
+        finally:
+            self.in_flight -= 1
+        return web.Response(body=body)
+
+
+def unused_url():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return f"http://127.0.0.1:{sock.getsockname()[1]}"
+
+
+async def serve(proxy):
+    """Run the proxy app on a real port, so responses reach the client as they are streamed."""
+    server = uvicorn.Server(uvicorn.Config(proxy.create_app(), host="127.0.0.1", port=0, log_level="warning"))
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+    port = server.servers[0].sockets[0].getsockname()[1]
+    return server, task, f"http://127.0.0.1:{port}"
+
+
+def run_proxy(scenario, upstream_url=None, **proxy_args):
+    async def main():
+        upstream = StubUpstream()
+        await upstream.start()
+        proxy = StreamingProxy(upstream_url or upstream.url, **proxy_args)
+        server, task, url = await serve(proxy)
+        try:
+            async with httpx.AsyncClient(base_url=url, timeout=10) as client:
+                return await scenario(client, upstream, proxy)
+        finally:
+            server.should_exit = True
+            await task
+            await upstream.stop()
+
+    return asyncio.run(main())
+
+
+def test_chunks_are_streamed_and_the_first_arrives_early():
+    async def scenario(client, upstream, proxy):
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        arrivals = []
+        async with client.stream("GET", "/stream") as response:
+            async for chunk in response.aiter_raw():
+                arrivals.append((loop.time() - started, chunk))
+        return response.status_code, arrivals
+
+    status, arrivals = run_proxy(scenario)
+
+    assert status == 200
+    assert b"".join(chunk for _, chunk in arrivals) == b"chunk0;chunk1;chunk2;"
+    # The first chunk is forwarded before the upstream has finished the body
+    assert len(arrivals) >= 2
+    assert arrivals[0][0] < CHUNK_DELAY
+    assert arrivals[-1][0] >= 2 * CHUNK_DELAY
+
+
+def test_at_most_three_requests_are_forwarded_at_once():
+    async def scenario(client, upstream, proxy):
+        responses = await asyncio.gather(*[client.post("/slow", content=f"body{idx}") for idx in range(9)])
+        return responses, upstream.max_in_flight
+
+    responses, max_in_flight = run_proxy(scenario, max_concurrency=3)
+
+    assert [response.status_code for response in responses] == [200] * 9
+    assert [response.text for response in responses] == [f"body{idx}" for idx in range(9)]
+    assert max_in_flight == 3
+
+
+def test_requests_beyond_the_queue_timeout_get_503():
+    async def scenario(client, upstream, proxy):
+        return await asyncio.gather(*[client.post("/slow", content="x") for _ in range(6)])
+
+    responses = run_proxy(scenario, max_concurrency=3, queue_timeout_seconds=0.02)
+
+    statuses = sorted(response.status_code for response in responses)
+    assert statuses == [200, 200, 200, 503, 503, 503]
+    assert all(response.headers["retry-after"] == "1" for response in responses if response.status_code == 503)
+
+
+def test_dead_upstream_gets_503():
+    async def scenario(client, upstream, proxy):
+        return await client.post("/slow", content="x")
+
+    response = run_proxy(scenario, upstream_url=unused_url(), ready_timeout_seconds=0.3)
+
+    assert response.status_code == 503
+    assert response.json() == {"error": "Internal service not available"}
+    assert response.headers["retry-after"] == "5"
+
+
+async def free_slots(proxy):
+    # Give the proxy a moment to finish tearing down the failed streams
+    for _ in range(50):
+        if proxy._slots._value == proxy.max_concurrency:
+            break
+        await asyncio.sleep(0.02)
+    return proxy._slots._value
+
+
+def test_upstream_dropping_mid_stream_frees_its_slot():
+    async def scenario(client, upstream, proxy):
+        for _ in range(proxy.max_concurrency + 1):
+            with pytest.raises(httpx.HTTPError):
+                async with client.stream("GET", "/drop") as response:
+                    async for _ in response.aiter_raw():
+                        pass
+        slots = await free_slots(proxy)
+        # Later requests are still served instead of getting 503s
+        return slots, await client.post("/slow", content="after")
+
+    slots, response = run_proxy(scenario, max_concurrency=3)
+
+    assert slots == 3
+    assert response.status_code == 200 and response.text == "after"
+
+
+def test_client_disconnecting_mid_stream_frees_its_slot():
+    async def scenario(client, upstream, proxy):
+        for _ in range(proxy.max_concurrency + 1):
+            async with client.stream("GET", "/stream") as response:
+                async for _ in response.aiter_raw():
+                    break
+        return await free_slots(proxy)
+
+    assert run_proxy(scenario, max_concurrency=3) == 3
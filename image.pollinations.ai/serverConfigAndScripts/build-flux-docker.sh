@@ -6,8 +6,9 @@ log() {
 
 # Build Docker image locally
 log "Building Docker image locally"
-cd ../nunchaku
-docker build -t voodoohop/flux-svdquant:latest . || { log "ERROR: Failed to build Docker image"; exit 1; }
+# The context is image.pollinations.ai, so the image also gets server_common
+cd ..
+docker build -f nunchaku/Dockerfile -t voodoohop/flux-svdquant:latest . || { log "ERROR: Failed to build Docker image"; exit 1; }
 
 # If a registry push is requested
 if [ "$1" = "--push" ]; then
@@ -0,0 +1,74 @@
+import base64
+import io
+import json
+import uuid
+from typing import Any, Dict, List, Optional
+
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+# Compact ASCII JSON of the fields below; the prompt is only returned in JSON mode,
+# so user text never ends up in response headers
+METADATA_HEADER = "X-Image-Metadata"
+METADATA_FIELDS = ("seed", "has_nsfw_concept", "concept", "width", "height")
+BINARY_MEDIA_TYPES = ("image/jpeg", "multipart/mixed")
+
+
+def encode_jpeg(image, **save_kwargs) -> memoryview:
+    """Encode a PIL image as JPEG and return a view of the encoder buffer, without copying it."""
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", **save_kwargs)
+    return buffer.getbuffer()
+
+
+def wants_binary(response_format: Optional[str], accept: Optional[str]) -> bool:
+    """Binary responses are opt-in, via `response_format` or the Accept header."""
+    if response_format:
+        return response_format.lower() == "binary"
+    if not accept:
+        return False
+    return any(media_type in accept for media_type in BINARY_MEDIA_TYPES)
+
+
+def image_metadata(result: Dict[str, Any]) -> str:
+    return json.dumps({k: result[k] for k in METADATA_FIELDS if k in result}, separators=(",", ":"))
+
+
+def json_response(results: List[Dict[str, Any]]) -> JSONResponse:
+    content = [{**result, "image": base64.b64encode(result["image"]).decode("utf-8")} for result in results]
+    return JSONResponse(content=content)
+
+
+def jpeg_response(result: Dict[str, Any]) -> Response:
+    return Response(
+        content=result["image"],
+        media_type="image/jpeg",
+        headers={METADATA_HEADER: image_metadata(result)},
+    )
+
+
+def multipart_response(results: List[Dict[str, Any]]) -> StreamingResponse:
+    """Stream a multipart/mixed body with one image/jpeg part per result."""
+    boundary = uuid.uuid4().hex
+
+    def parts():
+        for result in results:
+            yield (
+                f"--{boundary}\r\n"
+                f"Content-Type: image/jpeg\r\n"
+                f"Content-Length: {len(result['image'])}\r\n"
+                f"{METADATA_HEADER}: {image_metadata(result)}\r\n\r\n"
+            ).encode("ascii")
+            yield result["image"]
+            yield b"\r\n"
+        yield f"--{boundary}--\r\n".encode("ascii")
+
+    return StreamingResponse(parts(), media_type=f"multipart/mixed; boundary={boundary}")
+
+
+def build_response(results: List[Dict[str, Any]], binary: bool) -> Response:
+    """`results` hold the raw JPEG buffer under "image"; JSON responses base64 encode it."""
+    if not binary:
+        return json_response(results)
+    if len(results) == 1:
+        return jpeg_response(results[0])
+    return multipart_response(results)
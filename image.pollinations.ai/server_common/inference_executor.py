@@ -0,0 +1,92 @@
+import asyncio
+import functools
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+
+class ServerBusyError(Exception):
+    """Raised when accepting more work would exceed the in-flight limit."""
+
+
+class RequestTooLargeError(ValueError):
+    """Raised when one request asks for more images than are ever allowed in flight."""
+
+
+class InferenceExecutor:
+    """Keeps blocking model work off the asyncio event loop.
+
+    GPU work runs on a single dedicated thread so renders never contend for the
+    device, while JPEG encoding and safety post-processing run on a separate CPU
+    pool. `admit()` bounds the number of images accepted but not yet finished so
+    callers can answer with a 503 instead of queueing without limit; a request
+    that could never fit gets RequestTooLargeError instead, for a 400.
+    """
+
+    def __init__(self, max_in_flight: int = 16, cpu_workers: int = 4):
+        self.max_in_flight = max_in_flight
+        self.gpu_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="gpu")
+        self.cpu_pool = ThreadPoolExecutor(max_workers=cpu_workers, thread_name_prefix="cpu")
+        self._in_flight = 0
+        self._lock = threading.Lock()
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    @contextmanager
+    def admit(self, count: int = 1):
+        if count > self.max_in_flight:
+            raise RequestTooLargeError(f"{count} images requested, at most {self.max_in_flight} per request")
+        with self._lock:
+            if self._in_flight + count > self.max_in_flight:
+                raise ServerBusyError(f"{self._in_flight} images in flight (limit {self.max_in_flight})")
+            self._in_flight += count
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._in_flight -= count
+
+    async def run_gpu(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.gpu_pool, functools.partial(fn, *args, **kwargs))
+
+    async def run_cpu(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.cpu_pool, functools.partial(fn, *args, **kwargs))
+
+    def shutdown(self):
+        self.gpu_pool.shutdown(wait=False, cancel_futures=True)
+        self.cpu_pool.shutdown(wait=False, cancel_futures=True)
+
+
+def from_env(default_max_in_flight: int = 16) -> InferenceExecutor:
+    return InferenceExecutor(
+        max_in_flight=int(os.getenv("MAX_IN_FLIGHT", str(default_max_in_flight))),
+        cpu_workers=int(os.getenv("CPU_WORKERS", "4")),
+    )
+
+
+def timed(fn, *args, **kwargs):
+    """Call `fn` and return (result, elapsed seconds)."""
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+async def gather_or_cancel(*coroutines) -> list:
+    """Results of all coroutines, or the first error once the others have been cancelled.
+
+    For the images of one request: when one fails nobody reads the others, so
+    they shouldn't keep holding batch and GPU slots.
+    """
+    tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
@@ -0,0 +1,270 @@
+import bisect
+import json
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Tuple
+
+# Latency histogram buckets grow geometrically from 0.5ms to about 10 minutes,
+# so any quantile is off by at most half a bucket (about 9%)
+BUCKET_GROWTH = 1.2
+BUCKET_BOUNDS = [0.0005 * BUCKET_GROWTH ** i for i in range(78)]
+
+# Windows reported for every histogram and rate, in seconds
+WINDOWS = (60, 300)
+SLICE_SECONDS = 10
+QUANTILES = (0.5, 0.95, 0.99)
+
+# Stages reported by every server; each one may also time stages of its own
+STAGES = ("queue_wait", "text_encode", "denoise", "vae_decode", "safety", "encode")
+
+
+class _Slice:
+    __slots__ = ("index", "counts", "count", "sum")
+
+    def __init__(self, index: int, buckets: int):
+        self.index = index
+        self.counts = [0] * buckets
+        self.count = 0
+        self.sum = 0.0
+
+
+class RollingHistogram:
+    """Latency histogram over sliding windows, cheap enough to record every request.
+
+    Time is cut into `slice_seconds` slices kept in a ring that covers the
+    largest window; a value lands in its slice's fixed geometric bucket, so
+    recording is a bisect and a few increments under the lock. Quantiles are
+    computed on read by merging the slices inside the requested window.
+    """
+
+    def __init__(self, max_window: float = max(WINDOWS), slice_seconds: float = SLICE_SECONDS):
+        self.slice_seconds = slice_seconds
+        self.slices: List[Optional[_Slice]] = [None] * (int(math.ceil(max_window / slice_seconds)) + 1)
+        self.total_count = 0
+        self.total_sum = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, value: float, now: Optional[float] = None):
+        index = int((time.monotonic() if now is None else now) // self.slice_seconds)
+        bucket = bisect.bisect_left(BUCKET_BOUNDS, value)
+        with self._lock:
+            current = self.slices[index % len(self.slices)]
+            if current is None or current.index != index:
+                current = self.slices[index % len(self.slices)] = _Slice(index, len(BUCKET_BOUNDS) + 1)
+            current.counts[bucket] += 1
+            current.count += 1
+            current.sum += value
+            self.total_count += 1
+            self.total_sum += value
+
+    def window(self, seconds: float, now: Optional[float] = None) -> Tuple[List[int], int, float]:
+        """Merged (bucket counts, count, sum) of the values recorded in the last `seconds`."""
+        oldest = int(((time.monotonic() if now is None else now) - seconds) // self.slice_seconds)
+        counts = [0] * (len(BUCKET_BOUNDS) + 1)
+        count, total = 0, 0.0
+        with self._lock:
+            live = [s for s in self.slices if s is not None and s.index >= oldest]
+            for current in live:
+                for bucket, bucket_count in enumerate(current.counts):
+                    counts[bucket] += bucket_count
+                count += current.count
+                total += current.sum
+        return counts, count, total
+
+    def summary(self, seconds: float, now: Optional[float] = None) -> Dict[str, float]:
+        counts, count, total = self.window(seconds, now)
+        summary = {"count": count, "mean": total / count if count else 0.0}
+        for q in QUANTILES:
+            summary[f"p{round(q * 100)}"] = _quantile(counts, count, q)
+        return summary
+
+
+def _quantile(counts: List[int], count: int, q: float) -> float:
+    if not count:
+        return 0.0
+    rank = q * count
+    seen = 0
+    for bucket, bucket_count in enumerate(counts):
+        if seen + bucket_count >= rank and bucket_count:
+            if bucket == 0:
+                return BUCKET_BOUNDS[0]
+            if bucket == len(BUCKET_BOUNDS):
+                return BUCKET_BOUNDS[-1]
+            # Interpolate geometrically inside the bucket
+            lower, upper = BUCKET_BOUNDS[bucket - 1], BUCKET_BOUNDS[bucket]
+            return lower * (upper / lower) ** ((rank - seen) / bucket_count)
+        seen += bucket_count
+    return BUCKET_BOUNDS[-1]
+
+
+class RollingCounter:
+    """Sum of recorded amounts over sliding windows, e.g. images or GPU-busy seconds."""
+
+    def __init__(self, max_window: float = max(WINDOWS), slice_seconds: float = SLICE_SECONDS):
+        self.slice_seconds = slice_seconds
+        self.slices: List[List[float]] = [[-1, 0.0] for _ in range(int(math.ceil(max_window / slice_seconds)) + 1)]
+        self.total = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, amount: float, now: Optional[float] = None):
+        index = int((time.monotonic() if now is None else now) // self.slice_seconds)
+        with self._lock:
+            current = self.slices[index % len(self.slices)]
+            if current[0] != index:
+                current[0], current[1] = index, 0.0
+            current[1] += amount
+            self.total += amount
+
+    def window(self, seconds: float, now: Optional[float] = None) -> float:
+        oldest = int(((time.monotonic() if now is None else now) - seconds) // self.slice_seconds)
+        with self._lock:
+            return sum(amount for index, amount in self.slices if index >= oldest)
+
+
+class GPUTimer:
+    """Times one GPU call; `mark(stage)` records the time since the previous mark.
+
+    With a `synchronize` function (torch.cuda.synchronize) each mark waits for
+    the queued kernels first, so the time lands on the stage that ran them.
+    `step_end` can be passed as a diffusers `callback_on_step_end` to mark the
+    end of denoising from inside the pipeline call.
+    """
+
+    def __init__(self, metrics: "Metrics", synchronize: Optional[Callable[[], None]] = None):
+        self.metrics = metrics
+        self.synchronize = synchronize
+        self.started = self.last_mark = time.perf_counter()
+
+    def mark(self, stage: str):
+        if self.synchronize is not None:
+            self.synchronize()
+        now = time.perf_counter()
+        self.metrics.observe(stage, now - self.last_mark)
+        self.last_mark = now
+
+    def step_end(self, pipe, step_index, timestep, callback_kwargs):
+        if step_index == pipe.num_timesteps - 1:
+            self.mark("denoise")
+        return callback_kwargs
+
+
+class Metrics:
+    """Per-stage latency histograms, an image counter and GPU utilization for one server.
+
+    `snapshot()` reports each stage's count, mean and p50/p95/p99 over every
+    window in WINDOWS, along with images per second and the fraction of wall
+    time the GPU was busy, and the numbers of every cache registered with
+    `add_cache`; `export(fmt)` renders it for the /metrics endpoint. Windows
+    are cut by `clock`, which tests can replace with a fake one.
+    """
+
+    def __init__(self, service: str, clock: Callable[[], float] = time.monotonic):
+        self.service = service
+        self.clock = clock
+        self.started = clock()
+        self.stages: Dict[str, RollingHistogram] = {stage: RollingHistogram() for stage in STAGES}
+        self.images = RollingCounter()
+        self.gpu_busy = RollingCounter()
+        self.caches: Dict[str, Callable[[], Dict[str, float]]] = {}
+        self._lock = threading.Lock()
+
+    def add_cache(self, name: str, stats: Callable[[], Dict[str, float]]):
+        """Report `stats()`, e.g. hits, misses and size, as the cache `name`."""
+        self.caches[name] = stats
+
+    def observe(self, stage: str, seconds: float):
+        histogram = self.stages.get(stage)
+        if histogram is None:
+            with self._lock:
+                histogram = self.stages.setdefault(stage, RollingHistogram())
+        histogram.record(seconds, self.clock())
+
+    @contextmanager
+    def timer(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    @contextmanager
+    def gpu(self, synchronize: Optional[Callable[[], None]] = None):
+        """Time a GPU call as busy time, yielding a GPUTimer to split it into stages."""
+        timer = GPUTimer(self, synchronize)
+        try:
+            yield timer
+        finally:
+            self.gpu_busy.add(time.perf_counter() - timer.started, self.clock())
+
+    def count_images(self, count: int = 1):
+        self.images.add(count, self.clock())
+
+    def _elapsed(self, seconds: float) -> float:
+        # A server that started less than a window ago is measured over its uptime
+        return max(1e-9, min(seconds, self.clock() - self.started))
+
+    def images_per_second(self, seconds: float = WINDOWS[0]) -> float:
+        return self.images.window(seconds, self.clock()) / self._elapsed(seconds)
+
+    def gpu_utilization(self, seconds: float = WINDOWS[0]) -> float:
+        return min(1.0, self.gpu_busy.window(seconds, self.clock()) / self._elapsed(seconds))
+
+    def _cache_stats(self) -> Dict[str, Dict[str, float]]:
+        return {name: stats() for name, stats in list(self.caches.items())}
+
+    def snapshot(self) -> Dict:
+        windows = {}
+        for seconds in WINDOWS:
+            windows[f"{seconds}s"] = {
+                "images_per_second": round(self.images_per_second(seconds), 3),
+                "gpu_utilization": round(self.gpu_utilization(seconds), 3),
+                "stages": {
+                    stage: {name: round(value, 4) for name, value in histogram.summary(seconds, self.clock()).items()}
+                    for stage, histogram in list(self.stages.items())
+                },
+            }
+        return {
+            "service": self.service,
+            "uptime_seconds": round(self.clock() - self.started, 1),
+            "images_total": int(self.images.total),
+            "windows": windows,
+            "caches": self._cache_stats(),
+        }
+
+    def prometheus(self) -> str:
+        """Snapshot in the Prometheus text exposition format."""
+        labels = f'service="{self.service}"'
+        lines = [
+            "# TYPE pollinations_images_total counter",
+            f"pollinations_images_total{{{labels}}} {int(self.images.total)}",
+            "# TYPE pollinations_gpu_busy_seconds_total counter",
+            f"pollinations_gpu_busy_seconds_total{{{labels}}} {self.gpu_busy.total:.6f}",
+            "# TYPE pollinations_images_per_second gauge",
+            "# TYPE pollinations_gpu_utilization gauge",
+        ]
+        for seconds in WINDOWS:
+            window = f'{labels},window="{seconds}s"'
+            lines.append(f"pollinations_images_per_second{{{window}}} {self.images_per_second(seconds):.6f}")
+            lines.append(f"pollinations_gpu_utilization{{{window}}} {self.gpu_utilization(seconds):.6f}")
+        lines.append("# TYPE pollinations_stage_seconds summary")
+        for stage, histogram in list(self.stages.items()):
+            stage_labels = f'{labels},stage="{stage}"'
+            for seconds in WINDOWS:
+                counts, count, _ = histogram.window(seconds, self.clock())
+                for q in QUANTILES:
+                    lines.append(f'pollinations_stage_seconds{{{stage_labels},window="{seconds}s",quantile="{q}"}} '
+                                 f"{_quantile(counts, count, q):.6f}")
+            lines.append(f"pollinations_stage_seconds_sum{{{stage_labels}}} {histogram.total_sum:.6f}")
+            lines.append(f"pollinations_stage_seconds_count{{{stage_labels}}} {histogram.total_count}")
+        for name, stats in self._cache_stats().items():
+            for stat, value in stats.items():
+                lines.append(f'pollinations_cache_{stat}{{{labels},cache="{name}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+    def export(self, fmt: Optional[str] = None) -> Tuple[str, str]:
+        """(body, content type) for the /metrics endpoint; Prometheus text unless `fmt` is "json"."""
+        if fmt == "json":
+            return json.dumps(self.snapshot()), "application/json"
+        return self.prometheus(), "text/plain; version=0.0.4"
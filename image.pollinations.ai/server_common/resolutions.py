@@ -0,0 +1,88 @@
+from typing import Optional, Tuple
+
+# FLUX needs sides in multiples of 8 and an area divisible by 65536; quantized
+# models run out of memory above 768x768 (1024x1024 = 1,048,576 pixels)
+FLUX_MAX_PIXELS = 768 * 768
+# Past this the old spiral search gave up and returned the nearest multiples
+MAX_SEARCH_OFFSET = 100
+
+
+def _trailing_zeros(n: int) -> int:
+    return (n & -n).bit_length() - 1
+
+
+def _max_trailing_zeros(lo: int, hi: int) -> int:
+    """Largest power of two dividing some integer in [lo, hi], for 1 <= lo <= hi."""
+    return (hi ^ (lo - 1)).bit_length() - 1
+
+
+class ResolutionIndex:
+    """Snaps requested sizes to the nearest valid size in O(1).
+
+    A size is valid when both sides are multiples of `multiple` and the area
+    is divisible by `area_multiple`. In units of `multiple` that means the
+    product of the sides is divisible by 2**bits, i.e. the sides' trailing zero
+    bits add up to at least `bits`, so whether a window of candidates holds a
+    valid size only depends on the best-aligned value on each axis. Snapping
+    bisects for the smallest such window around the request and picks the same
+    size the original spiral search did: the lowest width, then height, at the
+    first offset with a valid candidate.
+    """
+
+    def __init__(self, multiple: int = 8, area_multiple: int = 65536,
+                 max_pixels: Optional[int] = None, min_pixels: Optional[int] = None):
+        unit_area, remainder = divmod(area_multiple, multiple * multiple)
+        if remainder or unit_area & (unit_area - 1):
+            raise ValueError("area_multiple must be a power-of-two multiple of multiple**2")
+        self.multiple = multiple
+        self.bits = unit_area.bit_length() - 1
+        self.max_pixels = max_pixels
+        self.min_pixels = min_pixels
+
+    def is_valid(self, width: int, height: int) -> bool:
+        return (width % self.multiple == 0 and height % self.multiple == 0
+                and (width * height) % (self.multiple * self.multiple << self.bits) == 0)
+
+    def snap(self, width: float, height: float) -> Tuple[int, int]:
+        """Scale into the pixel limits, keeping the aspect ratio, then return the nearest valid size."""
+        width, height = round(width), round(height)
+        pixels = width * height
+        if self.max_pixels and pixels > self.max_pixels:
+            scale = (self.max_pixels / pixels) ** 0.5
+            width, height = round(width * scale), round(height * scale)
+        elif self.min_pixels and 0 < pixels < self.min_pixels:
+            scale = (self.min_pixels / pixels) ** 0.5
+            width, height = round(width * scale), round(height * scale)
+
+        a, b = round(width / self.multiple), round(height / self.multiple)
+        if not self._has_valid(a, b, MAX_SEARCH_OFFSET - 1):
+            return a * self.multiple, b * self.multiple
+
+        lo, hi = 0, MAX_SEARCH_OFFSET - 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._has_valid(a, b, mid):
+                hi = mid
+            else:
+                lo = mid + 1
+
+        (a_lo, a_hi), (b_lo, b_hi) = self._window(a, lo), self._window(b, lo)
+        # Lowest width that pairs with some height in the window, then the lowest such height
+        step = 1 << max(self.bits - min(_max_trailing_zeros(b_lo, b_hi), self.bits), 0)
+        a = -(-a_lo // step) * step
+        step = 1 << max(self.bits - min(_trailing_zeros(a), self.bits), 0)
+        b = -(-b_lo // step) * step
+        return a * self.multiple, b * self.multiple
+
+    @staticmethod
+    def _window(center: int, offset: int) -> Tuple[int, int]:
+        return max(center - offset, 1), center + offset
+
+    def _has_valid(self, a: int, b: int, offset: int) -> bool:
+        (a_lo, a_hi), (b_lo, b_hi) = self._window(a, offset), self._window(b, offset)
+        if a_lo > a_hi or b_lo > b_hi:
+            return False
+        return _max_trailing_zeros(a_lo, a_hi) + _max_trailing_zeros(b_lo, b_hi) >= self.bits
+
+
+FLUX_RESOLUTIONS = ResolutionIndex(multiple=8, area_multiple=65536, max_pixels=FLUX_MAX_PIXELS)
@@ -0,0 +1,183 @@
+import asyncio
+import hashlib
+import json
+import os
+import struct
+import threading
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+HEADER_SIZE = struct.Struct(">I")
+
+# A cached entry is the list of result dicts for one render; "image" holds the JPEG bytes
+Results = List[Dict[str, Any]]
+
+
+def cache_key(**params) -> str:
+    """Content address of a deterministic render, e.g. model, prompt, seed, size and steps."""
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """Two-tier cache for renders with an explicit seed, which are deterministic.
+
+    Entries live in an in-memory LRU bounded by `max_memory_bytes` and are
+    written through to `directory`, whose total size is kept under
+    `max_disk_bytes` by evicting the least recently used files. Concurrent
+    requests for the same key share a single render.
+    """
+
+    def __init__(self, directory: str, max_memory_bytes: int, max_disk_bytes: int):
+        self.directory = directory
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.memory: "OrderedDict[str, Results]" = OrderedDict()
+        self.memory_bytes = 0
+        self.disk: "OrderedDict[str, int]" = OrderedDict()  # key -> file size, least recently used first
+        self.disk_bytes = 0
+        self.disk_lock = threading.Lock()
+        self.in_flight: Dict[str, asyncio.Task] = {}
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+        self._scan_disk()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "memory_entries": len(self.memory),
+            "memory_bytes": self.memory_bytes,
+            "disk_entries": len(self.disk),
+            "disk_bytes": self.disk_bytes,
+        }
+
+    async def get_or_compute(self, key: str, compute: Callable[[], Awaitable[Results]],
+                             store: Optional[Callable[[Results], bool]] = None) -> Results:
+        """Cached results for `key`, or those of `compute()`, which are kept unless `store` rejects them."""
+        results = self._get_memory(key)
+        if results is not None:
+            self.hits += 1
+            return results
+
+        task = self.in_flight.get(key)
+        if task is not None:
+            self.hits += 1
+        else:
+            # The render belongs to the cache rather than to the first caller, so
+            # cancelling any one caller never cancels it for the others
+            task = asyncio.create_task(self._load_or_compute(key, compute, store))
+            self.in_flight[key] = task
+            task.add_done_callback(lambda task: self._finished(key, task))
+        return await asyncio.shield(task)
+
+    async def _load_or_compute(self, key: str, compute: Callable[[], Awaitable[Results]],
+                               store: Optional[Callable[[Results], bool]]) -> Results:
+        results = await asyncio.to_thread(self._read_disk, key) if key in self.disk else None
+        if results is not None:
+            self.hits += 1
+            self._put_memory(key, results)
+            return results
+
+        self.misses += 1
+        results = await compute()
+        if store is None or store(results):
+            await asyncio.to_thread(self._write_disk, key, results)
+            self._put_memory(key, results)
+        return results
+
+    def _finished(self, key: str, task: asyncio.Task):
+        del self.in_flight[key]
+        if not task.cancelled():
+            # Every caller may have gone away; make sure an unretrieved error doesn't log a warning
+            task.exception()
+
+    def _get_memory(self, key: str) -> Optional[Results]:
+        results = self.memory.get(key)
+        if results is not None:
+            self.memory.move_to_end(key)
+        return results
+
+    def _put_memory(self, key: str, results: Results):
+        if key in self.memory:
+            return
+        self.memory[key] = results
+        self.memory_bytes += _entry_size(results)
+        while self.memory_bytes > self.max_memory_bytes and len(self.memory) > 1:
+            _, evicted = self.memory.popitem(last=False)
+            self.memory_bytes -= _entry_size(evicted)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.bin")
+
+    def _scan_disk(self):
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".bin"):
+                stat = os.stat(os.path.join(self.directory, name))
+                files.append((stat.st_mtime, name[:-len(".bin")], stat.st_size))
+        for _, key, size in sorted(files):
+            self.disk[key] = size
+            self.disk_bytes += size
+
+    def _read_disk(self, key: str) -> Optional[Results]:
+        """One file per entry: header length, JSON metadata, then the JPEG bytes back to back."""
+        try:
+            with open(self._path(key), "rb") as f:
+                data = f.read()
+            os.utime(self._path(key))
+        except FileNotFoundError:
+            return None
+        (header_size,) = HEADER_SIZE.unpack_from(data)
+        view = memoryview(data)
+        offset = HEADER_SIZE.size + header_size
+        results = []
+        for metadata in json.loads(view[HEADER_SIZE.size:offset].tobytes()):
+            image_size = metadata.pop("image_size")
+            results.append({**metadata, "image": view[offset:offset + image_size]})
+            offset += image_size
+        with self.disk_lock:
+            if key in self.disk:
+                self.disk.move_to_end(key)
+        return results
+
+    def _write_disk(self, key: str, results: Results):
+        header = json.dumps([
+            {**{k: v for k, v in result.items() if k != "image"}, "image_size": len(result["image"])}
+            for result in results
+        ]).encode("utf-8")
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(HEADER_SIZE.pack(len(header)))
+            f.write(header)
+            for result in results:
+                f.write(result["image"])
+        os.replace(tmp_path, path)
+
+        size = os.path.getsize(path)
+        evicted = []
+        with self.disk_lock:
+            self.disk_bytes += size - self.disk.pop(key, 0)
+            self.disk[key] = size
+            while self.disk_bytes > self.max_disk_bytes and len(self.disk) > 1:
+                evicted_key, evicted_size = self.disk.popitem(last=False)
+                self.disk_bytes -= evicted_size
+                evicted.append(evicted_key)
+        for evicted_key in evicted:
+            try:
+                os.remove(self._path(evicted_key))
+            except FileNotFoundError:
+                pass
+
+
+def _entry_size(results: Results) -> int:
+    return sum(len(result["image"]) for result in results)
+
+
+def from_env() -> ResultCache:
+    return ResultCache(
+        directory=os.getenv("RESULT_CACHE_DIR", "/tmp/imagecache/results"),
+        max_memory_bytes=int(float(os.getenv("RESULT_CACHE_MEMORY_MB", "256")) * 1024 * 1024),
+        max_disk_bytes=int(float(os.getenv("RESULT_CACHE_DISK_MB", "2048")) * 1024 * 1024),
+    )
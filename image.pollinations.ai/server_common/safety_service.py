@@ -0,0 +1,218 @@
+"""Shared safety-check service.
+
+One process holds the CLIP safety model and serves every generator process on
+the machine over a unix socket, so each worker no longer loads its own copy.
+Concurrent checks are coalesced into batched forward passes.
+
+It scores with the `safety_checker` package of the server it is started from, so
+run it from the nunchaku or image_gen_dmd2 directory:
+    python ../server_common/safety_service.py --socket /tmp/safety_checker.sock
+
+and point the generators at it with SAFETY_SERVICE_SOCKET=/tmp/safety_checker.sock,
+which makes `censor.check_safety` forward its images here.
+
+Wire format (both directions): 4-byte big-endian header length, JSON header.
+Requests are followed by the raw RGB bytes of every image listed in the header.
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+HEADER_SIZE = struct.Struct(">I")
+MAX_BATCH_IMAGES = 16
+MAX_WAIT_MS = 5
+
+
+def _to_rgb_images(x_image):
+    if isinstance(x_image, np.ndarray) or not isinstance(x_image[0], Image.Image):
+        images = np.asarray(x_image)
+        if images.ndim == 3:
+            images = images[None, ...]
+        images = (images * 255).round().astype("uint8")
+        return [Image.fromarray(image) for image in images]
+    return [image if image.mode == "RGB" else image.convert("RGB") for image in x_image]
+
+
+def _read_exactly(sock, size):
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        count = sock.recv_into(view[received:], size - received)
+        if count == 0:
+            raise ConnectionError("Safety service closed the connection")
+        received += count
+    return buffer
+
+
+class SafetyServiceClient:
+    """Blocking client, one persistent connection per calling thread."""
+
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+        self._local = threading.local()
+
+    def _connection(self):
+        sock = getattr(self._local, "sock", None)
+        if sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(self.socket_path)
+            self._local.sock = sock
+        return sock
+
+    def _close(self):
+        sock = getattr(self._local, "sock", None)
+        if sock is not None:
+            sock.close()
+            self._local.sock = None
+
+    def check(self, x_image, safety_checker_adj: float):
+        images = _to_rgb_images(x_image)
+        header = json.dumps({
+            "safety_checker_adj": safety_checker_adj,
+            "sizes": [image.size for image in images],
+        }).encode("utf-8")
+
+        try:
+            sock = self._connection()
+            sock.sendall(HEADER_SIZE.pack(len(header)) + header)
+            for image in images:
+                sock.sendall(image.tobytes())
+            (response_size,) = HEADER_SIZE.unpack(_read_exactly(sock, HEADER_SIZE.size))
+            response = json.loads(_read_exactly(sock, response_size))
+        except Exception:
+            self._close()
+            raise
+
+        if "error" in response:
+            raise RuntimeError(f"Safety service error: {response['error']}")
+        return response["concepts"], response["has_nsfw_concept"]
+
+
+class SafetyCheckService:
+    """Coalesces concurrent checks from all connections into batched forward passes."""
+
+    def __init__(self, check_fn, max_batch_images=MAX_BATCH_IMAGES, max_wait_ms=MAX_WAIT_MS):
+        self.check_fn = check_fn
+        self.max_batch_images = max_batch_images
+        self.max_wait = max_wait_ms / 1000
+        self.queue = asyncio.Queue()
+        # The model is only ever used from this one thread
+        self.model_thread = ThreadPoolExecutor(max_workers=1, thread_name_prefix="safety")
+
+    async def check(self, images, safety_checker_adj):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((images, safety_checker_adj, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            image_count = len(batch[0][0])
+            deadline = loop.time() + self.max_wait
+            while image_count < self.max_batch_images:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                batch.append(item)
+                image_count += len(item[0])
+
+            # The adjustment changes the scoring, so each distinct value gets its own forward pass
+            by_adj = {}
+            for item in batch:
+                by_adj.setdefault(item[1], []).append(item)
+            for safety_checker_adj, items in by_adj.items():
+                await self._run_batch(safety_checker_adj, items)
+
+    async def _run_batch(self, safety_checker_adj, items):
+        images = [image for item in items for image in item[0]]
+        start = time.time()
+        try:
+            concepts, has_nsfw_concept = await asyncio.get_running_loop().run_in_executor(
+                self.model_thread, self.check_fn, images, safety_checker_adj
+            )
+        except Exception as e:
+            for _, _, future in items:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        print(f"Checked {len(images)} images from {len(items)} requests in {time.time() - start:.3f} seconds")
+
+        offset = 0
+        for item_images, _, future in items:
+            count = len(item_images)
+            if not future.done():
+                future.set_result((concepts[offset:offset + count], has_nsfw_concept[offset:offset + count]))
+            offset += count
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    (header_size,) = HEADER_SIZE.unpack(await reader.readexactly(HEADER_SIZE.size))
+                except asyncio.IncompleteReadError:
+                    break
+                header = json.loads(await reader.readexactly(header_size))
+                images = []
+                for width, height in header["sizes"]:
+                    data = await reader.readexactly(width * height * 3)
+                    images.append(Image.frombuffer("RGB", (width, height), data, "raw", "RGB", 0, 1))
+
+                try:
+                    concepts, has_nsfw_concept = await self.check(images, header["safety_checker_adj"])
+                    response = {"concepts": concepts, "has_nsfw_concept": has_nsfw_concept}
+                except Exception as e:
+                    response = {"error": str(e)}
+
+                body = json.dumps(response).encode("utf-8")
+                writer.write(HEADER_SIZE.pack(len(body)) + body)
+                await writer.drain()
+        finally:
+            writer.close()
+
+
+async def serve(socket_path, max_batch_images=MAX_BATCH_IMAGES, max_wait_ms=MAX_WAIT_MS):
+    from safety_checker.censor import check_safety_local, safety_cache
+
+    def check_fn(images, safety_checker_adj):
+        return safety_cache.check(images, safety_checker_adj, check_safety_local)
+
+    service = SafetyCheckService(check_fn, max_batch_images, max_wait_ms)
+    worker = asyncio.create_task(service.run())
+    server = await asyncio.start_unix_server(service.handle_connection, path=socket_path)
+    print(f"Safety check service listening on {socket_path}")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        worker.cancel()
+
+
+if __name__ == "__main__":
+    # The model code lives in the safety_checker package of the server directory
+    sys.path.insert(0, os.getcwd())
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--socket", default="/tmp/safety_checker.sock", help="path of the unix socket to listen on")
+    parser.add_argument("--max-batch-images", type=int, default=MAX_BATCH_IMAGES)
+    parser.add_argument("--max-wait-ms", type=float, default=MAX_WAIT_MS)
+    args = parser.parse_args()
+
+    if os.path.exists(args.socket):
+        os.remove(args.socket)
+    asyncio.run(serve(args.socket, args.max_batch_images, args.max_wait_ms))
@@ -0,0 +1,182 @@
+import hashlib
+import importlib
+import json
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional
+
+
+class StartupTimeline:
+    """Records how long each startup phase took and on which thread, for a per-phase report."""
+
+    def __init__(self, service: str):
+        self.service = service
+        self.started = time.monotonic()
+        self.phases: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            end = time.monotonic()
+            with self._lock:
+                self.phases.append({
+                    "phase": name,
+                    "thread": threading.current_thread().name,
+                    "start": round(start - self.started, 3),
+                    "seconds": round(end - start, 3),
+                })
+
+    def as_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            phases = sorted(self.phases, key=lambda phase: phase["start"])
+        return {
+            "service": self.service,
+            "total_seconds": round(max((p["start"] + p["seconds"] for p in phases), default=0.0), 3),
+            "phases": phases,
+        }
+
+    def report(self):
+        timeline = self.as_dict()
+        lines = [f"{self.service} startup took {timeline['total_seconds']:.1f} seconds:"]
+        for phase in timeline["phases"]:
+            lines.append(f"  {phase['start']:7.1f}s +{phase['seconds']:6.1f}s  {phase['phase']} [{phase['thread']}]")
+        print("\n".join(lines))
+
+
+def load_parallel(loaders: Dict[str, Callable[[], Any]], timeline: Optional[StartupTimeline] = None) -> Dict[str, Any]:
+    """Run independent loaders on their own threads and return their results by name.
+
+    Model loading is mostly disk reads, decompression and host-to-device
+    copies that release the GIL, so independent components load concurrently.
+    The first exception is re-raised once every loader has finished.
+    """
+    def run(name, load):
+        if timeline is None:
+            return load()
+        with timeline.phase(name):
+            return load()
+
+    with ThreadPoolExecutor(max_workers=max(1, len(loaders)), thread_name_prefix="load") as pool:
+        futures = {name: pool.submit(run, name, load) for name, load in loaders.items()}
+    return {name: future.result() for name, future in futures.items()}
+
+
+class LazyImport:
+    """Module (or one of its attributes) imported on first attribute access.
+
+    Keeps heavy optional imports such as `clip` or `transformers` model classes
+    off the import path of servers that may never use them.
+    """
+
+    def __init__(self, module: str, attribute: Optional[str] = None):
+        self._module = module
+        self._attribute = attribute
+        self._value = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        if self._value is None:
+            with self._lock:
+                if self._value is None:
+                    value = importlib.import_module(self._module)
+                    self._value = getattr(value, self._attribute) if self._attribute else value
+        return self._value
+
+    def __getattr__(self, name):
+        return getattr(self.load(), name)
+
+    def __call__(self, *args, **kwargs):
+        return self.load()(*args, **kwargs)
+
+
+class LazyLoader:
+    """Value built by `load()` on first `get()`, or ahead of time by `prefetch()` on a background thread."""
+
+    def __init__(self, name: str, load: Callable[[], Any], timeline: Optional[StartupTimeline] = None):
+        self.name = name
+        self._load = load
+        self._timeline = timeline
+        self._value = None
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def get(self):
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    if self._timeline is None:
+                        self._value = self._load()
+                    else:
+                        with self._timeline.phase(f"lazy:{self.name}"):
+                            self._value = self._load()
+                    self._loaded = True
+        return self._value
+
+    def prefetch(self):
+        def run():
+            try:
+                self.get()
+            except Exception as e:
+                # The next get() tries again and raises to its caller
+                print(f"Prefetching {self.name} failed: {e}")
+        threading.Thread(target=run, name=f"prefetch-{self.name}", daemon=True).start()
+
+
+class WarmStartSnapshot:
+    """Modules saved after expensive one-time preparation, such as fusing LoRAs and converting to fp16.
+
+    `load_or_build` builds the module on the first start and saves it under a
+    directory named after `fingerprint`; later starts load the saved copy
+    instead (diffusers loads safetensors by memory-mapping them), skipping the
+    LoRA download and fuse. Changing anything in the fingerprint builds a new
+    snapshot. Snapshots are written to a temporary directory and renamed into
+    place, so an interrupted save is never loaded.
+    """
+
+    def __init__(self, directory: Optional[str]):
+        self.directory = directory
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def path(self, name: str, **fingerprint) -> str:
+        digest = hashlib.sha256(json.dumps(fingerprint, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self.directory, f"{name}-{digest}")
+
+    def load_or_build(self, name: str, build: Callable[[], Any], load: Callable[[str], Any],
+                      save: Callable[[Any, str], None] = lambda module, path: module.save_pretrained(path),
+                      **fingerprint) -> Any:
+        if not self.directory:
+            return build()
+        path = self.path(name, **fingerprint)
+        if os.path.isdir(path):
+            try:
+                return load(path)
+            except Exception as e:
+                print(f"Warm-start snapshot {path} failed to load, rebuilding: {e}")
+                shutil.rmtree(path, ignore_errors=True)
+
+        module = build()
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            save(module, tmp_path)
+            os.replace(tmp_path, path)
+            print(f"Saved warm-start snapshot {path}")
+        except OSError as e:
+            # Another worker may have saved the same snapshot first; either copy is fine
+            print(f"Could not save warm-start snapshot {path}: {e}")
+        finally:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        return module
+
+
+def from_env() -> WarmStartSnapshot:
+    # An empty WARM_START_DIR disables snapshots
+    return WarmStartSnapshot(os.getenv("WARM_START_DIR", "/tmp/warm-start"))
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The servers add this directory to their path and import the modules flat
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
@@ -0,0 +1,45 @@
+import asyncio
+import base64
+import json
+
+from image_responses import METADATA_HEADER, build_response
+
+RESULT = {
+    "image": b"\xff\xd8jpeg\xff\xd9",
+    "has_nsfw_concept": False,
+    "concept": [],
+    "width": 1024,
+    "height": 768,
+    "seed": 42,
+    "prompt": "a café at night\r\nX-Injected: 1",
+}
+METADATA = {"seed": 42, "has_nsfw_concept": False, "concept": [], "width": 1024, "height": 768}
+
+
+def read_body(response):
+    async def collect():
+        return b"".join([chunk async for chunk in response.body_iterator])
+
+    return asyncio.run(collect())
+
+
+def test_jpeg_header_only_carries_whitelisted_fields():
+    response = build_response([RESULT], binary=True)
+    assert response.body == RESULT["image"]
+    assert json.loads(response.headers[METADATA_HEADER]) == METADATA
+
+
+def test_multipart_parts_only_carry_whitelisted_fields():
+    response = build_response([RESULT, {**RESULT, "seed": 43}], binary=True)
+    body = read_body(response)
+    assert b"X-Injected" not in body and b"caf" not in body
+
+    headers = [line for line in body.split(b"\r\n") if line.startswith(METADATA_HEADER.encode() + b":")]
+    assert [json.loads(line.split(b": ", 1)[1]) for line in headers] == [METADATA, {**METADATA, "seed": 43}]
+
+
+def test_json_mode_keeps_the_prompt():
+    response = build_response([RESULT], binary=False)
+    [content] = json.loads(response.body)
+    assert content["prompt"] == RESULT["prompt"]
+    assert base64.b64decode(content["image"]) == RESULT["image"]
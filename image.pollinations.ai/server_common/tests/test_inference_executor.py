@@ -0,0 +1,56 @@
+import asyncio
+
+import pytest
+
+from inference_executor import InferenceExecutor, RequestTooLargeError, ServerBusyError, gather_or_cancel
+
+
+def test_admit_counts_images_in_flight():
+    executor = InferenceExecutor(max_in_flight=4, cpu_workers=1)
+    try:
+        with executor.admit(3):
+            assert executor.in_flight == 3
+            with pytest.raises(ServerBusyError):
+                with executor.admit(2):
+                    pass
+            with executor.admit(1):
+                assert executor.in_flight == 4
+        assert executor.in_flight == 0
+    finally:
+        executor.shutdown()
+
+
+def test_requests_larger_than_the_limit_are_rejected_even_when_idle():
+    executor = InferenceExecutor(max_in_flight=4, cpu_workers=1)
+    try:
+        with executor.admit(4):
+            pass
+        with pytest.raises(RequestTooLargeError, match="5 images requested"):
+            with executor.admit(5):
+                pass
+        assert executor.in_flight == 0
+    finally:
+        executor.shutdown()
+
+
+def test_gather_or_cancel_cancels_the_rest_on_the_first_error():
+    finished = []
+
+    async def image(idx, delay, error=None):
+        await asyncio.sleep(delay)
+        if error is not None:
+            raise error
+        finished.append(idx)
+        return idx
+
+    async def scenario():
+        assert await gather_or_cancel(image(0, 0.01), image(1, 0)) == [0, 1]
+        finished.clear()
+        with pytest.raises(ServerBusyError):
+            await gather_or_cancel(image(0, 0.01, ServerBusyError("busy")), image(1, 0.2), image(2, 0.2))
+        # Give the cancelled images the time they would have needed
+        await asyncio.sleep(0.3)
+
+    asyncio.run(scenario())
+
+    assert finished == []
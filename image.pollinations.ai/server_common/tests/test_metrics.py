@@ -0,0 +1,148 @@
+import json
+import re
+
+import pytest
+
+from metrics import BUCKET_BOUNDS, BUCKET_GROWTH, QUANTILES, Metrics, RollingCounter, RollingHistogram, _quantile
+
+
+def test_registered_caches_are_exported():
+    metrics = Metrics("flux")
+    stats = {"hits": 3, "misses": 1, "size": 4}
+    metrics.add_cache("safety", lambda: stats)
+
+    body, _ = metrics.export("json")
+    assert json.loads(body)["caches"] == {"safety": {"hits": 3, "misses": 1, "size": 4}}
+
+    stats["hits"] = 5
+    body, content_type = metrics.export()
+    assert content_type.startswith("text/plain")
+    assert 'pollinations_cache_hits{service="flux",cache="safety"} 5' in body.splitlines()
+    assert 'pollinations_cache_size{service="flux",cache="safety"} 4' in body.splitlines()
+
+
+class FakeClock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def test_quantiles_match_known_samples():
+    histogram = RollingHistogram()
+    # 1000 samples spread evenly over 1ms..1s
+    for i in range(1, 1001):
+        histogram.record(i / 1000, now=0)
+
+    summary = histogram.summary(60, now=5)
+    assert summary["count"] == 1000
+    assert summary["mean"] == pytest.approx(0.5005)
+    # Within half a bucket of the exact quantile
+    for name, expected in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99)):
+        assert summary[name] == pytest.approx(expected, rel=BUCKET_GROWTH - 1)
+
+
+def test_quantiles_of_a_single_value_stay_in_its_bucket():
+    histogram = RollingHistogram()
+    for _ in range(10):
+        histogram.record(0.1, now=0)
+    counts, count, total = histogram.window(60, now=0)
+    assert count == 10 and total == pytest.approx(1.0)
+    bucket = counts.index(10)
+    for q in QUANTILES:
+        assert BUCKET_BOUNDS[bucket - 1] <= _quantile(counts, count, q) <= BUCKET_BOUNDS[bucket]
+
+
+def test_quantile_edges():
+    empty = [0] * (len(BUCKET_BOUNDS) + 1)
+    assert _quantile(empty, 0, 0.5) == 0.0
+
+    histogram = RollingHistogram()
+    histogram.record(0.0, now=0)
+    histogram.record(BUCKET_BOUNDS[-1] * 10, now=0)
+    counts, count, _ = histogram.window(60, now=0)
+    assert _quantile(counts, count, 0.5) == BUCKET_BOUNDS[0]
+    assert _quantile(counts, count, 0.99) == BUCKET_BOUNDS[-1]
+
+
+def test_histogram_window_drops_expired_slices():
+    histogram = RollingHistogram(max_window=60, slice_seconds=10)
+    histogram.record(1.0, now=5)  # slice 0
+    histogram.record(2.0, now=15)  # slice 1
+    histogram.record(4.0, now=65)  # slice 6
+
+    # The window reaches back into the slice holding now - seconds
+    assert histogram.window(60, now=65)[1:] == (3, 7.0)
+    assert histogram.window(60, now=70)[1:] == (2, 6.0)
+    assert histogram.window(10, now=70)[1:] == (1, 4.0)
+    assert histogram.window(60, now=200)[1:] == (0, 0.0)
+
+
+def test_histogram_ring_reuses_old_slices():
+    histogram = RollingHistogram(max_window=60, slice_seconds=10)
+    assert len(histogram.slices) == 7
+    histogram.record(1.0, now=5)  # slice 0
+    histogram.record(2.0, now=75)  # slice 7 overwrites slice 0's place in the ring
+
+    assert histogram.window(1000, now=75)[1:] == (1, 2.0)
+    # Totals are kept for the whole lifetime
+    assert histogram.total_count == 2
+    assert histogram.total_sum == pytest.approx(3.0)
+
+
+def test_counter_windows():
+    counter = RollingCounter(max_window=60, slice_seconds=10)
+    counter.add(1, now=5)
+    counter.add(2, now=15)
+    counter.add(3, now=16)
+    counter.add(4, now=65)
+
+    assert counter.window(60, now=65) == 10
+    assert counter.window(60, now=70) == 9
+    assert counter.window(10, now=70) == 4
+    assert counter.window(60, now=200) == 0
+
+    counter.add(5, now=75)  # reuses slice 0's place in the ring
+    assert counter.window(1000, now=75) == 14
+    assert counter.total == 15
+
+
+def test_prometheus_export():
+    clock = FakeClock()
+    metrics = Metrics("flux", clock=clock)
+    clock.now += 120
+    for seconds in (0.1, 0.2, 0.3, 0.4):
+        metrics.observe("denoise", seconds)
+    metrics.count_images(30)
+    metrics.gpu_busy.add(15, clock())
+    clock.now += 5
+
+    lines = metrics.prometheus().splitlines()
+    samples = {}
+    for line in lines:
+        if line.startswith("#"):
+            assert re.fullmatch(r"# TYPE pollinations_\w+ (counter|gauge|summary)", line)
+            continue
+        match = re.fullmatch(r'(pollinations_\w+)\{((?:\w+="[^"]*",)*\w+="[^"]*")\} (\S+)', line)
+        assert match, line
+        samples[match.group(1) + "{" + match.group(2) + "}"] = float(match.group(3))
+
+    assert samples['pollinations_images_total{service="flux"}'] == 30
+    assert samples['pollinations_gpu_busy_seconds_total{service="flux"}'] == 15
+    assert samples['pollinations_images_per_second{service="flux",window="60s"}'] == pytest.approx(0.5)
+    # The server is only 125s old, so the 300s window covers its uptime
+    assert samples['pollinations_images_per_second{service="flux",window="300s"}'] == pytest.approx(30 / 125)
+    assert samples['pollinations_gpu_utilization{service="flux",window="60s"}'] == pytest.approx(0.25)
+    assert samples['pollinations_stage_seconds_count{service="flux",stage="denoise"}'] == 4
+    assert samples['pollinations_stage_seconds_sum{service="flux",stage="denoise"}'] == pytest.approx(1.0)
+    p50 = samples['pollinations_stage_seconds{service="flux",stage="denoise",window="60s",quantile="0.5"}']
+    assert 0.2 / BUCKET_GROWTH <= p50 <= 0.2 * BUCKET_GROWTH
+    # Stages with no samples still report zeros
+    assert samples['pollinations_stage_seconds{service="flux",stage="vae_decode",window="60s",quantile="0.99"}'] == 0
+
+    # Once the samples age out of the window only the totals remain
+    clock.now += 400
+    body = metrics.prometheus()
+    assert 'pollinations_images_per_second{service="flux",window="60s"} 0.000000' in body.splitlines()
+    assert 'pollinations_stage_seconds_count{service="flux",stage="denoise"} 4' in body.splitlines()
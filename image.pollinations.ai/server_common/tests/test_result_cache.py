@@ -0,0 +1,94 @@
+import asyncio
+
+import pytest
+
+from result_cache import ResultCache, cache_key
+
+
+def make_cache(tmp_path):
+    return ResultCache(str(tmp_path), max_memory_bytes=1024 * 1024, max_disk_bytes=1024 * 1024)
+
+
+def test_concurrent_requests_share_one_render(tmp_path):
+    cache = make_cache(tmp_path)
+    renders = []
+
+    async def compute():
+        renders.append(None)
+        await asyncio.sleep(0.05)
+        return [{"image": b"jpeg", "seed": 1}]
+
+    async def scenario():
+        key = cache_key(prompt="cat", seed=1)
+        return await asyncio.gather(*[cache.get_or_compute(key, compute) for _ in range(5)])
+
+    results = asyncio.run(scenario())
+
+    assert len(renders) == 1
+    assert all(result == [{"image": b"jpeg", "seed": 1}] for result in results)
+    assert (cache.hits, cache.misses) == (4, 1)
+
+
+def test_cancelling_the_first_caller_does_not_cancel_the_others(tmp_path):
+    cache = make_cache(tmp_path)
+
+    async def compute():
+        await asyncio.sleep(0.1)
+        return [{"image": b"jpeg"}]
+
+    async def scenario():
+        key = cache_key(prompt="cat", seed=1)
+        leader = asyncio.create_task(cache.get_or_compute(key, compute))
+        await asyncio.sleep(0.01)
+        waiter = asyncio.create_task(cache.get_or_compute(key, compute))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        results = await waiter
+        # The finished render was cached even though the caller that started it left
+        return results, await cache.get_or_compute(key, compute), cache.in_flight
+
+    results, cached, in_flight = asyncio.run(scenario())
+
+    assert results == cached == [{"image": b"jpeg"}]
+    assert in_flight == {}
+
+
+def test_errors_reach_every_caller_and_are_not_cached(tmp_path):
+    cache = make_cache(tmp_path)
+    attempts = []
+
+    async def compute():
+        attempts.append(None)
+        await asyncio.sleep(0.01)
+        raise RuntimeError("CUDA out of memory")
+
+    async def scenario():
+        key = cache_key(prompt="cat", seed=1)
+        first = await asyncio.gather(*[cache.get_or_compute(key, compute) for _ in range(3)], return_exceptions=True)
+        second = await asyncio.gather(cache.get_or_compute(key, compute), return_exceptions=True)
+        return first + second
+
+    errors = asyncio.run(scenario())
+
+    assert [str(error) for error in errors] == ["CUDA out of memory"] * 4
+    assert len(attempts) == 2
+
+
+def test_rejected_results_are_not_stored(tmp_path):
+    cache = make_cache(tmp_path)
+
+    async def compute():
+        return [{"image": b"nsfw", "has_nsfw_concept": True}]
+
+    def store(results):
+        return not any(result["has_nsfw_concept"] for result in results)
+
+    async def scenario():
+        await cache.get_or_compute("key", compute, store=store)
+
+    asyncio.run(scenario())
+
+    assert cache.stats()["memory_entries"] == 0
+    assert cache.stats()["disk_entries"] == 0
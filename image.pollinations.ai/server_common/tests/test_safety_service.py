@@ -0,0 +1,67 @@
+import asyncio
+import os
+
+import numpy as np
+from PIL import Image
+
+from safety_service import SafetyCheckService, SafetyServiceClient
+
+
+class FakeChecker:
+    """Flags images whose top-left pixel is red, recording every batch it is called with."""
+
+    def __init__(self):
+        self.batches = []
+
+    def __call__(self, images, safety_checker_adj):
+        self.batches.append((len(images), safety_checker_adj))
+        nsfw = [image.getpixel((0, 0))[0] > 128 for image in images]
+        return [{"bad_concepts": [0] if flagged else []} for flagged in nsfw], nsfw
+
+
+def image(red):
+    return Image.new("RGB", (8, 4), (255 if red else 0, 0, 0))
+
+
+def test_concurrent_checks_are_coalesced_per_adjustment():
+    checker = FakeChecker()
+
+    async def scenario():
+        service = SafetyCheckService(checker, max_wait_ms=50)
+        worker = asyncio.create_task(service.run())
+        try:
+            return await asyncio.gather(
+                service.check([image(True), image(False)], 0.0),
+                service.check([image(False)], 0.0),
+                service.check([image(True)], 0.05),
+            )
+        finally:
+            worker.cancel()
+
+    results = asyncio.run(scenario())
+    assert [nsfw for _, nsfw in results] == [[True, False], [False], [True]]
+    assert sorted(checker.batches) == [(1, 0.05), (3, 0.0)]
+
+
+def test_client_round_trip_over_unix_socket(tmp_path):
+    checker = FakeChecker()
+    socket_path = os.path.join(str(tmp_path), "safety.sock")
+
+    async def scenario():
+        service = SafetyCheckService(checker)
+        worker = asyncio.create_task(service.run())
+        server = await asyncio.start_unix_server(service.handle_connection, path=socket_path)
+        client = SafetyServiceClient(socket_path)
+        try:
+            first = await asyncio.to_thread(client.check, [image(True), image(False)], 0.0)
+            # Float arrays in [0, 1] are converted the way the local checker converts them
+            second = await asyncio.to_thread(client.check, np.zeros((4, 8, 3)), 0.0)
+            return first, second
+        finally:
+            client._close()
+            server.close()
+            worker.cancel()
+
+    first, second = asyncio.run(scenario())
+    assert first == ([{"bad_concepts": [0]}, {"bad_concepts": []}], [True, False])
+    assert second == ([{"bad_concepts": []}], [False])
@@ -0,0 +1,147 @@
+import math
+import os
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# (width, height, batch size)
+Bucket = Tuple[int, int, int]
+
+
+def parse_buckets(spec: str) -> List[Bucket]:
+    """Parse "1024x1024,768x1344x4" into buckets; the batch size defaults to 1."""
+    buckets = []
+    for item in spec.replace(" ", "").split(","):
+        if not item:
+            continue
+        parts = [int(part) for part in item.lower().split("x")]
+        if len(parts) not in (2, 3):
+            raise ValueError(f"Invalid warmup bucket {item!r}, expected WIDTHxHEIGHT or WIDTHxHEIGHTxBATCH")
+        buckets.append((parts[0], parts[1], parts[2] if len(parts) == 3 else 1))
+    return buckets
+
+
+class BucketPolicy:
+    """Snaps request sizes onto warmed sizes that are close enough.
+
+    A warmed size is close enough when its aspect ratio is within
+    `max_aspect_change` and its area within `max_area_change` of the request
+    (both relative). Of those, the one with the nearest aspect ratio, then the
+    nearest area, wins. Other sizes are returned unchanged and render cold.
+    """
+
+    def __init__(self, sizes: List[Tuple[int, int]], max_aspect_change: float = 0.05, max_area_change: float = 0.15):
+        self.sizes = sorted(set(sizes))
+        self.max_aspect_change = max_aspect_change
+        self.max_area_change = max_area_change
+
+    def snap(self, width: int, height: int, max_pixels: Optional[int] = None) -> Tuple[int, int]:
+        if width <= 0 or height <= 0:
+            return width, height
+        best, best_distance = None, None
+        for size in self.sizes:
+            if max_pixels is not None and size[0] * size[1] > max_pixels:
+                continue
+            aspect_change = abs(math.log((size[0] / size[1]) / (width / height)))
+            area_change = abs(math.log((size[0] * size[1]) / (width * height)))
+            if aspect_change > math.log1p(self.max_aspect_change) or area_change > math.log1p(self.max_area_change):
+                continue
+            distance = (aspect_change, area_change)
+            if best_distance is None or distance < best_distance:
+                best, best_distance = size, distance
+        return best if best is not None else (width, height)
+
+
+class Warmup:
+    """Synthetic renders over resolution/batch buckets, run before a server reports ready.
+
+    The first render at a new shape pays for cuDNN autotuning, allocator growth
+    and, with `compile_mode`, graph compilation; `run` pays it up front for
+    every bucket. Buckets are passed through `snap_size` first so they match
+    the sizes requests are snapped to. With `snap_requests`, `snap` moves
+    request sizes onto warmed buckets when they are close. With
+    `cudnn_benchmark`, cuDNN picks the fastest kernels for each warmed shape.
+
+    `compile` wraps a module in torch.compile with static shapes, so each bucket
+    gets its own graph, and inductor's on-disk FX graph cache under
+    `compile_cache_dir`, so restarts reuse the graphs compiled for each bucket
+    instead of compiling them again.
+    """
+
+    def __init__(self, buckets: List[Bucket], repeats: int = 1, snap_requests: bool = True,
+                 snap_size: Optional[Callable[[int, int], Tuple[int, int]]] = None,
+                 compile_mode: Optional[str] = None, compile_cache_dir: str = "/tmp/torch-compile-cache",
+                 cudnn_benchmark: bool = True):
+        if snap_size is not None:
+            buckets = [(*snap_size(width, height), batch_size) for width, height, batch_size in buckets]
+        self.buckets = list(dict.fromkeys(buckets))
+        self.repeats = max(1, repeats)
+        self.snap_requests = snap_requests
+        self.compile_mode = compile_mode
+        self.compile_cache_dir = compile_cache_dir
+        self.cudnn_benchmark = cudnn_benchmark
+        self.policy = BucketPolicy([])
+        self.results: Dict[str, Dict[str, Any]] = {}
+        self.ready = False
+
+    def compile(self, module):
+        """`module` compiled with `compile_mode`, or unchanged when compilation is off."""
+        if not self.compile_mode:
+            return module
+        # Inductor reads the cache location when it first compiles
+        os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", self.compile_cache_dir)
+        import torch
+        torch._inductor.config.fx_graph_cache = True
+        # One graph per bucket, plus headroom for the sizes requests don't snap
+        torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, 2 * len(self.buckets) + 8)
+        print(f"Compiling {type(module).__name__} with mode {self.compile_mode}, cache in {os.environ['TORCHINDUCTOR_CACHE_DIR']}")
+        return torch.compile(module, mode=self.compile_mode, dynamic=False)
+
+    def run(self, render: Callable[[int, int, int], Any], timeline=None) -> Dict[str, Dict[str, Any]]:
+        """Call `render(width, height, batch_size)` `repeats` times per bucket.
+
+        A bucket that fails is logged and left cold; requests aren't snapped to it.
+        """
+        if self.cudnn_benchmark:
+            import torch
+            torch.backends.cudnn.benchmark = True
+        warmed = []
+        for width, height, batch_size in self.buckets:
+            name = f"{width}x{height}x{batch_size}"
+            seconds = []
+            try:
+                for _ in range(self.repeats):
+                    start = time.perf_counter()
+                    if timeline is None:
+                        render(width, height, batch_size)
+                    else:
+                        with timeline.phase(f"warmup:{name}"):
+                            render(width, height, batch_size)
+                    seconds.append(round(time.perf_counter() - start, 3))
+            except Exception as e:
+                print(f"Warmup of bucket {name} failed: {e}")
+                self.results[name] = {"error": str(e), "seconds": seconds}
+                continue
+            print(f"Warmed bucket {name} in {seconds} seconds")
+            self.results[name] = {"seconds": seconds}
+            warmed.append((width, height))
+        self.policy = BucketPolicy(warmed)
+        self.ready = True
+        return self.results
+
+    def snap(self, width: int, height: int, max_pixels: Optional[int] = None) -> Tuple[int, int]:
+        if not self.snap_requests:
+            return width, height
+        return self.policy.snap(width, height, max_pixels)
+
+
+def from_env(default_buckets: str, snap_size: Optional[Callable[[int, int], Tuple[int, int]]] = None) -> Warmup:
+    # An empty WARMUP_BUCKETS skips warmup; TORCH_COMPILE takes a torch.compile mode, e.g. max-autotune-no-cudagraphs
+    return Warmup(
+        buckets=parse_buckets(os.getenv("WARMUP_BUCKETS", default_buckets)),
+        repeats=int(os.getenv("WARMUP_REPEATS", "1")),
+        snap_requests=os.getenv("WARMUP_SNAP", "1") == "1",
+        snap_size=snap_size,
+        compile_mode=os.getenv("TORCH_COMPILE") or None,
+        compile_cache_dir=os.getenv("TORCH_COMPILE_CACHE_DIR", "/tmp/torch-compile-cache"),
+        cudnn_benchmark=os.getenv("CUDNN_BENCHMARK", "1") == "1",
+    )